@@ -0,0 +1,273 @@
+"""
+Контроль допуска запросов и сброс нагрузки (FSTR_ADMISSION_*, FSTR_RATE_*)
+
+Когда БД не успевает, запросы не копятся в ожидании соединения пула
+(до FSTR_DB_POOL_TIMEOUT секунд), а быстро получают 503 с Retry-After.
+
+Маршруты делятся на классы: read - чтения, submit - отправки и изменения,
+upload - пакеты, multipart и отправки с большим телом (изображения
+в base64), export - выгрузка. У класса свой предел одновременных запросов,
+очередь не длиннее этого предела и бюджет ожидания в ней. Все классы
+делят общий предел FSTR_ADMISSION_CONCURRENCY; освободившееся место
+получает ожидающий запрос с наивысшим приоритетом: сначала чтения,
+отправки с изображениями - последними. Запрос, пришедший к полной очереди
+или не получивший места за бюджет класса, получает 503 сразу.
+
+Частота запросов клиента ограничивается token bucket: по IP для всех
+запросов класса и по email для отправок; превышение - 429 с Retry-After.
+Служебные маршруты (/, /metrics, /cache/stats, документация) не ограничиваются.
+Пределы действуют в каждом рабочем процессе отдельно.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from starlette.responses import JSONResponse
+
+from app import metrics
+from app.database import pool_params_from_env
+
+ADMISSION_ENABLED = os.getenv('FSTR_ADMISSION', '1') not in ('0', 'false', 'no', '')
+# по умолчанию - четыре запроса на соединение пула: чтения из кэша и индексов БД не ждут
+ADMISSION_CONCURRENCY = int(os.getenv('FSTR_ADMISSION_CONCURRENCY')
+                            or 4 * max(pool_params_from_env()['maxconn'], 1))
+# тело POST /submitData больше этого - отправка с изображениями (класс upload)
+UPLOAD_BODY_SIZE = int(os.getenv('FSTR_ADMISSION_UPLOAD_BODY', str(64 * 1024)))
+RATE_LIMIT = float(os.getenv('FSTR_RATE_LIMIT', '50'))
+RATE_BURST = float(os.getenv('FSTR_RATE_BURST', '100'))
+SUBMIT_RATE_LIMIT = float(os.getenv('FSTR_SUBMIT_RATE_LIMIT', '1'))
+SUBMIT_RATE_BURST = float(os.getenv('FSTR_SUBMIT_RATE_BURST', '20'))
+RATE_MAX_CLIENTS = 100000
+SHED_RETRY_AFTER = 1
+EXEMPT_PATHS = frozenset(('/', '/metrics', '/cache/stats', '/docs', '/redoc', '/openapi.json'))
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RateLimitedError(Exception):
+    """Клиент превысил допустимую частоту запросов"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """
+    Не больше limit одновременных владельцев мест; ожидающие получают
+    место по приоритету (меньше - раньше), при равном - в порядке прихода
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(limit, 1)
+        self.in_use = 0
+        self.waiting = 0
+        # (приоритет, порядковый номер, future); отменённые удаляются при выдаче мест
+        self._waiters: list = []
+        self._order = itertools.count()
+
+    async def acquire(self, timeout: float, priority: int = 0) -> bool:
+        """Занять место, ожидая не дольше timeout секунд; False - не дождались"""
+        if self.in_use < self.limit and not self.waiting:
+            self.in_use += 1
+            return True
+        if timeout <= 0:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # место передали в момент отмены - возвращаем его
+                self.release()
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+        finally:
+            self.waiting -= 1
+            if len(self._waiters) > 2 * self.waiting + 64:
+                self._waiters = [waiter for waiter in self._waiters if not waiter[2].done()]
+                heapq.heapify(self._waiters)
+
+    def release(self):
+        """Освободить место: оно переходит первому ожидающему, если он есть"""
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+
+class RouteClass:
+    """Класс маршрутов: приоритет, предел одновременных запросов и бюджет ожидания"""
+
+    def __init__(self, name: str, priority: int, limit: int, budget: float):
+        self.name = name
+        self.priority = priority
+        self.budget = budget
+        self.limiter = Limiter(limit)
+
+
+class AdmissionController:
+    """Классы маршрутов и общий предел одновременных запросов"""
+
+    def __init__(self, concurrency: int, classes: Dict[str, RouteClass]):
+        self.total = Limiter(concurrency)
+        self.classes = classes
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        concurrency = ADMISSION_CONCURRENCY
+
+        def route_class(name: str, priority: int, limit: int, budget: float) -> RouteClass:
+            prefix = f'FSTR_ADMISSION_{name.upper()}'
+            return RouteClass(name, priority,
+                              int(os.getenv(f'{prefix}_LIMIT') or limit),
+                              float(os.getenv(f'{prefix}_BUDGET', str(budget))))
+
+        return cls(concurrency, {
+            'read': route_class('read', 0, concurrency, 0.5),
+            'submit': route_class('submit', 1, concurrency // 2, 1.0),
+            'export': route_class('export', 1, 2, 0),
+            'upload': route_class('upload', 2, concurrency // 4, 2.0),
+        })
+
+    def classify(self, scope) -> Optional[RouteClass]:
+        """Класс запроса по методу и пути; None - служебный маршрут без ограничений"""
+        path = scope['path']
+        if path in EXEMPT_PATHS:
+            return None
+        method = scope['method']
+        if method in SAFE_METHODS:
+            return self.classes['export' if path == '/export' else 'read']
+        if method == 'POST' and path.startswith('/submitData'):
+            if path in ('/submitData/batch', '/submitData/multipart'):
+                return self.classes['upload']
+            for name, value in scope['headers']:
+                if name == b'content-length':
+                    if value.isdigit() and int(value) > UPLOAD_BODY_SIZE:
+                        return self.classes['upload']
+                    break
+        return self.classes['submit']
+
+    async def admit(self, route_class: RouteClass) -> Optional[str]:
+        """Занять место для запроса; иначе причина отказа: queue_full или timeout"""
+        started = time.monotonic()
+        if route_class.limiter.waiting >= route_class.limiter.limit:
+            return 'queue_full'
+        if not await route_class.limiter.acquire(route_class.budget):
+            return 'timeout'
+        remaining = route_class.budget - (time.monotonic() - started)
+        try:
+            admitted = await self.total.acquire(remaining, route_class.priority)
+        except asyncio.CancelledError:
+            route_class.limiter.release()
+            raise
+        if not admitted:
+            route_class.limiter.release()
+            return 'timeout'
+        metrics.admission_wait.observe(time.monotonic() - started, route_class.name)
+        return None
+
+    def release(self, route_class: RouteClass):
+        self.total.release()
+        route_class.limiter.release()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Занятые места и ожидающие запросы по классам"""
+        return {name: {"in_flight": route_class.limiter.in_use, "waiting": route_class.limiter.waiting}
+                for name, route_class in self.classes.items()}
+
+
+class TokenBuckets:
+    """
+    Token bucket на клиента: rate запросов в секунду, подряд не больше burst
+    Хранятся последние RATE_MAX_CLIENTS клиентов; rate <= 0 - без ограничения
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = RATE_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self._buckets: OrderedDict = OrderedDict()
+
+    def take(self, key: Hashable) -> float:
+        """Списать токен клиента; 0 - запрос разрешён, иначе секунды до появления токена"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.pop(key, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def check(self, key: Hashable):
+        """Как take, но при превышении - RateLimitedError"""
+        wait = self.take(key)
+        if wait:
+            raise RateLimitedError("Слишком много запросов, повторите позже", wait)
+
+
+def retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+class AdmissionMiddleware:
+    """
+    ASGI-посредник контроля допуска
+
+    Место занято до конца ответа, в том числе потокового (выгрузка,
+    NDJSON): всё это время запрос держит курсор и соединение с БД.
+    """
+
+    def __init__(self, app, controller: AdmissionController, clients: TokenBuckets):
+        self.app = app
+        self.controller = controller
+        self.clients = clients
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        route_class = self.controller.classify(scope)
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get('client')
+        wait = self.clients.take(client[0] if client else None)
+        if wait:
+            metrics.admission_shed.inc(route_class.name, 'rate_limit')
+            response = JSONResponse(status_code=429, content={"detail": "Слишком много запросов, повторите позже"},
+                                    headers={"Retry-After": retry_after(wait)})
+            await response(scope, receive, send)
+            return
+
+        reason = await self.controller.admit(route_class)
+        if reason is not None:
+            metrics.admission_shed.inc(route_class.name, reason)
+            response = JSONResponse(status_code=503, content={"detail": "Сервер перегружен, повторите позже"},
+                                    headers={"Retry-After": str(SHED_RETRY_AFTER)})
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(route_class)
@@ -0,0 +1,115 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class AreaTree:
+    """
+    Дерево районов pereval_areas в памяти процесса
+
+    Узлы пронумерованы в порядке обхода в глубину (эйлеров обход): потомки
+    узла v занимают в массиве order отрезок [tin[v], tout[v]). Поэтому
+    проверка «a - предок b» выполняется за O(1), а список потомков - за
+    O(размер поддерева) без рекурсивных запросов к БД.
+    """
+
+    def __init__(self, rows: Iterable[Tuple[int, int, Optional[str]]] = ()):
+        rows = list(rows)
+        self.ids: List[int] = [row[0] for row in rows]
+        self.titles: List[Optional[str]] = [row[2] for row in rows]
+        self.index: Dict[int, int] = {area_id: idx for idx, area_id in enumerate(self.ids)}
+
+        n = len(rows)
+        # корень (у «Планеты Земля» id_parent = id) и узлы с несуществующим родителем
+        self.parent: List[int] = []
+        for idx, (area_id, parent_id, _) in enumerate(rows):
+            parent = self.index.get(parent_id, -1)
+            self.parent.append(-1 if parent == idx else parent)
+
+        children: List[List[int]] = [[] for _ in range(n)]
+        for idx, parent in enumerate(self.parent):
+            if parent >= 0:
+                children[parent].append(idx)
+        for child_list in children:
+            child_list.sort(key=lambda idx: self.ids[idx])
+
+        self.tin = [0] * n
+        self.tout = [0] * n
+        self.depth = [0] * n
+        self.order: List[int] = []
+        visited = [False] * n
+
+        def walk(root: int):
+            visited[root] = True
+            self.depth[root] = 0
+            stack = [(root, 0)]
+            self.tin[root] = len(self.order)
+            self.order.append(root)
+            while stack:
+                node, next_child = stack[-1]
+                if next_child < len(children[node]):
+                    stack[-1] = (node, next_child + 1)
+                    child = children[node][next_child]
+                    if visited[child]:
+                        continue
+                    visited[child] = True
+                    self.depth[child] = self.depth[node] + 1
+                    self.tin[child] = len(self.order)
+                    self.order.append(child)
+                    stack.append((child, 0))
+                else:
+                    self.tout[node] = len(self.order)
+                    stack.pop()
+
+        for idx in sorted(range(n), key=lambda idx: self.ids[idx]):
+            if self.parent[idx] < 0:
+                walk(idx)
+        # узлы в цикле без выхода к корню: разрываем цикл и считаем их корнями
+        for idx in range(n):
+            if not visited[idx]:
+                self.parent[idx] = -1
+                walk(idx)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, area_id: int) -> bool:
+        return area_id in self.index
+
+    def _node(self, idx: int, depth_base: int = 0) -> Dict[str, Any]:
+        parent = self.parent[idx]
+        return {
+            "id": self.ids[idx],
+            "id_parent": self.ids[parent] if parent >= 0 else self.ids[idx],
+            "title": self.titles[idx],
+            "depth": self.depth[idx] - depth_base
+        }
+
+    def is_ancestor(self, ancestor_id: int, area_id: int) -> bool:
+        """Является ли ancestor_id предком area_id (или им самим)"""
+        a = self.index.get(ancestor_id)
+        b = self.index.get(area_id)
+        if a is None or b is None:
+            return False
+        return self.tin[a] <= self.tin[b] < self.tout[a]
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Все районы в порядке обхода дерева"""
+        return [self._node(idx) for idx in self.order]
+
+    def subtree(self, area_id: int) -> List[Dict[str, Any]]:
+        """Район и все его потомки; depth - глубина относительно района"""
+        idx = self.index[area_id]
+        base = self.depth[idx]
+        return [self._node(node, base) for node in self.order[self.tin[idx]:self.tout[idx]]]
+
+    def subtree_ids(self, area_id: int) -> List[int]:
+        idx = self.index[area_id]
+        return [self.ids[node] for node in self.order[self.tin[idx]:self.tout[idx]]]
+
+    def path(self, area_id: int) -> List[Dict[str, Any]]:
+        """Путь от корня до района"""
+        idx = self.index[area_id]
+        nodes = []
+        while idx >= 0:
+            nodes.append(idx)
+            idx = self.parent[idx]
+        return [self._node(node) for node in reversed(nodes)]
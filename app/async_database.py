@@ -0,0 +1,1090 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator, Awaitable, Callable, List, Tuple
+import asyncpg
+import orjson
+
+from app.changes import ALL_CHANGES_QUERY, SNAPSHOT_XMIN_QUERY, USER_CHANGES_QUERY
+from app.database import (
+    PEREVAL_TEXT_COLUMNS,
+    PoolExhaustedError,
+    VersionConflictError,
+    build_images_json,
+    build_raw_data,
+    build_raw_patch,
+    db_params_from_env,
+    pool_params_from_env,
+)
+from app.duplicates import DUPLICATES_QUERY, SAVE_DUPLICATES_BATCH_QUERY, SAVE_DUPLICATES_QUERY, Candidate
+from app.idempotency import IDEMPOTENCY_TTL, IdempotencyKeyConflictError, check_request_hash
+from app.image_store import COLLECT_IMAGES_QUERY, UPSERT_IMAGE_BLOB_QUERY, image_store_from_env
+from app.images import image_sources_from_payload, payload_images
+from app.ingest import INGEST_STATUS_QUERY, RESERVE_IDS_QUERY
+from app.metrics import db_method, db_reads, record_error, record_query
+from app.replicas import (
+    PRIMARY_LSN_QUERY,
+    REPLICA_CHECK_INTERVAL,
+    REPLICA_ERRORS,
+    REPLICA_LSN_QUERY,
+    REPLICA_MAX_LAG,
+    LagTracker,
+    Replica,
+    read_from_primary,
+    replica_hosts_from_env,
+)
+from app.stats import RECONCILE_QUERY, STATS_QUERY, TOP_CONTRIBUTORS_QUERY
+
+# Сохранить ключи Idempotency-Key; занятый ключ перезаписывается, только если он устарел
+SAVE_IDEMPOTENCY_KEY_QUERY = """
+INSERT INTO pereval_idempotency (key, request_hash, pereval_id)
+SELECT * FROM unnest($1::text[], $2::bytea[], $3::int[])
+ON CONFLICT (key) DO UPDATE
+    SET request_hash = EXCLUDED.request_hash, pereval_id = EXCLUDED.pereval_id, created_at = now()
+    WHERE pereval_idempotency.created_at <= now() - make_interval(secs => $4)
+RETURNING pereval_id, key
+"""
+
+
+class TimedConnection:
+    """
+    Соединение asyncpg с замером времени запросов (app.metrics)
+
+    asyncpg не разделяет выполнение запроса и передачу строк, поэтому
+    execute/fetch*/fetchval учитываются как фаза execute, а последующие
+    порции строк серверного курсора - как фаза fetch.
+    """
+    __slots__ = ('_conn',)
+
+    def __init__(self, conn: asyncpg.Connection):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _timed(self, call, query, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return await call(query, *args, **kwargs)
+        except Exception as e:
+            record_error(e)
+            raise
+        finally:
+            record_query('execute', time.perf_counter() - started, query, args)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._timed(self._conn.execute, query, args, kwargs)
+
+    async def executemany(self, query, args, **kwargs):
+        return await self._timed(self._conn.executemany, query, (args,), kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._timed(self._conn.fetch, query, args, kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._timed(self._conn.fetchrow, query, args, kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._timed(self._conn.fetchval, query, args, kwargs)
+
+    async def cursor(self, query, *args, prefetch: int = 100, **kwargs):
+        """
+        Итерация по серверному курсору: время до первой строки - фаза execute,
+        получение остальных порций строк - фаза fetch
+        """
+        iterator = self._conn.cursor(query, *args, prefetch=prefetch, **kwargs).__aiter__()
+        first = True
+        fetching = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    row = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception as e:
+                    record_error(e)
+                    raise
+                finally:
+                    elapsed = time.perf_counter() - started
+                    if first:
+                        record_query('execute', elapsed, query, args)
+                        first = False
+                    else:
+                        fetching += elapsed
+                yield row
+        finally:
+            if fetching:
+                record_query('fetch', fetching, query, args)
+
+
+class AsyncDatabaseManager:
+    """
+    Асинхронная реализация интерфейса DatabaseManager на asyncpg
+
+    Используется обработчиками FastAPI, чтобы запросы к БД не блокировали
+    цикл событий. Пул создаётся в каждом процессе отдельно при запуске
+    приложения (или лениво при первом запросе).
+    Если заданы реплики (FSTR_DB_REPLICAS, см. app.replicas), чтения, не
+    требующие свежих данных, идут на них, а при их недоступности - на
+    основной сервер.
+    """
+
+    def __init__(self):
+        self.db_params = db_params_from_env()
+        self.db_params['port'] = int(self.db_params['port'])
+        self.pool_params = pool_params_from_env()
+        self.pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+        self._listener: Optional[asyncpg.Connection] = None
+        # установлено ли расширение pg_trgm (проверяется при первом поиске)
+        self._trgm: Optional[bool] = None
+        self.replicas = [Replica(host, port) for host, port in replica_hosts_from_env()]
+        self.max_lag = REPLICA_MAX_LAG
+        self._lag = LagTracker(window=max(REPLICA_MAX_LAG * 2, REPLICA_CHECK_INTERVAL * 3))
+        self._next_replica = 0
+        self._replica_task: Optional[asyncio.Task] = None
+        # id недавно изменённых записей -> время изменения (читаются с основного сервера)
+        self._recent_changes: OrderedDict = OrderedDict()
+        self.images = image_store_from_env()
+
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection):
+        for type_name in ('json', 'jsonb'):
+            await conn.set_type_codec(
+                type_name,
+                encoder=lambda value: orjson.dumps(value).decode(),
+                decoder=orjson.loads,
+                schema='pg_catalog'
+            )
+
+    async def connect(self):
+        """Создаём пул соединений с БД"""
+        async with self._pool_lock:
+            if self.pool is not None:
+                return
+            try:
+                self.pool = await asyncpg.create_pool(
+                    **self.db_params,
+                    min_size=self.pool_params['minconn'],
+                    max_size=max(self.pool_params['maxconn'], 1),
+                    max_inactive_connection_lifetime=self.pool_params['check_interval'] * 10,
+                    init=self._init_connection
+                )
+            except Exception as e:
+                print(f"Ошибка подключения к БД: {e}")
+                raise
+            if self.replicas:
+                await self.check_replicas()
+                self._replica_task = asyncio.get_running_loop().create_task(self._watch_replicas())
+
+    async def listen(self, channel: str, callback):
+        """
+        Подписаться на NOTIFY канала channel
+        callback(payload) вызывается в цикле событий для каждого уведомления;
+        для подписок используется отдельное соединение вне пула
+        """
+        if self._listener is None or self._listener.is_closed():
+            self._listener = await asyncpg.connect(**self.db_params)
+        await self._listener.add_listener(
+            channel, lambda conn, pid, channel_name, payload: callback(payload)
+        )
+
+    async def close(self):
+        """Закрыть все соединения пула"""
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+        async with self._pool_lock:
+            if self._replica_task is not None:
+                self._replica_task.cancel()
+                self._replica_task = None
+            for replica in self.replicas:
+                if replica.pool is not None:
+                    await replica.pool.close()
+                    replica.pool = None
+                replica.healthy = False
+            if self.pool is not None:
+                await self.pool.close()
+                self.pool = None
+
+    async def check_replicas(self):
+        """Проверить все реплики: доступность, режим восстановления и отставание"""
+        timeout = self.pool_params['timeout']
+        try:
+            async with self.pool.acquire(timeout=timeout) as conn:
+                self._lag.sample(await asyncio.wait_for(conn.fetchval(PRIMARY_LSN_QUERY), timeout))
+        except Exception as e:
+            print(f"Ошибка при получении позиции журнала основного сервера: {e}")
+        await asyncio.gather(*(self._check_replica(replica) for replica in self.replicas))
+
+    async def _check_replica(self, replica: Replica):
+        timeout = self.pool_params['timeout']
+        try:
+            if replica.pool is None:
+                # без минимума соединений: пул недоступной реплики не переподключается сам
+                replica.pool = await asyncio.wait_for(asyncpg.create_pool(
+                    **dict(self.db_params, host=replica.host, port=replica.port),
+                    min_size=0,
+                    max_size=max(self.pool_params['maxconn'], 1),
+                    max_inactive_connection_lifetime=self.pool_params['check_interval'] * 10,
+                    init=self._init_connection
+                ), timeout)
+            async with replica.pool.acquire(timeout=timeout) as conn:
+                in_recovery, lsn = await asyncio.wait_for(conn.fetchrow(REPLICA_LSN_QUERY), timeout)
+            if in_recovery:
+                replica.mark_checked(self._lag.lag(lsn), self.max_lag)
+            else:
+                replica.mark_failed("сервер не в режиме реплики")
+        except Exception as e:
+            replica.mark_failed(e)
+
+    async def _watch_replicas(self):
+        while True:
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+            await self.check_replicas()
+
+    def replica_stats(self) -> List[Dict[str, Any]]:
+        """Состояние реплик по последней проверке"""
+        return [replica.stats() for replica in self.replicas]
+
+    def note_change(self, pereval_id: int):
+        """
+        Запись изменилась (NOTIFY pereval_changed): пока реплики могут её
+        не знать (FSTR_DB_REPLICA_MAX_LAG плюс интервал проверки), она читается
+        с основного сервера, чтобы в кэш не попала старая версия
+        """
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        self._recent_changes.pop(pereval_id, None)
+        self._recent_changes[pereval_id] = now
+        expired = now - self.max_lag - REPLICA_CHECK_INTERVAL
+        while next(iter(self._recent_changes.values())) < expired:
+            self._recent_changes.popitem(last=False)
+
+    def _changed_recently(self, pereval_id: int) -> bool:
+        changed_at = self._recent_changes.get(pereval_id)
+        return changed_at is not None and changed_at >= time.monotonic() - self.max_lag - REPLICA_CHECK_INTERVAL
+
+    def _pick_replica(self) -> Optional[Replica]:
+        """Следующая по кругу доступная реплика или None - читать с основного сервера"""
+        if not self.replicas or read_from_primary.get():
+            return None
+        available = [replica for replica in self.replicas if replica.available]
+        if not available:
+            return None
+        self._next_replica = (self._next_replica + 1) % len(available)
+        return available[self._next_replica]
+
+    async def _read(self, run: Callable[[Any], Awaitable[Any]], retry_missing: bool = False,
+                    primary: bool = False):
+        """
+        Выполнить чтение run(conn) на реплике, а если реплики нет или она
+        не ответила - на основном сервере (реплика исключается до проверки)
+        retry_missing - пустой результат реплики повторяется на основном
+        сервере: запись могла ещё не дойти до реплики
+        """
+        replica = None if primary else self._pick_replica()
+        if replica is not None:
+            try:
+                async with self.connection(replica) as conn:
+                    result = await run(conn)
+                if result or not retry_missing:
+                    db_reads.inc('replica')
+                    return result
+            except REPLICA_ERRORS as e:
+                replica.mark_failed(e)
+            db_reads.inc('fallback')
+        else:
+            db_reads.inc('primary')
+        async with self.connection() as conn:
+            return await run(conn)
+
+    @asynccontextmanager
+    async def read_connection(self):
+        """
+        Соединение для длинного чтения (серверного курсора) с реплики или
+        основного сервера; если реплика не выдала соединение - с основного,
+        ошибки посреди чтения не повторяются
+        """
+        replica = self._pick_replica()
+        if replica is not None:
+            try:
+                conn = await self._acquire(replica.pool)
+            except REPLICA_ERRORS as e:
+                replica.mark_failed(e)
+                db_reads.inc('fallback')
+            else:
+                db_reads.inc('replica')
+                try:
+                    yield TimedConnection(conn)
+                finally:
+                    await replica.pool.release(conn)
+                return
+        else:
+            db_reads.inc('primary')
+        async with self.connection() as conn:
+            yield conn
+
+    def pool_stats(self) -> Dict[str, int]:
+        """Соединения пула: открыто, занято, предел"""
+        if self.pool is None:
+            return {'size': 0, 'in_use': 0, 'max': self.pool_params['maxconn']}
+        size = self.pool.get_size()
+        return {'size': size, 'in_use': size - self.pool.get_idle_size(), 'max': self.pool.get_max_size()}
+
+    @asynccontextmanager
+    async def connection(self, replica: Optional[Replica] = None):
+        """
+        Взять соединение из пула, ожидая не дольше FSTR_DB_POOL_TIMEOUT секунд
+        replica - из пула реплики, по умолчанию основного сервера
+        """
+        if self.pool is None:
+            await self.connect()
+        pool = self.pool if replica is None else replica.pool
+        conn = await self._acquire(pool)
+        try:
+            yield TimedConnection(conn)
+        finally:
+            await pool.release(conn)
+
+    async def _acquire(self, pool: asyncpg.Pool) -> asyncpg.Connection:
+        timeout = self.pool_params['timeout']
+        started = time.perf_counter()
+        try:
+            return await pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            raise PoolExhaustedError(
+                f"Нет свободных соединений с БД (занято {pool.get_size()}, "
+                f"ожидание {timeout} с)"
+            )
+        finally:
+            record_query('connect', time.perf_counter() - started)
+
+    async def store_image(self, conn: asyncpg.Connection, chunks, created: Optional[List[str]] = None) -> str:
+        """
+        Сохраняет изображение в хранилище (app.image_store) и возвращает его sha256
+        chunks - обычный или асинхронный итератор байтовых частей; строка
+        image_blobs записывается в транзакции conn до переноса файла на место.
+        В created добавляются хэши изображений, которых не было ни в БД, ни
+        в хранилище: при откате транзакции их нужно удалить (discard_images)
+        """
+        staged = await asyncio.to_thread(self.images.stage)
+        try:
+            if hasattr(chunks, '__aiter__'):
+                async for chunk in chunks:
+                    await asyncio.to_thread(staged.write, chunk)
+            else:
+                for chunk in chunks:
+                    await asyncio.to_thread(staged.write, chunk)
+            inserted = await conn.fetchval(UPSERT_IMAGE_BLOB_QUERY, staged.digest, staged.size)
+            if await asyncio.to_thread(self.images.commit, staged) and inserted and created is not None:
+                created.append(staged.hexdigest)
+        except BaseException:
+            await asyncio.to_thread(self.images.discard, staged)
+            raise
+        return staged.hexdigest
+
+    async def store_images(self, conn: asyncpg.Connection, image_sources,
+                           created: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Сохраняет изображения и возвращает документ images со ссылками на них"""
+        titles = []
+        image_hashes = []
+        for title, chunks in image_sources:
+            titles.append(title)
+            image_hashes.append(await self.store_image(conn, chunks, created))
+        return build_images_json(titles, image_hashes)
+
+    async def discard_images(self, created: List[str]):
+        """
+        Удалить файлы изображений, созданные транзакцией, перед её откатом
+        Пока транзакция не откачена, её строки image_blobs заблокированы:
+        запись того же изображения другим запросом ждёт отката и затем
+        сохраняет файл заново
+        """
+        for hash_hex in created:
+            try:
+                await asyncio.to_thread(self.images.delete, hash_hex)
+            except Exception as e:
+                print(f"Ошибка при удалении изображения {hash_hex}: {e}")
+        created.clear()
+
+    @db_method
+    async def add_pereval(self, pereval_data: Dict[str, Any], image_sources=None,
+                          content_hash: Optional[bytes] = None, idempotency_key: Optional[str] = None,
+                          request_hash: Optional[bytes] = None,
+                          duplicates: Optional[List[Candidate]] = None) -> Optional[int]:
+        """
+        Добавляет перевал в базу данных вместе с изображениями
+        image_sources - пары (название, части содержимого); по умолчанию
+        изображения берутся из pereval_data["images"] (base64)
+        content_hash - хэш содержимого (app.idempotency): если запись с таким
+        хэшем уже есть, новая не создаётся и возвращается id существующей;
+        idempotency_key сохраняется вместе с записью (request_hash - хэш
+        данных запроса, по умолчанию content_hash)
+        duplicates - возможные дубликаты записи (app.duplicates), сохраняются
+        той же транзакцией
+        Возвращает id добавленной записи или None при ошибке
+        """
+        if request_hash is None:
+            request_hash = content_hash
+        try:
+            raw_data = build_raw_data(pereval_data)
+            if image_sources is None:
+                image_sources = image_sources_from_payload(payload_images(pereval_data))
+
+            created: List[str] = []
+            async with self.connection() as conn:
+                transaction = conn.transaction()
+                await transaction.start()
+                try:
+                    # такие данные уже сохранены: изображения не пишем
+                    pereval_id = None
+                    if content_hash is None or not await conn.fetchval(
+                            "SELECT 1 FROM pereval_added WHERE content_hash = $1", content_hash):
+                        images_json = await self.store_images(conn, image_sources, created)
+
+                        query = """
+                        INSERT INTO pereval_added (raw_data, images, date_added, content_hash)
+                        VALUES ($1::jsonb, $2::jsonb, NOW(), $3)
+                        ON CONFLICT (content_hash) WHERE content_hash IS NOT NULL DO NOTHING
+                        RETURNING id;
+                        """
+                        pereval_id = await conn.fetchval(query, raw_data, images_json, content_hash)
+                    if pereval_id is not None and duplicates:
+                        await conn.execute(SAVE_DUPLICATES_QUERY, pereval_id, *map(list, zip(*duplicates)))
+                    if pereval_id is not None and idempotency_key is not None:
+                        pereval_id = await conn.fetchval(
+                            SAVE_IDEMPOTENCY_KEY_QUERY, [idempotency_key], [request_hash], [pereval_id],
+                            IDEMPOTENCY_TTL
+                        )
+                except BaseException:
+                    await self.discard_images(created)
+                    await transaction.rollback()
+                    raise
+                if pereval_id is not None:
+                    await transaction.commit()
+                    return pereval_id
+                await self.discard_images(created)
+                await transaction.rollback()
+
+            # те же данные или тот же ключ одновременно сохранил другой запрос
+            found = await self.find_submission(idempotency_key, content_hash)
+            if found["key_id"] is not None:
+                check_request_hash(found["request_hash"], request_hash)
+                return found["key_id"]
+            return found["duplicate_id"]
+
+        except (PoolExhaustedError, IdempotencyKeyConflictError):
+            raise
+        except Exception as e:
+            print(f"Ошибка при добавлении перевала: {e}")
+            return None
+
+    @db_method
+    async def find_submission(self, key: Optional[str], content_hash: Optional[bytes]) -> Dict[str, Any]:
+        """
+        Ранее принятая отправка одним запросом: по ключу Idempotency-Key
+        (key_id, request_hash; ключи старше IDEMPOTENCY_TTL не учитываются)
+        и по хэшу содержимого (duplicate_id)
+        """
+        async with self.connection() as conn:
+            row = await conn.fetchrow("""
+            SELECT k.pereval_id AS key_id, k.request_hash,
+                   (SELECT id FROM pereval_added WHERE content_hash = $2) AS duplicate_id
+            FROM (SELECT 1) AS one
+            LEFT JOIN pereval_idempotency k
+                ON k.key = $1 AND k.created_at > now() - make_interval(secs => $3)
+            """, key, content_hash, IDEMPOTENCY_TTL)
+            return dict(row)
+
+    @db_method
+    async def purge_idempotency_keys(self, batch_size: int = 10000) -> int:
+        """Удалить ключи Idempotency-Key старше IDEMPOTENCY_TTL (пачками, чтобы не держать блокировки)"""
+        deleted = 0
+        async with self.connection() as conn:
+            while True:
+                status = await conn.execute("""
+                DELETE FROM pereval_idempotency WHERE key IN (
+                    SELECT key FROM pereval_idempotency
+                    WHERE created_at <= now() - make_interval(secs => $1)
+                    LIMIT $2
+                )
+                """, IDEMPOTENCY_TTL, batch_size)
+                count = int(status.split()[-1])
+                deleted += count
+                if count < batch_size:
+                    return deleted
+
+    @db_method
+    async def reserve_ids(self, count: int) -> List[int]:
+        """
+        Зарезервировать count id из pereval_id_seq одним запросом
+        и отметить их в pereval_ingest_status как queued (app.ingest)
+        """
+        async with self.connection() as conn:
+            rows = await conn.fetch(RESERVE_IDS_QUERY, count)
+            return sorted(row['id'] for row in rows)
+
+    @db_method
+    async def save_ingest_states(self, persisted: List[int], failed: List[Tuple[int, str]]):
+        """Состояние записей очереди после записи пачки: сохранённые и пары (id, ошибка)"""
+        async with self.connection() as conn:
+            async with conn.transaction():
+                if persisted:
+                    await conn.execute("DELETE FROM pereval_ingest_status WHERE id = ANY($1::int[])", persisted)
+                if failed:
+                    await conn.execute("""
+                    INSERT INTO pereval_ingest_status (id, state, error)
+                    SELECT id, 'failed', error FROM unnest($1::int[], $2::text[]) AS t(id, error)
+                    ON CONFLICT (id) DO UPDATE
+                        SET state = EXCLUDED.state, error = EXCLUDED.error, updated_at = now()
+                    """, [pereval_id for pereval_id, _ in failed], [error for _, error in failed])
+
+    @db_method
+    async def get_ingest_status(self, pereval_id: int) -> Optional[Tuple[str, Optional[str]]]:
+        """Состояние записи (persisted, queued или failed) и ошибка; None - такой записи нет"""
+        async with self.connection() as conn:
+            row = await conn.fetchrow(INGEST_STATUS_QUERY, pereval_id)
+            return None if row['state'] is None else (row['state'], row['error'])
+
+    @db_method
+    async def purge_ingest_status(self, ttl: float) -> int:
+        """Удалить состояния записей очереди старше ttl секунд"""
+        async with self.connection() as conn:
+            status = await conn.execute(
+                "DELETE FROM pereval_ingest_status WHERE updated_at <= now() - make_interval(secs => $1)", ttl
+            )
+            return int(status.split()[-1])
+
+    @db_method
+    async def existing_ids(self, ids: List[int]) -> set:
+        """Какие из id уже есть в pereval_added"""
+        async with self.connection() as conn:
+            rows = await conn.fetch("SELECT id FROM pereval_added WHERE id = ANY($1::int[])", ids)
+            return {row['id'] for row in rows}
+
+    @db_method
+    async def add_perevals(self, perevals: List[Dict[str, Any]],
+                           ids: Optional[List[int]] = None,
+                           content_hashes: Optional[List[Optional[bytes]]] = None,
+                           keys: Optional[List[Optional[str]]] = None,
+                           duplicates: Optional[List[Optional[List[Candidate]]]] = None) -> List[int]:
+        """
+        Добавляет несколько перевалов одной транзакцией
+        id резервируются из pereval_id_seq одним запросом (или передаются
+        заранее зарезервированные в ids), строки записываются одним
+        многострочным INSERT ... SELECT FROM unnest.
+        content_hashes - хэши содержимого: для уже сохранённых данных (и повторов
+        внутри пачки) запись не создаётся, вместо её id возвращается id
+        существующей; keys - ключи Idempotency-Key записей (или None): если
+        ключ уже занят, в том числе одновременным запросом, запись не создаётся
+        и возвращается id записи ключа (IdempotencyKeyConflictError, если ключ
+        использован для других данных);
+        duplicates - возможные дубликаты каждой записи (app.duplicates)
+        Возвращает id в порядке входного списка;
+        при ошибке откатывается вся пачка и исключение пробрасывается.
+        """
+        if not perevals:
+            return []
+        if content_hashes is None:
+            content_hashes = [None] * len(perevals)
+
+        created: List[str] = []
+        async with self.connection() as conn:
+            async with conn.transaction():
+                try:
+                    if ids is None:
+                        ids = [row['id'] for row in await conn.fetch(
+                            "SELECT nextval('pereval_id_seq') AS id FROM generate_series(1, $1)",
+                            len(perevals)
+                        )]
+                    ids = list(ids)
+                    reserved = list(ids)
+
+                    # ключи сохраняются до записи строк: запись, чей ключ уже занят
+                    # (в том числе одновременным запросом), не создаётся, вместо её id -
+                    # id записи ключа; повтор ключа в пачке - id первой записи с ним
+                    saved = []
+                    aliases = {}
+                    if keys is not None and any(key is not None for key in keys):
+                        first = {}
+                        for pos, key in enumerate(keys):
+                            if key is None:
+                                continue
+                            if key in first:
+                                check_request_hash(content_hashes[first[key]], content_hashes[pos])
+                                aliases[pos] = first[key]
+                            else:
+                                first[key] = pos
+                                saved.append(pos)
+                        rows = await conn.fetch(
+                            SAVE_IDEMPOTENCY_KEY_QUERY, [keys[pos] for pos in saved],
+                            [content_hashes[pos] for pos in saved], [ids[pos] for pos in saved], IDEMPOTENCY_TTL
+                        )
+                        stored = {row['key'] for row in rows}
+                        taken = [pos for pos in saved if keys[pos] not in stored]
+                        if taken:
+                            rows = await conn.fetch(
+                                "SELECT key, request_hash, pereval_id FROM pereval_idempotency "
+                                "WHERE key = ANY($1::text[])", [keys[pos] for pos in taken]
+                            )
+                            previous = {row['key']: row for row in rows}
+                            for pos in taken:
+                                check_request_hash(previous[keys[pos]]['request_hash'], content_hashes[pos])
+                                ids[pos] = previous[keys[pos]]['pereval_id']
+                                aliases[pos] = pos
+                            saved = [pos for pos in saved if keys[pos] in stored]
+
+                    # уже сохранённые и повторяющиеся в пачке данные не пишутся
+                    known = {}
+                    hashes = [content_hash for content_hash in content_hashes if content_hash is not None]
+                    if hashes:
+                        rows = await conn.fetch(
+                            "SELECT id, content_hash FROM pereval_added WHERE content_hash = ANY($1::bytea[])", hashes
+                        )
+                        known = {bytes(row['content_hash']): row['id'] for row in rows}
+
+                    new = []
+                    for pos, content_hash in enumerate(content_hashes):
+                        if pos in aliases:
+                            continue
+                        if content_hash is not None and content_hash in known:
+                            ids[pos] = known[content_hash]
+                            continue
+                        if content_hash is not None:
+                            known[content_hash] = ids[pos]
+                        new.append(pos)
+
+                    raw_data_list = []
+                    images_list = []
+                    for pos in new:
+                        images_list.append(await self.store_images(
+                            conn, image_sources_from_payload(payload_images(perevals[pos])), created
+                        ))
+                        raw_data_list.append(build_raw_data(perevals[pos]))
+
+                    query = """
+                    INSERT INTO pereval_added (id, raw_data, images, date_added, content_hash)
+                    SELECT id, raw_data, images, NOW(), content_hash
+                    FROM unnest($1::int[], $2::jsonb[], $3::jsonb[], $4::bytea[])
+                        AS t(id, raw_data, images, content_hash)
+                    ON CONFLICT (content_hash) WHERE content_hash IS NOT NULL DO NOTHING
+                    RETURNING id
+                    """
+                    new_ids = [ids[pos] for pos in new]
+                    inserted = {row['id'] for row in await conn.fetch(
+                        query, new_ids, raw_data_list, images_list, [content_hashes[pos] for pos in new]
+                    )}
+                    if len(inserted) < len(new_ids):
+                        # те же данные одновременно сохранил другой запрос
+                        lost = [content_hashes[pos] for pos in new if ids[pos] not in inserted]
+                        rows = await conn.fetch(
+                            "SELECT id, content_hash FROM pereval_added WHERE content_hash = ANY($1::bytea[])", lost
+                        )
+                        known.update({bytes(row['content_hash']): row['id'] for row in rows})
+                        for pos, content_hash in enumerate(content_hashes):
+                            if content_hash is not None and pos not in aliases:
+                                ids[pos] = known[content_hash]
+                    for pos, target in aliases.items():
+                        ids[pos] = ids[target]
+
+                    moved = [pos for pos in saved if ids[pos] != reserved[pos]]
+                    if moved:
+                        # ключи записей, которые не создались, ведут к сохранённым
+                        await conn.execute(
+                            "UPDATE pereval_idempotency k SET pereval_id = t.pereval_id "
+                            "FROM unnest($1::text[], $2::int[]) AS t(key, pereval_id) WHERE k.key = t.key",
+                            [keys[pos] for pos in moved], [ids[pos] for pos in moved]
+                        )
+
+                    if duplicates is not None:
+                        pairs = [(ids[pos], *candidate) for pos in new for candidate in duplicates[pos] or ()
+                                 if ids[pos] in inserted]
+                        if pairs:
+                            await conn.execute(SAVE_DUPLICATES_BATCH_QUERY, *map(list, zip(*pairs)))
+                    return ids
+                except BaseException:
+                    # до отката, пока строки image_blobs заблокированы
+                    await self.discard_images(created)
+                    raise
+
+    @db_method
+    async def get_pereval_by_id(self, pereval_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Получить запись перевала по ID
+        raw_data и images возвращаются текстом JSON как есть из БД
+        (см. app.serialization.passthrough_row)
+        """
+        async def run(conn):
+            result = await conn.fetchrow(f"SELECT {PEREVAL_TEXT_COLUMNS} FROM pereval_added WHERE id = $1",
+                                         pereval_id)
+            return dict(result) if result else None
+
+        try:
+            return await self._read(run, retry_missing=True, primary=self._changed_recently(pereval_id))
+        except PoolExhaustedError:
+            raise
+        except Exception as e:
+            print(f"Ошибка при получении перевала: {e}")
+            return None
+
+    @db_method
+    async def get_perevals_by_email(self, email: str, limit: Optional[int] = None,
+                                    after: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Получить перевалы по email пользователя в порядке id
+        Постраничная выборка по ключу: не больше limit записей с id > after;
+        raw_data и images - текст JSON, как в get_pereval_by_id
+        """
+        query = f"""
+        SELECT {PEREVAL_TEXT_COLUMNS} FROM pereval_added
+        WHERE email = $1 AND id > $2
+        ORDER BY id
+        LIMIT $3
+        """
+
+        async def run(conn):
+            return [dict(row) for row in await conn.fetch(query, email, after or 0, limit)]
+
+        try:
+            return await self._read(run)
+        except PoolExhaustedError:
+            raise
+        except Exception as e:
+            print(f"Ошибка при поиске по email: {e}")
+            return []
+
+    @db_method
+    async def iter_perevals_by_email(self, email: str, after: Optional[int] = None,
+                                     limit: Optional[int] = None,
+                                     prefetch: int = 100) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Перевалы пользователя через серверный курсор
+        В памяти одновременно не больше prefetch строк, сколько бы их ни было
+        """
+        async with self.read_connection() as conn:
+            async with conn.transaction():
+                query = f"""
+                SELECT {PEREVAL_TEXT_COLUMNS} FROM pereval_added
+                WHERE email = $1 AND id > $2
+                ORDER BY id
+                LIMIT $3
+                """
+                async for row in conn.cursor(query, email, after or 0, limit, prefetch=prefetch):
+                    yield dict(row)
+
+    @db_method
+    async def get_changes(self, email: Optional[str], floor: int, after: Optional[Tuple[int, int]],
+                          limit: int) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        Лента изменений (app.changes): записи и удалённые записи с change_xid >= floor
+        после курсора after в порядке (change_xid, id), не больше limit
+        Возвращает xmin снимка, полученный до чтения строк, и строки
+        (raw_data и images - текст JSON, у удалённых - deleted = true)
+        """
+        after_xid, after_id = after if after is not None else (-1, 0)
+
+        async def run(conn):
+            xmin = await conn.fetchval(SNAPSHOT_XMIN_QUERY)
+            if email is None:
+                rows = await conn.fetch(ALL_CHANGES_QUERY, floor, after_xid, after_id, limit)
+            else:
+                rows = await conn.fetch(USER_CHANGES_QUERY, email, floor, after_xid, after_id, limit)
+            return xmin, [dict(row) for row in rows]
+
+        return await self._read(run)
+
+    @db_method
+    async def purge_deleted(self, ttl: float, batch_size: int = 10000) -> int:
+        """Забыть удалённые записи старше ttl секунд (лента изменений их больше не отдаёт)"""
+        deleted = 0
+        async with self.connection() as conn:
+            while True:
+                status = await conn.execute("""
+                DELETE FROM pereval_deleted WHERE (id, email) IN (
+                    SELECT id, email FROM pereval_deleted
+                    WHERE deleted_at <= now() - make_interval(secs => $1)
+                    LIMIT $2
+                )
+                """, ttl, batch_size)
+                count = int(status.split()[-1])
+                deleted += count
+                if count < batch_size:
+                    return deleted
+
+    @db_method
+    async def iter_export(self, status: Optional[str] = None, date_from=None, date_to=None,
+                          after_id: Optional[int] = None,
+                          batch_size: int = 1000) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Все записи перевалов порциями по batch_size строк в порядке id (app.export)
+        Серверный курсор: в памяти не больше одной порции; фильтры - статус,
+        date_added в [date_from, date_to) и id > after_id
+        """
+        async with self.read_connection() as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                # данные пользователя (email, имя, телефон) в массовую выгрузку не попадают
+                query = """
+                SELECT id, date_added, version, (raw_data - 'user')::text AS raw_data, images::text AS images,
+                       status, latitude, longitude
+                FROM pereval_added
+                WHERE id > $1
+                  AND ($2::text IS NULL OR status = $2)
+                  AND ($3::timestamp IS NULL OR date_added >= $3)
+                  AND ($4::timestamp IS NULL OR date_added < $4)
+                ORDER BY id
+                """
+                batch = []
+                async for row in conn.cursor(query, after_id or 0, status, date_from, date_to,
+                                             prefetch=batch_size):
+                    batch.append(dict(row))
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+
+    @db_method
+    async def update_pereval(self, pereval_id: int, patch,
+                             versions: Optional[List[int]] = None) -> Tuple[Optional[int], Optional[str]]:
+        """
+        Частично обновить запись перевала (PerevalPatch), если статус 'new'
+
+        Патч применяется к raw_data в БД (pereval_merge_patch) одним условным
+        UPDATE, без предварительного чтения; тот же запрос возвращает статус
+        и версию записи, чтобы при отказе не делать второй запрос.
+        content_hash сбрасывается: данные больше не те, что были отправлены,
+        и повтор исходной отправки сохраняется новой записью.
+        versions - допустимые текущие версии (If-Match), None - любая;
+        при несовпадении бросает VersionConflictError.
+        Возвращает (новая версия, None) или (None, сообщение об ошибке).
+        """
+        query = """
+        WITH updated AS (
+            UPDATE pereval_added
+            SET raw_data = pereval_merge_patch(raw_data, $2::jsonb),
+                images = COALESCE($3::jsonb, images),
+                content_hash = NULL
+            WHERE id = $1 AND status = 'new'
+              AND ($4::integer[] IS NULL OR version = ANY($4::integer[]))
+            RETURNING version
+        )
+        SELECT (SELECT version FROM updated) AS updated, status, version
+        FROM pereval_added WHERE id = $1
+        """
+        try:
+            raw_patch = build_raw_patch(patch)
+            async with self.connection() as conn:
+                if patch.images is None:
+                    row = await conn.fetchrow(query, pereval_id, raw_patch, None, versions)
+                else:
+                    # новые изображения сохраняются в той же транзакции и откатываются при отказе
+                    created: List[str] = []
+                    transaction = conn.transaction()
+                    await transaction.start()
+                    try:
+                        images_json = await self.store_images(conn, image_sources_from_payload(patch.images),
+                                                              created)
+                        row = await conn.fetchrow(query, pereval_id, raw_patch, images_json, versions)
+                    except BaseException:
+                        await self.discard_images(created)
+                        await transaction.rollback()
+                        raise
+                    if row and row['updated'] is not None:
+                        await transaction.commit()
+                    else:
+                        await self.discard_images(created)
+                        await transaction.rollback()
+
+            if not row:
+                return None, "Запись не найдена"
+            if row['updated'] is not None:
+                return row['updated'], None
+            if row['status'] != 'new':
+                return None, "Запись нельзя редактировать (статус не 'new')"
+            raise VersionConflictError(row['version'])
+
+        except (PoolExhaustedError, VersionConflictError):
+            raise
+        except Exception as e:
+            print(f"Ошибка при обновлении перевала: {e}")
+            return None, str(e)
+
+    @db_method
+    async def get_legacy_image_hash(self, image_id: int) -> Optional[str]:
+        """sha256 изображения по id бывшей строки pereval_images (миграция 0009) или None"""
+        image_hash = await self._read(
+            lambda conn: conn.fetchval("SELECT hash FROM image_legacy_ids WHERE id = $1", image_id),
+            retry_missing=True
+        )
+        return bytes(image_hash).hex() if image_hash is not None else None
+
+    @db_method
+    async def collect_images(self, grace: float, batch_size: int = 1000) -> int:
+        """
+        Удалить изображения, на которые нет ссылок дольше grace секунд
+        Файлы удаляются, пока строки image_blobs заблокированы (см. COLLECT_IMAGES_QUERY)
+        """
+        deleted = 0
+        async with self.connection() as conn:
+            while True:
+                async with conn.transaction():
+                    rows = await conn.fetch(COLLECT_IMAGES_QUERY, grace, batch_size)
+                    for row in rows:
+                        await asyncio.to_thread(self.images.delete, bytes(row['hash']).hex())
+                deleted += len(rows)
+                if len(rows) < batch_size:
+                    return deleted
+
+    @db_method
+    async def get_all_coords(self) -> List[Tuple[int, float, float]]:
+        """Координаты всех перевалов (для построения индекса в памяти)"""
+        async with self.connection() as conn:
+            rows = await conn.fetch(
+                "SELECT id, latitude, longitude FROM pereval_added WHERE geo_cell IS NOT NULL"
+            )
+            return [(row['id'], row['latitude'], row['longitude']) for row in rows]
+
+    @db_method
+    async def get_index_fields(self, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Поля перевалов для индексов в памяти (координаты, названия) и хэш содержимого по id; удалённых нет"""
+        async with self.connection() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT id, latitude, longitude, title, raw_data->>'other_titles' AS other_titles, content_hash
+                FROM pereval_added WHERE id = ANY($1::int[])
+                """,
+                ids
+            )
+            return {row['id']: dict(row) for row in rows}
+
+    @db_method
+    async def get_all_titles(self) -> List[Tuple[int, Optional[str], Optional[str]]]:
+        """Названия всех перевалов (для дерева подсказок)"""
+        async with self.connection() as conn:
+            rows = await conn.fetch("SELECT id, title, raw_data->>'other_titles' AS other_titles FROM pereval_added")
+            return [(row['id'], row['title'], row['other_titles']) for row in rows]
+
+    @db_method
+    async def get_duplicate_fields(self) -> List[Tuple[int, float, float, Optional[str], Optional[str]]]:
+        """Координаты и названия всех перевалов с координатами (для индекса дубликатов)"""
+        async with self.connection() as conn:
+            rows = await conn.fetch(
+                "SELECT id, latitude, longitude, title, raw_data->>'other_titles' AS other_titles "
+                "FROM pereval_added WHERE geo_cell IS NOT NULL"
+            )
+            return [(row['id'], row['latitude'], row['longitude'], row['title'], row['other_titles'])
+                    for row in rows]
+
+    @db_method
+    async def get_duplicates(self, pereval_id: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Возможные дубликаты записи: найденные при её добавлении и записи,
+        добавленные позже с ней в качестве кандидата; None, если записи нет
+        """
+        async def run(conn):
+            if not await conn.fetchval("SELECT 1 FROM pereval_added WHERE id = $1", pereval_id):
+                return None
+            return {"duplicates": [dict(row) for row in await conn.fetch(DUPLICATES_QUERY, pereval_id)]}
+
+        result = await self._read(run, retry_missing=True, primary=self._changed_recently(pereval_id))
+        return None if result is None else result["duplicates"]
+
+    @db_method
+    async def search_perevals(self, query: str, limit: int) -> List[Dict[str, Any]]:
+        """
+        Нечёткий поиск по названиям (search_text, миграция 0006)
+        query должен быть нормализован (app.search.normalize). С pg_trgm -
+        по сходству слов через триграммный индекс, без него - по подстроке
+        """
+        if self._trgm is None:
+            async with self.connection() as conn:
+                self._trgm = bool(await conn.fetchval(
+                    "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+                ))
+        if self._trgm:
+            sql = """
+            SELECT id, raw_data->>'beautyTitle' AS "beautyTitle", title,
+                   raw_data->>'other_titles' AS other_titles,
+                   word_similarity($1, search_text) AS score
+            FROM pereval_added
+            WHERE $1 <% search_text
+            ORDER BY score DESC, id
+            LIMIT $2
+            """
+            params = (query,)
+        else:
+            sql = """
+            SELECT id, raw_data->>'beautyTitle' AS "beautyTitle", title,
+                   raw_data->>'other_titles' AS other_titles,
+                   1.0::real AS score
+            FROM pereval_added
+            WHERE search_text LIKE $1
+            ORDER BY id
+            LIMIT $2
+            """
+            params = ('%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%',)
+        rows = await self._read(lambda conn: conn.fetch(sql, *params, limit))
+        return [dict(row) for row in rows]
+
+    @db_method
+    async def get_perevals_in_bbox(self, min_lat: float, min_lon: float, max_lat: float,
+                                   max_lon: float, cells: Optional[List[int]],
+                                   limit: int) -> List[Dict[str, Any]]:
+        """
+        Перевалы в прямоугольнике координат
+        cells - ячейки сетки, покрывающие прямоугольник (отбор по индексу geo_cell);
+        None - отбор только по индексу (latitude, longitude)
+        """
+        query = """
+        SELECT id, title, latitude, longitude FROM pereval_added
+        WHERE ($1::int[] IS NULL OR geo_cell = ANY($1::int[]))
+          AND latitude BETWEEN $2 AND $3 AND longitude BETWEEN $4 AND $5
+        ORDER BY id
+        LIMIT $6
+        """
+        rows = await self._read(lambda conn: conn.fetch(query, cells, min_lat, max_lat, min_lon, max_lon, limit))
+        return [dict(row) for row in rows]
+
+    @db_method
+    async def get_pereval_summaries(self, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Краткие сведения (название, координаты) по списку id"""
+        rows = await self._read(lambda conn: conn.fetch(
+            "SELECT id, title, latitude, longitude FROM pereval_added WHERE id = ANY($1::int[])",
+            ids
+        ))
+        return {row['id']: dict(row) for row in rows}
+
+    @db_method
+    async def get_areas(self) -> List[Tuple[int, int, Optional[str]]]:
+        """Все строки справочника районов pereval_areas"""
+        async with self.connection() as conn:
+            rows = await conn.fetch("SELECT id, id_parent, title FROM pereval_areas")
+            return [(row['id'], row['id_parent'], row['title']) for row in rows]
+
+    @db_method
+    async def get_stats(self, dimensions: List[str]) -> Dict[str, Dict[str, int]]:
+        """Счётчики статистики (миграция 0010): {разрез: {ключ: число}}"""
+        rows = await self._read(lambda conn: conn.fetch(STATS_QUERY, dimensions))
+        result: Dict[str, Dict[str, int]] = {dimension: {} for dimension in dimensions}
+        for row in rows:
+            result[row['dimension']][row['key']] = row['count']
+        return result
+
+    @db_method
+    async def get_top_contributors(self, limit: int) -> List[Dict[str, Any]]:
+        """Авторы с наибольшим числом записей"""
+        rows = await self._read(lambda conn: conn.fetch(TOP_CONTRIBUTORS_QUERY, limit))
+        return [dict(row) for row in rows]
+
+    @db_method
+    async def reconcile_stats(self) -> Optional[int]:
+        """
+        Сверить счётчики статистики с данными; число исправленных счётчиков
+        или None, если сверку уже выполняет другой процесс
+        """
+        async with self.connection() as conn:
+            return await conn.fetchval(RECONCILE_QUERY)
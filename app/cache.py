@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class Cache:
+    """
+    Интерфейс кэша ответов
+
+    Методы асинхронные, чтобы его могла реализовать и общая для процессов
+    система (Redis, memcached); по умолчанию используется LRUTTLCache.
+    """
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: Hashable, value: Any):
+        raise NotImplementedError
+
+    async def delete(self, key: Hashable):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class LRUTTLCache(Cache):
+    """Кэш в памяти процесса: не больше max_entries записей, каждая живёт ttl секунд"""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def set(self, key: Hashable, value: Any):
+        if self.max_entries <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else None
+        }
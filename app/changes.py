@@ -0,0 +1,128 @@
+"""
+Лента изменений для синхронизации клиентов (GET /changes, миграция 0011)
+
+Клиент хранит токен из поля next последнего ответа и передаёт его в since:
+в ответ попадают записи, созданные или изменённые после выдачи токена,
+и id удалённых. Без since отдаются все записи (первая синхронизация).
+
+Записи отбираются по номеру изменившей их транзакции (change_xid), а не
+по времени или последовательности: номера выдаются раньше фиксации, и
+запись с меньшим номером может стать видна позже. Поэтому токен хранит
+нижнюю границу floor - самую старую незавершённую транзакцию (xmin снимка)
+на начало предыдущей синхронизации: всё, что меньше, уже было видно и
+отдано. Запись может прийти повторно (клиент применяет её как обновление),
+но не теряется. Длинная лента отдаётся страницами по (change_xid, id);
+пока more = true, next продолжает ту же синхронизацию.
+
+Удалённые записи хранятся FSTR_CHANGES_TTL секунд; токен старше
+этого срока не принимается (410), клиенту нужна полная синхронизация.
+"""
+import base64
+import hashlib
+import os
+import time
+from typing import Optional, Tuple
+
+CHANGES_TTL = int(os.getenv('FSTR_CHANGES_TTL', str(30 * 24 * 3600)))
+
+SNAPSHOT_XMIN_QUERY = "SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+
+_CHANGES_COLUMNS = "id, change_xid, false AS deleted, date_added, version, raw_data::text AS raw_data, images::text AS images"
+_DELETED_COLUMNS = "id, change_xid, true AS deleted, NULL::timestamp, NULL::integer, NULL::text, NULL::text"
+
+# $1 - email, $2 - floor, ($3, $4) - курсор (change_xid, id), $5 - limit
+USER_CHANGES_QUERY = f"""
+(SELECT {_CHANGES_COLUMNS} FROM pereval_added
+ WHERE email = $1 AND change_xid >= $2 AND (change_xid, id) > ($3, $4)
+ ORDER BY change_xid, id LIMIT $5)
+UNION ALL
+(SELECT {_DELETED_COLUMNS} FROM pereval_deleted
+ WHERE email = $1 AND change_xid >= $2 AND (change_xid, id) > ($3, $4)
+ ORDER BY change_xid, id LIMIT $5)
+ORDER BY change_xid, id
+LIMIT $5
+"""
+# Все записи; смена email удалением не считается
+ALL_CHANGES_QUERY = f"""
+(SELECT {_CHANGES_COLUMNS} FROM pereval_added
+ WHERE change_xid >= $1 AND (change_xid, id) > ($2, $3)
+ ORDER BY change_xid, id LIMIT $4)
+UNION ALL
+(SELECT {_DELETED_COLUMNS} FROM pereval_deleted d
+ WHERE change_xid >= $1 AND (change_xid, id) > ($2, $3)
+   AND NOT EXISTS (SELECT 1 FROM pereval_added a WHERE a.id = d.id)
+ ORDER BY change_xid, id LIMIT $4)
+ORDER BY change_xid, id
+LIMIT $4
+"""
+
+
+class ChangeTokenExpiredError(Exception):
+    """Токен старше FSTR_CHANGES_TTL: удалённые с тех пор записи могли быть забыты"""
+    pass
+
+
+def token_scope(email: Optional[str]) -> str:
+    """Чья лента: токен одного пользователя не подходит для ленты другого"""
+    if email is None:
+        return '*'
+    return hashlib.sha256(email.encode()).hexdigest()[:12]
+
+
+class ChangeToken:
+    """
+    Состояние синхронизации клиента
+
+    floor, floor_time - нижняя граница change_xid и время её получения;
+    next_floor, next_time - граница следующей синхронизации (xmin на её первой
+    странице) и cursor - последняя отданная (change_xid, id), пока страницы
+    текущей синхронизации не закончились
+    """
+
+    def __init__(self, scope: str, floor: int = 0, floor_time: Optional[float] = None,
+                 next_floor: Optional[int] = None, next_time: Optional[float] = None,
+                 cursor: Optional[Tuple[int, int]] = None):
+        self.scope = scope
+        self.floor = floor
+        self.floor_time = time.time() if floor_time is None else floor_time
+        self.next_floor = next_floor
+        self.next_time = next_time
+        self.cursor = cursor
+
+    def encode(self) -> str:
+        fields = [self.scope, self.floor, int(self.floor_time)]
+        if self.cursor is not None:
+            fields += [self.next_floor, int(self.next_time), *self.cursor]
+        return base64.urlsafe_b64encode('.'.join(map(str, fields)).encode()).decode().rstrip('=')
+
+    @classmethod
+    def decode(cls, token: str, email: Optional[str] = None) -> "ChangeToken":
+        """Токен из since; ValueError - испорчен или выдан для другой ленты"""
+        try:
+            fields = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode().split('.')
+            scope, numbers = fields[0], [int(field) for field in fields[1:]]
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Неверный токен since")
+        if len(numbers) not in (2, 6):
+            raise ValueError("Неверный токен since")
+        if scope != token_scope(email):
+            raise ValueError("Токен since выдан для ленты другого пользователя")
+        if time.time() - numbers[1] > CHANGES_TTL:
+            raise ChangeTokenExpiredError("Токен since устарел, нужна полная синхронизация")
+        if len(numbers) == 2:
+            return cls(scope, numbers[0], numbers[1])
+        floor, floor_time, next_floor, next_time, cursor_xid, cursor_id = numbers
+        return cls(scope, floor, floor_time, next_floor, next_time, (cursor_xid, cursor_id))
+
+    def advance(self, xmin: int, last: Optional[Tuple[int, int]]) -> "ChangeToken":
+        """
+        Токен для следующего запроса: xmin - граница снимка, прочитанного этим
+        запросом, last - (change_xid, id) последней строки, если есть ещё страницы
+        """
+        if self.cursor is None:
+            next_floor, next_time = xmin, time.time()
+        else:
+            next_floor, next_time = self.next_floor, self.next_time
+        if last is not None:
+            return ChangeToken(self.scope, self.floor, self.floor_time, next_floor, next_time, last)
+        return ChangeToken(self.scope, next_floor, next_time)
@@ -1,77 +1,336 @@
 import os
 import json
-from typing import Optional, Dict, Any
+import threading
+import time
+from typing import Optional, Dict, Any, List
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
+from pydantic import BaseModel
+from app.image_store import UPSERT_IMAGE_BLOB_QUERY, image_store_from_env, psycopg2_query
+from app.images import image_sources_from_payload, payload_images
+from app.metrics import db_method, record_error, record_query
 
 load_dotenv()
 
 
+# Столбцы записи перевала, которые отдаёт API (без служебных столбцов для запросов)
+PEREVAL_COLUMNS = "id, date_added, version, raw_data, images"
+# То же, но документы jsonb отдаются текстом, чтобы не разбирать их в Python
+PEREVAL_TEXT_COLUMNS = "id, date_added, version, raw_data::text AS raw_data, images::text AS images"
+
+
+def db_params_from_env() -> Dict[str, Any]:
+    """Параметры подключения к БД из переменных окружения FSTR_DB_*"""
+    return {
+        'host': os.getenv('FSTR_DB_HOST', 'localhost'),
+        'port': os.getenv('FSTR_DB_PORT', '5432'),
+        'database': os.getenv('FSTR_DB_NAME', 'pereval'),
+        'user': os.getenv('FSTR_DB_LOGIN'),
+        'password': os.getenv('FSTR_DB_PASS')
+    }
+
+
+def pool_params_from_env() -> Dict[str, Any]:
+    """Параметры пула соединений из переменных окружения FSTR_DB_POOL_*"""
+    return {
+        'minconn': int(os.getenv('FSTR_DB_POOL_MIN', '1')),
+        'maxconn': int(os.getenv('FSTR_DB_POOL_MAX', '10')),
+        'timeout': float(os.getenv('FSTR_DB_POOL_TIMEOUT', '5')),
+        'check_interval': float(os.getenv('FSTR_DB_POOL_CHECK_INTERVAL', '30'))
+    }
+
+
+def build_raw_data(pereval_data, user_data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Собирает документ raw_data из данных запроса (модели или словаря)
+    Если передан user_data, он подставляется вместо пользователя из запроса
+    """
+    if isinstance(pereval_data, BaseModel):
+        # одним проходом pydantic-core, с именами полей хранимого документа
+        raw_data = pereval_data.model_dump(by_alias=True, exclude={"images"})
+        raw_data["status"] = "new"
+        if user_data is not None:
+            raw_data["user"] = user_data
+        return raw_data
+
+    if user_data is None:
+        user_data = {
+            "email": pereval_data["user"]["email"],
+            "phone": pereval_data["user"]["phone"],
+            "fam": pereval_data["user"]["fam"],
+            "name": pereval_data["user"]["name"],
+            "otc": pereval_data["user"].get("otc", "")
+        }
+
+    return {
+        "beautyTitle": pereval_data.get("beauty_title", ""),
+        "title": pereval_data["title"],
+        "other_titles": pereval_data.get("other_titles", ""),
+        "connect": pereval_data.get("connect", ""),
+        "add_time": pereval_data["add_time"],
+        "user": user_data,
+        "coords": {
+            "latitude": pereval_data["coords"]["latitude"],
+            "longitude": pereval_data["coords"]["longitude"],
+            "height": pereval_data["coords"]["height"]
+        },
+        "level": {
+            "winter": pereval_data["level"].get("winter", ""),
+            "summer": pereval_data["level"].get("summer", ""),
+            "autumn": pereval_data["level"].get("autumn", ""),
+            "spring": pereval_data["level"].get("spring", "")
+        },
+        "status": "new"
+    }
+
+
+def build_raw_patch(patch: BaseModel) -> Dict[str, Any]:
+    """
+    Патч документа raw_data (JSON Merge Patch) из модели PerevalPatch
+    Только переданные поля; null у необязательных строк заменяется на "",
+    чтобы документ сохранял вид, который даёт build_raw_data
+    """
+    raw_patch = patch.model_dump(by_alias=True, exclude_unset=True, exclude={"images"})
+    for key in ("beautyTitle", "other_titles", "connect"):
+        if key in raw_patch and raw_patch[key] is None:
+            raw_patch[key] = ""
+    for key, value in (raw_patch.get("level") or {}).items():
+        if value is None:
+            raw_patch["level"][key] = ""
+    return raw_patch
+
+
+def build_images_json(titles, image_hashes) -> Dict[str, Any]:
+    """Собирает документ images: названия и sha256 изображений в хранилище (app.image_store)"""
+    images_list = []
+    for title, image_hash in zip(titles, image_hashes):
+        images_list.append({
+            "sha256": image_hash,
+            "title": title
+        })
+    return {"images": images_list}
+
+
+class PoolExhaustedError(Exception):
+    """Пул соединений исчерпан: свободное соединение не появилось за отведённое время"""
+
+
+class VersionConflictError(Exception):
+    """Версия записи не совпала с ожидаемой (If-Match): запись изменили"""
+
+    def __init__(self, version: int):
+        super().__init__(f"Запись изменена, текущая версия {version}")
+        self.version = version
+
+
+class TimedCursor(RealDictCursor):
+    """Курсор с замером времени выполнения запросов и получения строк (app.metrics)"""
+
+    def _timed(self, phase: str, call, query=None, params=None):
+        started = time.perf_counter()
+        try:
+            return call()
+        except Exception as e:
+            record_error(e)
+            raise
+        finally:
+            record_query(phase, time.perf_counter() - started, query, params)
+
+    def execute(self, query, vars=None):
+        return self._timed('execute', lambda: super(TimedCursor, self).execute(query, vars), query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed('execute', lambda: super(TimedCursor, self).executemany(query, vars_list), query)
+
+    def fetchone(self):
+        return self._timed('fetch', super().fetchone, self.query)
+
+    def fetchmany(self, size=None):
+        return self._timed('fetch', lambda: super(TimedCursor, self).fetchmany(size), self.query)
+
+    def fetchall(self):
+        return self._timed('fetch', super().fetchall, self.query)
+
+
+class ConnectionPool:
+    """
+    Пул соединений с ограниченным ожиданием и проверкой соединения при выдаче
+
+    Соединение, простоявшее без дела дольше check_interval секунд,
+    перед выдачей проверяется запросом SELECT 1; мёртвые соединения
+    закрываются и заменяются новыми.
+    """
+
+    def __init__(self, db_params: Dict[str, Any], minconn: int, maxconn: int,
+                 timeout: float, check_interval: float):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **db_params,
+                                            cursor_factory=TimedCursor)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used: Dict[int, float] = {}
+
+    def getconn(self):
+        """Взять соединение из пула, ожидая не дольше timeout секунд"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhaustedError(
+                f"Нет свободных соединений с БД (занято {self.maxconn}, "
+                f"ожидание {self.timeout} с)"
+            )
+        try:
+            conn = self._pool.getconn()
+            if not self._is_alive(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Вернуть соединение в пул"""
+        try:
+            if conn.closed:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def _is_alive(self, conn) -> bool:
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def closeall(self):
+        self._last_used.clear()
+        self._pool.closeall()
+
+
 class DatabaseManager:
     def __init__(self):
-        self.db_params = {
-            'host': os.getenv('FSTR_DB_HOST', 'localhost'),
-            'port': os.getenv('FSTR_DB_PORT', '5432'),
-            'database': os.getenv('FSTR_DB_NAME', 'pereval'),
-            'user': os.getenv('FSTR_DB_LOGIN'),
-            'password': os.getenv('FSTR_DB_PASS')
-        }
+        self.db_params = db_params_from_env()
+        self.pool_params = pool_params_from_env()
+        self._pool: Optional[ConnectionPool] = None
+        self._pool_lock = threading.Lock()
+        self.images = image_store_from_env()
 
     def connect(self):
         """Устанавливаем соединение с БД"""
         try:
-            conn = psycopg2.connect(**self.db_params, cursor_factory=RealDictCursor)
+            conn = psycopg2.connect(**self.db_params, cursor_factory=TimedCursor)
             return conn
         except Exception as e:
             print(f"Ошибка подключения к БД: {e}")
             raise
 
-    def add_pereval(self, pereval_data: Dict[str, Any]) -> Optional[int]:
+    @property
+    def pooled(self) -> bool:
+        """Пул включён, если FSTR_DB_POOL_MAX больше нуля"""
+        return self.pool_params['maxconn'] > 0
+
+    def get_connection(self):
+        """Взять соединение из пула (или открыть новое, если пул выключен)"""
+        started = time.perf_counter()
+        try:
+            return self._get_connection()
+        finally:
+            record_query('connect', time.perf_counter() - started)
+
+    def _get_connection(self):
+        if not self.pooled:
+            return self.connect()
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    try:
+                        self._pool = ConnectionPool(self.db_params, **self.pool_params)
+                    except Exception as e:
+                        print(f"Ошибка подключения к БД: {e}")
+                        raise
+        return self._pool.getconn()
+
+    def release_connection(self, conn):
+        """Вернуть соединение в пул (или закрыть, если пул выключен)"""
+        if self._pool is None:
+            conn.close()
+        else:
+            self._pool.putconn(conn)
+
+    def close(self):
+        """Закрыть все соединения пула"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def store_image(self, cursor, chunks, created: Optional[List[str]] = None) -> str:
+        """
+        Сохраняет изображение в хранилище по частям и возвращает его sha256
+        Строка image_blobs записывается в транзакции cursor (см. app.image_store);
+        в created добавляются хэши новых файлов, их удаляет discard_images при откате
+        """
+        staged = self.images.stage()
+        try:
+            for chunk in chunks:
+                staged.write(chunk)
+            cursor.execute(psycopg2_query(UPSERT_IMAGE_BLOB_QUERY), (psycopg2.Binary(staged.digest), staged.size))
+            inserted = cursor.fetchone()['inserted']
+            if self.images.commit(staged) and inserted and created is not None:
+                created.append(staged.hexdigest)
+        except BaseException:
+            self.images.discard(staged)
+            raise
+        return staged.hexdigest
+
+    def store_images(self, cursor, image_sources, created: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Сохраняет изображения и возвращает документ images со ссылками на них"""
+        titles = []
+        image_hashes = []
+        for title, chunks in image_sources:
+            titles.append(title)
+            image_hashes.append(self.store_image(cursor, chunks, created))
+        return build_images_json(titles, image_hashes)
+
+    def discard_images(self, created: List[str]):
+        """Удалить файлы изображений, созданные транзакцией, перед её откатом"""
+        for hash_hex in created:
+            try:
+                self.images.delete(hash_hex)
+            except Exception as e:
+                print(f"Ошибка при удалении изображения {hash_hex}: {e}")
+        created.clear()
+
+    @db_method
+    def add_pereval(self, pereval_data: Dict[str, Any], image_sources=None) -> Optional[int]:
         """
-        Добавляет перевал в базу данных
+        Добавляет перевал в базу данных вместе с изображениями
         Возвращает id добавленной записи или None при ошибке
         """
         conn = None
+        created: List[str] = []
         try:
-            raw_data = {
-                "beautyTitle": pereval_data.get("beauty_title", ""),
-                "title": pereval_data["title"],
-                "other_titles": pereval_data.get("other_titles", ""),
-                "connect": pereval_data.get("connect", ""),
-                "add_time": pereval_data["add_time"],
-                "user": {
-                    "email": pereval_data["user"]["email"],
-                    "phone": pereval_data["user"]["phone"],
-                    "fam": pereval_data["user"]["fam"],
-                    "name": pereval_data["user"]["name"],
-                    "otc": pereval_data["user"].get("otc", "")
-                },
-                "coords": {
-                    "latitude": pereval_data["coords"]["latitude"],
-                    "longitude": pereval_data["coords"]["longitude"],
-                    "height": pereval_data["coords"]["height"]
-                },
-                "level": {
-                    "winter": pereval_data["level"].get("winter", ""),
-                    "summer": pereval_data["level"].get("summer", ""),
-                    "autumn": pereval_data["level"].get("autumn", ""),
-                    "spring": pereval_data["level"].get("spring", "")
-                },
-                "status": "new"
-            }
-
-            images_list = []
-            for img in pereval_data.get("images", []):
-                images_list.append({
-                    "id": len(images_list) + 1,
-                    "title": img["title"]
-                })
-
-            images_json = {"images": images_list}
-
-            conn = self.connect()
+            raw_data = build_raw_data(pereval_data)
+            if image_sources is None:
+                image_sources = image_sources_from_payload(payload_images(pereval_data))
+
+            conn = self.get_connection()
             with conn.cursor() as cursor:
+                images_json = self.store_images(cursor, image_sources, created)
+
                 query = """
                 INSERT INTO pereval_added (raw_data, images, date_added)
                 VALUES (%s::jsonb, %s::jsonb, NOW())
@@ -84,61 +343,125 @@ class DatabaseManager:
                 conn.commit()
                 return pereval_id
 
+        except PoolExhaustedError:
+            raise
         except Exception as e:
             if conn:
+                self.discard_images(created)
                 conn.rollback()
             print(f"Ошибка при добавлении перевала: {e}")
             return None
 
         finally:
             if conn:
-                conn.close()
+                self.release_connection(conn)
+
+    @db_method
+    def add_perevals(self, perevals) -> list:
+        """
+        Добавляет несколько перевалов одной транзакцией многострочным INSERT
+        Возвращает id в порядке входного списка; при ошибке откатывается вся пачка
+        """
+        if not perevals:
+            return []
+
+        conn = None
+        created: List[str] = []
+        try:
+            conn = self.get_connection()
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval('pereval_id_seq') AS id FROM generate_series(1, %s)",
+                    (len(perevals),)
+                )
+                ids = [row['id'] for row in cursor.fetchall()]
+
+                rows = []
+                for pereval_id, pereval_data in zip(ids, perevals):
+                    images_json = self.store_images(
+                        cursor, image_sources_from_payload(payload_images(pereval_data)), created
+                    )
+                    rows.append((pereval_id, json.dumps(build_raw_data(pereval_data)),
+                                 json.dumps(images_json)))
+
+                execute_values(
+                    cursor,
+                    "INSERT INTO pereval_added (id, raw_data, images, date_added) VALUES %s",
+                    rows,
+                    template="(%s, %s::jsonb, %s::jsonb, NOW())",
+                    page_size=1000
+                )
+                conn.commit()
+                return ids
+
+        except Exception:
+            if conn:
+                self.discard_images(created)
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                self.release_connection(conn)
 
+    @db_method
     def get_pereval_by_id(self, pereval_id: int):
         """Получить запись перевала по ID"""
         conn = None
         try:
-            conn = self.connect()
+            conn = self.get_connection()
             with conn.cursor() as cursor:
-                query = "SELECT * FROM pereval_added WHERE id = %s"
+                query = f"SELECT {PEREVAL_COLUMNS} FROM pereval_added WHERE id = %s"
                 cursor.execute(query, (pereval_id,))
                 result = cursor.fetchone()
                 return dict(result) if result else None
+        except PoolExhaustedError:
+            raise
         except Exception as e:
             print(f"Ошибка при получении перевала: {e}")
             return None
         finally:
             if conn:
-                conn.close()
+                self.release_connection(conn)
 
-    def get_perevals_by_email(self, email: str):
-        """Получить все перевалы по email пользователя"""
+    @db_method
+    def get_perevals_by_email(self, email: str, limit: Optional[int] = None,
+                              after: Optional[int] = None):
+        """
+        Получить перевалы по email пользователя в порядке id
+        Постраничная выборка по ключу: не больше limit записей с id > after
+        """
         conn = None
         try:
-            conn = self.connect()
+            conn = self.get_connection()
             with conn.cursor() as cursor:
-                query = """
-                SELECT * FROM pereval_added 
-                WHERE raw_data->'user'->>'email' = %s
+                query = f"""
+                SELECT {PEREVAL_COLUMNS} FROM pereval_added 
+                WHERE email = %s AND id > %s
+                ORDER BY id
+                LIMIT %s
                 """
-                cursor.execute(query, (email,))
+                cursor.execute(query, (email, after or 0, limit))
                 results = cursor.fetchall()
                 return [dict(row) for row in results]
+        except PoolExhaustedError:
+            raise
         except Exception as e:
             print(f"Ошибка при поиске по email: {e}")
             return []
         finally:
             if conn:
-                conn.close()
+                self.release_connection(conn)
 
+    @db_method
     def update_pereval(self, pereval_id: int, update_data: dict):
         """Обновить запись перевала, если статус 'new'"""
         conn = None
+        created: List[str] = []
         try:
-            conn = self.connect()
+            conn = self.get_connection()
             with conn.cursor() as cursor:
                 check_query = """
-                SELECT raw_data->>'status' as status, raw_data->'user' as user_data 
+                SELECT status, raw_data->'user' as user_data 
                 FROM pereval_added WHERE id = %s
                 """
                 cursor.execute(check_query, (pereval_id,))
@@ -152,39 +475,15 @@ class DatabaseManager:
 
                 old_user_data = current['user_data']
 
-                new_raw_data = {
-                    "beautyTitle": update_data.get("beauty_title", ""),
-                    "title": update_data["title"],
-                    "other_titles": update_data.get("other_titles", ""),
-                    "connect": update_data.get("connect", ""),
-                    "add_time": update_data["add_time"],
-                    "user": old_user_data,
-                    "coords": {
-                        "latitude": update_data["coords"]["latitude"],
-                        "longitude": update_data["coords"]["longitude"],
-                        "height": update_data["coords"]["height"]
-                    },
-                    "level": {
-                        "winter": update_data["level"].get("winter", ""),
-                        "summer": update_data["level"].get("summer", ""),
-                        "autumn": update_data["level"].get("autumn", ""),
-                        "spring": update_data["level"].get("spring", "")
-                    },
-                    "status": "new"
-                }
-
-                images_list = []
-                for idx, img in enumerate(update_data.get("images", []), 1):
-                    images_list.append({
-                        "id": idx,
-                        "title": img["title"]
-                    })
-                images_json = {"images": images_list}
+                new_raw_data = build_raw_data(update_data, user_data=old_user_data)
+                images_json = self.store_images(
+                    cursor, image_sources_from_payload(payload_images(update_data)), created
+                )
 
                 update_query = """
                 UPDATE pereval_added 
-                SET raw_data = %s::jsonb, images = %s::jsonb 
-                WHERE id = %s AND raw_data->>'status' = 'new'
+                SET raw_data = %s::jsonb, images = %s::jsonb, content_hash = NULL 
+                WHERE id = %s AND status = 'new'
                 RETURNING id
                 """
 
@@ -197,13 +496,18 @@ class DatabaseManager:
                     conn.commit()
                     return True, None
                 else:
+                    self.discard_images(created)
+                    conn.rollback()
                     return False, "Не удалось обновить запись"
 
+        except PoolExhaustedError:
+            raise
         except Exception as e:
             if conn:
+                self.discard_images(created)
                 conn.rollback()
             print(f"Ошибка при обновлении перевала: {e}")
             return False, str(e)
         finally:
             if conn:
-                conn.close()
\ No newline at end of file
+                self.release_connection(conn)
\ No newline at end of file
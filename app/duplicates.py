@@ -0,0 +1,198 @@
+"""
+Поиск возможных дубликатов перевала при добавлении (миграция 0012)
+
+Один перевал часто присылают разные пользователи под немного разными
+названиями («пер. Анзоб» и «Анзоб», название в title у одного и в
+other_titles у другого) и с координатами в нескольких сотнях метров.
+Кандидаты - записи не дальше FSTR_DUPLICATE_RADIUS метров, у которых
+сходство названий не ниже FSTR_DUPLICATE_SIMILARITY.
+
+Индекс в памяти процесса: ячейки сетки размером с радиус (по широте),
+в ячейке - id записей; у записи хранятся координаты и названия без
+общих слов («пер.», «перевал», ...) одной строкой UTF-8 - в str кириллица
+занимает вдвое больше. Проверка смотрит соседние ячейки
+и сравнивает названия только у записей в радиусе, поэтому её время не
+зависит от числа записей. Сходство названий - доля общих триграмм,
+как у pg_trgm; из пар названий двух записей берётся наибольшее.
+Найденные кандидаты сохраняются вместе с новой записью (pereval_duplicates),
+см. GET /submitData/{id}/duplicates.
+"""
+import math
+import os
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+from app.geo import EARTH_RADIUS_KM, geo_cell
+from app.search import normalize, pass_names
+
+DUPLICATE_RADIUS = float(os.getenv('FSTR_DUPLICATE_RADIUS', '1000'))
+DUPLICATE_SIMILARITY = float(os.getenv('FSTR_DUPLICATE_SIMILARITY', '0.5'))
+DUPLICATE_LIMIT = int(os.getenv('FSTR_DUPLICATE_LIMIT', '5'))
+
+# Слова, которые не отличают один перевал от другого
+GENERIC_WORDS = frozenset(('пер', 'перевал', 'перев', 'п', 'седл', 'седло', 'седловина', 'pass', 'col'))
+_WORDS = re.compile(r'\w+')
+METERS_PER_DEGREE = EARTH_RADIUS_KM * 1000 * math.pi / 180
+
+DUPLICATES_QUERY = """
+SELECT a.id, a.raw_data->>'beautyTitle' AS "beautyTitle", a.title,
+       a.raw_data->>'other_titles' AS other_titles, a.status,
+       a.latitude, a.longitude, a.date_added, d.similarity, d.distance_m
+FROM (
+    SELECT duplicate_id AS id, similarity, distance_m FROM pereval_duplicates WHERE pereval_id = $1
+    UNION ALL
+    SELECT pereval_id, similarity, distance_m FROM pereval_duplicates WHERE duplicate_id = $1
+) AS d
+JOIN pereval_added a ON a.id = d.id
+ORDER BY d.similarity DESC, d.distance_m, a.id
+"""
+# $1 - id новой записи, $2, $3, $4 - id кандидатов, сходство, расстояние
+SAVE_DUPLICATES_QUERY = """
+INSERT INTO pereval_duplicates (pereval_id, duplicate_id, similarity, distance_m)
+SELECT $1, d.id, d.similarity, d.distance_m
+FROM unnest($2::int[], $3::float8[], $4::float8[]) AS d(id, similarity, distance_m)
+WHERE d.id <> $1
+ON CONFLICT DO NOTHING
+"""
+# Кандидаты пачки: те же поля, по строке на пару
+SAVE_DUPLICATES_BATCH_QUERY = """
+INSERT INTO pereval_duplicates (pereval_id, duplicate_id, similarity, distance_m)
+SELECT d.pereval_id, d.id, d.similarity, d.distance_m
+FROM unnest($1::int[], $2::int[], $3::float8[], $4::float8[]) AS d(pereval_id, id, similarity, distance_m)
+WHERE d.id <> d.pereval_id
+ON CONFLICT DO NOTHING
+"""
+
+# (id записи, сходство названий, расстояние в метрах)
+Candidate = Tuple[int, float, float]
+
+
+def name_keys(title: Optional[str], other_titles: Optional[str]) -> List[str]:
+    """Названия перевала для сравнения: нормализованные, без общих слов и знаков"""
+    keys = []
+    for name in pass_names(title, other_titles):
+        key = ' '.join(word for word in _WORDS.findall(normalize(name)) if word not in GENERIC_WORDS)
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def trigrams(key: str) -> FrozenSet[str]:
+    """Триграммы слов названия, как у pg_trgm: слово дополняется пробелами"""
+    result = set()
+    for word in key.split():
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(result)
+
+
+def similarity(first: Tuple[FrozenSet[str], ...], second: Tuple[FrozenSet[str], ...]) -> float:
+    """Наибольшее сходство (доля общих триграмм) среди пар названий"""
+    best = 0.0
+    for a in first:
+        for b in second:
+            if a and b:
+                best = max(best, len(a & b) / len(a | b))
+    return best
+
+
+def distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Расстояние по дуге большого круга, метры"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlam = math.radians(lon2 - lon1)
+    h = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlam / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * 1000 * math.asin(min(math.sqrt(h), 1.0))
+
+
+class DuplicateIndex:
+    """Записи с координатами по ячейкам сетки для поиска возможных дубликатов"""
+
+    def __init__(self, radius: float = DUPLICATE_RADIUS, threshold: float = DUPLICATE_SIMILARITY,
+                 limit: int = DUPLICATE_LIMIT):
+        self.radius = radius
+        self.threshold = threshold
+        self.limit = limit
+        # шаг сетки в градусах: соседние ячейки покрывают радиус по широте
+        self.step = max(radius, 1.0) / METERS_PER_DEGREE
+        # ячейка -> id записи или список id, если их несколько (чаще запись в ячейке одна)
+        self.cells: Dict[int, Union[int, List[int]]] = {}
+        # id -> (широта, долгота, названия без общих слов через \n в UTF-8)
+        self.records: Dict[int, Tuple[float, float, bytes]] = {}
+        self.ready = False
+
+    def __len__(self):
+        return len(self.records)
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.step), math.floor(lon / self.step)
+
+    @staticmethod
+    def _cell_key(row: int, col: int) -> int:
+        return (row << 32) + col
+
+    def load(self, rows: Iterable[Tuple[int, Optional[float], Optional[float], Optional[str], Optional[str]]]):
+        """Построить индекс по строкам (id, широта, долгота, title, other_titles)"""
+        for pereval_id, lat, lon, title, other_titles in rows:
+            self.upsert(pereval_id, lat, lon, title, other_titles)
+        self.ready = True
+
+    def upsert(self, pereval_id: int, lat: Optional[float], lon: Optional[float],
+               title: Optional[str], other_titles: Optional[str]):
+        """Добавить или изменить запись; без координат или названий запись удаляется"""
+        self.remove(pereval_id)
+        keys = name_keys(title, other_titles)
+        if geo_cell(lat, lon) is None or not keys:
+            return
+        self.records[pereval_id] = (lat, lon, '\n'.join(keys).encode())
+        cell = self._cell_key(*self._cell(lat, lon))
+        ids = self.cells.get(cell)
+        if ids is None:
+            self.cells[cell] = pereval_id
+        elif isinstance(ids, list):
+            ids.append(pereval_id)
+        else:
+            self.cells[cell] = [ids, pereval_id]
+
+    def remove(self, pereval_id: int):
+        record = self.records.pop(pereval_id, None)
+        if record is None:
+            return
+        cell = self._cell_key(*self._cell(record[0], record[1]))
+        ids = self.cells[cell]
+        if not isinstance(ids, list):
+            del self.cells[cell]
+            return
+        ids.remove(pereval_id)
+        if len(ids) == 1:
+            self.cells[cell] = ids[0]
+
+    def find(self, lat: Optional[float], lon: Optional[float], title: Optional[str],
+             other_titles: Optional[str]) -> List[Candidate]:
+        """Возможные дубликаты: не больше limit, по убыванию сходства, затем по расстоянию"""
+        keys = name_keys(title, other_titles)
+        if geo_cell(lat, lon) is None or not keys:
+            return []
+        row, col = self._cell(lat, lon)
+        # градус долготы короче градуса широты: по долготе смотрим больше ячеек
+        cos_lat = math.cos(math.radians(min(abs(lat) + self.step, 89.0)))
+        cols = math.ceil(1 / max(cos_lat, 0.01))
+        grams = None
+        found = []
+        for cell_row in range(row - 1, row + 2):
+            for cell_col in range(col - cols, col + cols + 1):
+                ids = self.cells.get(self._cell_key(cell_row, cell_col))
+                if ids is None:
+                    continue
+                for pereval_id in ids if isinstance(ids, list) else (ids,):
+                    plat, plon, other_keys = self.records[pereval_id]
+                    distance = distance_m(lat, lon, plat, plon)
+                    if distance > self.radius:
+                        continue
+                    if grams is None:
+                        grams = tuple(trigrams(key) for key in keys)
+                    score = similarity(grams, tuple(trigrams(key) for key in other_keys.decode().split('\n')))
+                    if score >= self.threshold:
+                        found.append((pereval_id, round(score, 3), round(distance, 1)))
+        found.sort(key=lambda item: (-item[1], item[2], item[0]))
+        return found[:self.limit]
@@ -0,0 +1,306 @@
+"""
+Выгрузка всех записей перевалов потоком: NDJSON, GeoJSON, Parquet
+
+    python -m app.export --format geojson --output perevals.geojson
+    python -m app.export --format parquet --output perevals.parquet --status accepted
+    python -m app.export --format ndjson --after-id 120000 > new_perevals.ndjson
+
+Записи читаются серверным курсором порциями по batch_size строк и сразу
+кодируются, поэтому в памяти одна порция (для Parquet - одна группа строк),
+сколько бы записей ни было. Порядок - по id: для инкрементальной выгрузки
+достаточно передать в after_id последний выгруженный id (CLI печатает его
+в конце) или взять записи с date_added не раньше date_from.
+Parquet требует pyarrow, он импортируется лениво. Данные пользователя
+(email, имя, телефон) не выгружаются ни в каком формате: в NDJSON raw_data
+отдаётся без поля user.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import orjson
+
+from app.geo import parse_coord
+from app.serialization import dumps, passthrough_row
+
+EXPORT_BATCH_SIZE = 1000
+
+# формат -> (Content-Type, расширение файла)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "geojson": ("application/geo+json", "geojson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# Поля записи в NDJSON - как в GET /submitData/{id}, raw_data без user
+RECORD_FIELDS = ("id", "date_added", "version", "raw_data", "images")
+
+LEVEL_SEASONS = ("winter", "summer", "autumn", "spring")
+
+# Строк в группе строк Parquet и столбцы, для которых пишется статистика min/max
+PARQUET_ROW_GROUP_ROWS = 50000
+PARQUET_STATISTICS = ["id", "date_added", "version", "status", "latitude", "longitude", "height"]
+
+
+def flat_record(row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Плоская запись для GeoJSON и Parquet: поля raw_data верхнего уровня,
+    высота числом, категории по сезонам и изображения (sha256 и название)
+    """
+    raw_data = orjson.loads(row["raw_data"])
+    coords = raw_data.get("coords") or {}
+    level = raw_data.get("level") or {}
+    images = orjson.loads(row["images"]) if row["images"] else {}
+    record = {
+        "id": row["id"],
+        "date_added": row["date_added"],
+        "version": row["version"],
+        "status": row["status"],
+        "beauty_title": raw_data.get("beautyTitle"),
+        "title": raw_data.get("title"),
+        "other_titles": raw_data.get("other_titles"),
+        "connect": raw_data.get("connect"),
+        "add_time": raw_data.get("add_time"),
+        "height": parse_coord(coords.get("height")),
+    }
+    for season in LEVEL_SEASONS:
+        record[f"level_{season}"] = level.get(season)
+    record["images"] = [
+        {"sha256": image.get("sha256"), "title": image.get("title")}
+        for image in (images.get("images") or []) if isinstance(image, dict)
+    ]
+    return record
+
+
+async def ndjson_chunks(batches: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """Запись на строку, raw_data и images передаются текстом из БД без разбора"""
+    async for batch in batches:
+        yield b"".join(
+            dumps(passthrough_row({field: row[field] for field in RECORD_FIELDS})) + b"\n" for row in batch
+        )
+
+
+def _geojson_feature(row: Dict[str, Any]) -> Dict[str, Any]:
+    latitude, longitude = row["latitude"], row["longitude"]
+    geometry = None
+    if latitude is not None and longitude is not None and -90 <= latitude <= 90 and -180 <= longitude <= 180:
+        geometry = {"type": "Point", "coordinates": [longitude, latitude]}
+    return {"type": "Feature", "id": row["id"], "geometry": geometry, "properties": flat_record(row)}
+
+
+async def geojson_chunks(batches: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """
+    FeatureCollection с точками [долгота, широта] числами
+    Данные пользователя в GeoJSON (слой для карт) не попадают;
+    записи без корректных координат выгружаются с geometry: null
+    """
+    yield b'{"type":"FeatureCollection","features":[\n'
+    first = True
+    async for batch in batches:
+        features = b",\n".join(dumps(_geojson_feature(row)) for row in batch)
+        if features:
+            yield features if first else b",\n" + features
+            first = False
+    yield b"\n]}\n"
+
+
+class _ChunkSink:
+    """Файлоподобный приёмник для ParquetWriter: записанные байты забираются после каждой группы строк"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema():
+    import pyarrow as pa
+
+    fields = [
+        ("id", pa.int64()),
+        ("date_added", pa.timestamp("us")),
+        ("version", pa.int32()),
+        ("status", pa.string()),
+        ("beauty_title", pa.string()),
+        ("title", pa.string()),
+        ("other_titles", pa.string()),
+        ("connect", pa.string()),
+        ("add_time", pa.string()),
+        ("latitude", pa.float64()),
+        ("longitude", pa.float64()),
+        ("height", pa.float64()),
+    ]
+    fields += [(f"level_{season}", pa.string()) for season in LEVEL_SEASONS]
+    fields.append(("images", pa.list_(pa.struct([("sha256", pa.string()), ("title", pa.string())]))))
+    return pa.schema(fields)
+
+
+def _parquet_table(batch: List[Dict[str, Any]], schema):
+    import pyarrow as pa
+
+    columns: Dict[str, list] = {name: [] for name in schema.names}
+    for row in batch:
+        record = flat_record(row)
+        record["latitude"] = row["latitude"]
+        record["longitude"] = row["longitude"]
+        for name, values in columns.items():
+            value = record[name]
+            values.append(value if value is None or isinstance(value, (int, float, list, datetime)) else str(value))
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+async def parquet_chunks(batches: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """
+    Файл Parquet: порции копятся в столбцах Arrow до PARQUET_ROW_GROUP_ROWS строк
+    и записываются группой строк, байты отдаются сразу после записи группы
+
+    Метаданные каждой группы остаются в памяти до конца файла (его оглавление),
+    поэтому группы крупнее порций курсора, а статистика min/max пишется только
+    для коротких столбцов, не для текстов.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd", write_statistics=PARQUET_STATISTICS)
+    pending = []
+    pending_rows = 0
+    try:
+        async for batch in batches:
+            if batch:
+                table = _parquet_table(batch, schema)
+                pending.append(table)
+                pending_rows += table.num_rows
+            if pending_rows >= PARQUET_ROW_GROUP_ROWS:
+                writer.write_table(pa.concat_tables(pending), row_group_size=pending_rows)
+                pending = []
+                pending_rows = 0
+                yield sink.take()
+        if pending:
+            writer.write_table(pa.concat_tables(pending), row_group_size=pending_rows)
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+ENCODERS = {"ndjson": ndjson_chunks, "geojson": geojson_chunks, "parquet": parquet_chunks}
+
+
+def check_format(fmt: str):
+    """Бросает ImportError, если для формата не установлена библиотека (Parquet - pyarrow)"""
+    if fmt == "parquet":
+        import pyarrow.parquet  # noqa: F401
+
+
+def local_time(value: Optional[datetime]) -> Optional[datetime]:
+    """Время с часовым поясом - в местное время сервера без пояса (date_added - timestamp)"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+async def prefetch(batches: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Прочитать первую порцию до начала ответа: ошибки БД и параметров
+    запроса выбрасываются здесь, а не после отправленного статуса 200
+    """
+    try:
+        first = await anext(batches)
+    except StopAsyncIteration:
+        first = None
+
+    async def chained():
+        if first is None:
+            return
+        yield first
+        async for batch in batches:
+            yield batch
+
+    return chained()
+
+
+def export_chunks(fmt: str, batches: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """Байты выгрузки в формате fmt из порций записей (AsyncDatabaseManager.iter_export)"""
+    return ENCODERS[fmt](batches)
+
+
+async def _export_to_file(args) -> None:
+    from app.async_database import AsyncDatabaseManager
+
+    db_manager = AsyncDatabaseManager()
+    await db_manager.connect()
+    rows = 0
+    last_id = None
+
+    async def counted(batches):
+        nonlocal rows, last_id
+        async for batch in batches:
+            if batch:
+                rows += len(batch)
+                last_id = batch[-1]["id"]
+            yield batch
+
+    batches = db_manager.iter_export(status=args.status, date_from=local_time(args.date_from),
+                                     date_to=local_time(args.date_to),
+                                     after_id=args.after_id, batch_size=args.batch_size)
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    started = time.perf_counter()
+    try:
+        async for chunk in export_chunks(args.format, counted(batches)):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+        await db_manager.close()
+
+    print(f"Выгружено записей: {rows} за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+    if last_id is not None:
+        print(f"Последний id: {last_id} (для следующей выгрузки: --after-id {last_id})", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка записей перевалов")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--output", help="файл (по умолчанию stdout)")
+    parser.add_argument("--status", help="только записи с этим статусом")
+    parser.add_argument("--from", dest="date_from", type=datetime.fromisoformat,
+                        help="date_added не раньше (ISO 8601)")
+    parser.add_argument("--to", dest="date_to", type=datetime.fromisoformat,
+                        help="date_added раньше (ISO 8601)")
+    parser.add_argument("--after-id", type=int, help="только записи с id больше")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="строк в порции")
+    args = parser.parse_args()
+
+    try:
+        check_format(args.format)
+    except ImportError:
+        sys.exit("Для формата parquet нужен pyarrow: pip install pyarrow")
+    asyncio.run(_export_to_file(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import heapq
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Сетка для индекса в БД; должна совпадать с функцией pereval_geo_cell (миграция 0004)
+GRID_STEP = 0.25
+GRID_ROWS = int(180 / GRID_STEP)
+GRID_COLS = int(360 / GRID_STEP)
+# Если прямоугольник покрывает больше ячеек, фильтр по ячейкам не используется
+MAX_BBOX_CELLS = 2000
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def parse_coord(value) -> Optional[float]:
+    """Координата из строки raw_data ("45.3842") или None, если это не число"""
+    try:
+        result = float(value)
+    except (TypeError, ValueError):
+        return None
+    return result if math.isfinite(result) else None
+
+
+def geo_cell(lat: float, lon: float) -> Optional[int]:
+    """Номер ячейки сетки для точки"""
+    if lat is None or lon is None or not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        return None
+    row = min(math.floor((lat + 90) / GRID_STEP), GRID_ROWS - 1)
+    col = min(math.floor((lon + 180) / GRID_STEP), GRID_COLS - 1)
+    return row * GRID_COLS + col
+
+
+def cells_for_bbox(min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> Optional[List[int]]:
+    """Ячейки, покрывающие прямоугольник, или None, если их слишком много"""
+    first = geo_cell(min_lat, min_lon)
+    last = geo_cell(max_lat, max_lon)
+    row0, col0 = divmod(first, GRID_COLS)
+    row1, col1 = divmod(last, GRID_COLS)
+    if (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_BBOX_CELLS:
+        return None
+    return [row * GRID_COLS + col for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+
+def to_xyz(lat: float, lon: float) -> Tuple[float, float, float]:
+    """Точка на единичной сфере: хорда монотонна по расстоянию по дуге"""
+    phi = math.radians(lat)
+    lam = math.radians(lon)
+    cos_phi = math.cos(phi)
+    return cos_phi * math.cos(lam), cos_phi * math.sin(lam), math.sin(phi)
+
+
+def chord_to_km(chord_sq: float) -> float:
+    chord = math.sqrt(chord_sq)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+class KDTree:
+    """
+    Статическое k-d дерево по точкам на единичной сфере
+
+    Хранится неявно: узел поддерева [lo, hi) - элемент с индексом (lo + hi) // 2,
+    ось разбиения чередуется по глубине. Построение O(n log^2 n), запрос
+    k ближайших - O(log n + k) в среднем.
+    """
+
+    def __init__(self, points: Iterable[Tuple[int, float, float]]):
+        items = [(to_xyz(lat, lon), pereval_id) for pereval_id, lat, lon in points]
+        self._build(items, 0, len(items), 0)
+        self.coords = [xyz for xyz, _ in items]
+        self.ids = [pereval_id for _, pereval_id in items]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _build(items, lo: int, hi: int, depth: int):
+        stack = [(lo, hi, depth)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo <= 1:
+                continue
+            axis = depth % 3
+            items[lo:hi] = sorted(items[lo:hi], key=lambda item: item[0][axis])
+            mid = (lo + hi) // 2
+            stack.append((lo, mid, depth + 1))
+            stack.append((mid + 1, hi, depth + 1))
+
+    def nearest(self, lat: float, lon: float, k: int, skip=frozenset()) -> List[Tuple[float, int]]:
+        """k ближайших точек: список (квадрат хорды, id) по возрастанию расстояния"""
+        if not self.ids or k <= 0:
+            return []
+        target = to_xyz(lat, lon)
+        coords = self.coords
+        ids = self.ids
+        heap: List[Tuple[float, int]] = []  # (-расстояние, id), на вершине самый дальний
+
+        def search(lo: int, hi: int, depth: int):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            point = coords[mid]
+            dist = ((point[0] - target[0]) ** 2 + (point[1] - target[1]) ** 2
+                    + (point[2] - target[2]) ** 2)
+            if ids[mid] not in skip:
+                if len(heap) < k:
+                    heapq.heappush(heap, (-dist, ids[mid]))
+                elif dist < -heap[0][0]:
+                    heapq.heapreplace(heap, (-dist, ids[mid]))
+            diff = target[depth % 3] - point[depth % 3]
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            search(near[0], near[1], depth + 1)
+            if len(heap) < k or diff * diff < -heap[0][0]:
+                search(far[0], far[1], depth + 1)
+
+        search(0, len(ids), 0)
+        return sorted((-neg, pereval_id) for neg, pereval_id in heap)
+
+
+class SpatialIndex:
+    """
+    Индекс ближайших перевалов в памяти процесса с инкрементальным обновлением
+
+    Изменения после построения дерева копятся в небольшом буфере (delta)
+    и списке удалённых из дерева id; запрос объединяет дерево и буфер.
+    Когда буфер вырастает, дерево перестраивается (в фоновом потоке),
+    а изменения, пришедшие за время перестройки, применяются поверх.
+    """
+
+    def __init__(self, rebuild_ratio: float = 0.05, rebuild_min: int = 1000):
+        self.tree = KDTree([])
+        self.points: Dict[int, Tuple[float, float]] = {}
+        self.delta: Dict[int, Tuple[float, float]] = {}
+        self.stale: set = set()
+        self.ready = False
+        self.rebuild_ratio = rebuild_ratio
+        self.rebuild_min = rebuild_min
+        self._rebuilding = False
+        self._pending: List[Tuple[int, Optional[Tuple[float, float]]]] = []
+
+    def __len__(self):
+        return len(self.points)
+
+    def begin_load(self):
+        """Начать полную загрузку: изменения до её окончания будут применены поверх"""
+        self._rebuilding = True
+        self._pending = []
+
+    def load(self, points: List[Tuple[int, float, float]], tree: KDTree):
+        """
+        Завершить полную загрузку: точки (id, широта, долгота) и дерево по ним
+        Дерево строится заранее (обычно в отдельном потоке)
+        """
+        self.points = {pereval_id: (lat, lon) for pereval_id, lat, lon in points}
+        self.swap(tree)
+        self.ready = True
+
+    def upsert(self, pereval_id: int, lat: Optional[float], lon: Optional[float]):
+        """Добавить или переместить точку; без координат точка удаляется"""
+        if geo_cell(lat, lon) is None:
+            self.remove(pereval_id)
+            return
+        if self._rebuilding:
+            self._pending.append((pereval_id, (lat, lon)))
+        self.points[pereval_id] = (lat, lon)
+        self.delta[pereval_id] = (lat, lon)
+        self.stale.add(pereval_id)
+
+    def remove(self, pereval_id: int):
+        if self._rebuilding:
+            self._pending.append((pereval_id, None))
+        self.points.pop(pereval_id, None)
+        self.delta.pop(pereval_id, None)
+        self.stale.add(pereval_id)
+
+    @property
+    def needs_rebuild(self) -> bool:
+        return (not self._rebuilding
+                and len(self.stale) > max(self.rebuild_min, len(self.tree) * self.rebuild_ratio))
+
+    def snapshot(self) -> List[Tuple[int, float, float]]:
+        """Начать перестройку: текущие точки для нового дерева"""
+        self._rebuilding = True
+        self._pending = []
+        return [(pereval_id, lat, lon) for pereval_id, (lat, lon) in self.points.items()]
+
+    def swap(self, tree: KDTree):
+        """Завершить перестройку: подставить дерево и применить изменения за время сборки"""
+        self.tree = tree
+        self.delta = {}
+        self.stale = set()
+        self._rebuilding = False
+        pending, self._pending = self._pending, []
+        for pereval_id, point in pending:
+            if point is None:
+                self.remove(pereval_id)
+            else:
+                self.upsert(pereval_id, *point)
+
+    def abort_rebuild(self):
+        self._rebuilding = False
+        self._pending = []
+
+    def nearest(self, lat: float, lon: float, k: int) -> List[Tuple[float, int]]:
+        """k ближайших перевалов: список (расстояние в км, id)"""
+        found = self.tree.nearest(lat, lon, k, skip=self.stale)
+        if self.delta:
+            tx, ty, tz = to_xyz(lat, lon)
+            for pereval_id, (plat, plon) in self.delta.items():
+                x, y, z = to_xyz(plat, plon)
+                found.append(((x - tx) ** 2 + (y - ty) ** 2 + (z - tz) ** 2, pereval_id))
+            found = heapq.nsmallest(k, found)
+        return [(chord_to_km(dist), pereval_id) for dist, pereval_id in found]
@@ -0,0 +1,114 @@
+"""
+Повторные отправки перевалов
+
+Клиент может передать заголовок Idempotency-Key (например, UUID): повтор
+запроса с тем же ключом возвращает id записи, созданной первым запросом,
+ничего не записывая. Ключи хранятся FSTR_IDEMPOTENCY_TTL секунд.
+Независимо от ключа одинаковые данные от того же пользователя (совпадает
+payload_hash, в который входит и пользователь) сохраняются один раз:
+повтор получает id уже сохранённой записи.
+
+Общее для процессов хранилище - БД (pereval_idempotency и уникальный
+pereval_added.content_hash); недавние отправки процесса, в том числе ещё
+стоящие в очереди записи, дополнительно помнятся в памяти.
+"""
+import hashlib
+import os
+from typing import Optional
+
+import orjson
+from pydantic import BaseModel
+
+from app.cache import LRUTTLCache
+
+IDEMPOTENCY_TTL = int(os.getenv('FSTR_IDEMPOTENCY_TTL', str(24 * 3600)))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('FSTR_IDEMPOTENCY_CACHE', '10000'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+class IdempotencyKeyConflictError(Exception):
+    """Ключ Idempotency-Key уже использован для запроса с другими данными"""
+    pass
+
+
+def payload_hash(pereval_data) -> bytes:
+    """sha256 данных перевала (модели или словаря) в каноническом JSON с упорядоченными ключами"""
+    if isinstance(pereval_data, BaseModel):
+        pereval_data = pereval_data.model_dump(mode="json")
+    return hashlib.sha256(orjson.dumps(pereval_data, option=orjson.OPT_SORT_KEYS)).digest()
+
+
+def check_request_hash(stored_hash: Optional[bytes], request_hash: Optional[bytes]):
+    """IdempotencyKeyConflictError, если ключ был использован для других данных"""
+    if stored_hash is not None and request_hash is not None and bytes(stored_hash) != request_hash:
+        raise IdempotencyKeyConflictError("Idempotency-Key уже использован для запроса с другими данными")
+
+
+def check_key(key: Optional[str]) -> Optional[str]:
+    """Ключ из заголовка; ValueError, если он пустой или слишком длинный"""
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f"Idempotency-Key должен быть непустой строкой до {IDEMPOTENCY_KEY_MAX_LENGTH} символов")
+    return key
+
+
+class SubmissionRegistry:
+    """
+    Поиск уже принятой отправки по ключу и по хэшу содержимого
+
+    Сначала проверяются недавние отправки этого процесса, затем БД
+    (один запрос). request_hash - хэш данных запроса: повтор ключа
+    с другими данными - ошибка IdempotencyKeyConflictError.
+    """
+
+    def __init__(self, db_manager, max_entries: int = IDEMPOTENCY_CACHE_SIZE, ttl: float = IDEMPOTENCY_TTL):
+        self.db = db_manager
+        self.ttl = ttl
+        self._recent = LRUTTLCache(max_entries, ttl)
+
+    async def find(self, request_hash: bytes, key: Optional[str] = None,
+                   content_hash: Optional[bytes] = None) -> Optional[int]:
+        """id ранее сохранённой (или поставленной в очередь) записи или None"""
+        if key is not None:
+            item = await self._recent.get(("key", key))
+            if item is not None:
+                return self._check(item, request_hash)
+        if content_hash is not None:
+            pereval_id = await self._recent.get(("hash", content_hash))
+            # запись с тех пор не изменили и не удалили (см. forget)
+            if pereval_id is not None and await self._recent.get(("id", pereval_id)) == content_hash:
+                return pereval_id
+
+        found = await self.db.find_submission(key, content_hash)
+        if found["key_id"] is not None:
+            item = (found["request_hash"], found["key_id"])
+            await self._recent.set(("key", key), item)
+            return self._check(item, request_hash)
+        if found["duplicate_id"] is not None:
+            await self._remember_hash(found["duplicate_id"], content_hash)
+            return found["duplicate_id"]
+        return None
+
+    async def remember(self, pereval_id: int, request_hash: bytes, key: Optional[str] = None,
+                       content_hash: Optional[bytes] = None):
+        """Запомнить только что принятую отправку"""
+        if key is not None:
+            await self._recent.set(("key", key), (request_hash, pereval_id))
+        if content_hash is not None:
+            await self._remember_hash(pereval_id, content_hash)
+
+    async def forget(self, pereval_id: int):
+        """Запись изменена или удалена: её прежнее содержимое больше не повтор"""
+        await self._recent.delete(("id", pereval_id))
+
+    async def _remember_hash(self, pereval_id: int, content_hash: bytes):
+        await self._recent.set(("hash", content_hash), pereval_id)
+        await self._recent.set(("id", pereval_id), content_hash)
+
+    @staticmethod
+    def _check(item, request_hash: bytes) -> int:
+        stored_hash, pereval_id = item
+        check_request_hash(stored_hash, request_hash)
+        return pereval_id
@@ -0,0 +1,448 @@
+"""
+Хранилище изображений вне БД с адресацией по содержимому
+
+Изображение хранится один раз под своим sha256: повторная отправка той же
+фотографии (в том числе при update_pereval) не занимает места. В документе
+images записи ссылаются на изображения хэшем ({"sha256": ..., "title": ...}),
+изображение отдаётся по GET /images/{sha256}.
+
+Бэкенд выбирается FSTR_IMAGE_STORE (сейчас только local - файлы в каталоге
+FSTR_IMAGE_DIR). Раскладка: <каталог>/ab/cd/abcd...: два уровня подкаталогов
+по первым символам хэша, чтобы в каталоге не было миллионов файлов.
+Запись атомарная: файл пишется во временный в <каталог>/.tmp, сбрасывается
+на диск (fsync) и переименовывается в итоговое имя; если файл с таким хэшем
+уже есть, временный просто удаляется.
+
+Учёт ссылок - в БД (image_blobs, миграция 0009): триггер pereval_added
+увеличивает и уменьшает refcount по хэшам в images. Изображения без ссылок
+дольше FSTR_IMAGE_GC_GRACE секунд удаляет сборщик (collect_images).
+Файлы, созданные транзакцией, которая затем откатывается, удаляются до
+отката (AsyncDatabaseManager.discard_images); оставшиеся файлы без строки
+в БД (процесс упал посреди записи) удаляет
+    python -m app.image_store gc --orphans
+Перенос изображений из таблицы pereval_images (если миграция 0009 прошла,
+пока старые процессы сервера ещё писали в неё):
+    python -m app.image_store migrate
+"""
+import argparse
+import hashlib
+import os
+import re
+import tempfile
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.images import IMAGE_CHUNK_SIZE
+
+load_dotenv()
+
+IMAGE_STORE = os.getenv('FSTR_IMAGE_STORE', 'local')
+IMAGE_DIR = os.getenv('FSTR_IMAGE_DIR', '/var/lib/pereval/images')
+IMAGE_GC_GRACE = float(os.getenv('FSTR_IMAGE_GC_GRACE', '3600'))
+# Сколько первых байт читается для определения Content-Type
+IMAGE_HEAD_BYTES = 16
+# Уровни подкаталогов и символов хэша на уровень
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+HASH_HEX_LENGTH = 64
+
+# Запись изображения: строка блокируется и перестаёт считаться освобождённой
+# до конца транзакции, поэтому сборщик не удалит файл, на который она ссылается;
+# inserted - строки не было, её создала эта транзакция
+UPSERT_IMAGE_BLOB_QUERY = """
+INSERT INTO image_blobs (hash, size) VALUES ($1, $2)
+ON CONFLICT (hash) DO UPDATE SET released_at = NULL
+RETURNING (xmax = 0) AS inserted
+"""
+
+# Изображения без ссылок старше grace ($1) секунд, не больше $2 за раз; строки,
+# заблокированные записью (UPSERT_IMAGE_BLOB_QUERY), пропускаются. Файлы удаляются
+# до коммита: запись, ждущая блокировки, после него увидит, что файла нет,
+# и запишет его заново
+COLLECT_IMAGES_QUERY = """
+DELETE FROM image_blobs WHERE hash IN (
+    SELECT hash FROM image_blobs
+    WHERE refcount <= 0 AND coalesce(released_at, created_at) <= now() - make_interval(secs => $1)
+    LIMIT $2
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING hash
+"""
+
+
+def psycopg2_query(query: str) -> str:
+    """Запрос с параметрами $1, $2, ... (asyncpg) для psycopg2, параметры по порядку"""
+    return re.sub(r'\$\d+', '%s', query)
+
+
+def is_image_hash(value: str) -> bool:
+    """Строка - sha256 в шестнадцатеричном виде"""
+    return len(value) == HASH_HEX_LENGTH and all(c in '0123456789abcdef' for c in value)
+
+
+class StagedImage:
+    """Изображение, записываемое во временный файл: хэш и размер считаются по ходу"""
+
+    def __init__(self, path: str, file):
+        self.path = path
+        self.file = file
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        self._hash.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    @property
+    def digest(self) -> bytes:
+        return self._hash.digest()
+
+    @property
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class ImageStore:
+    """
+    Интерфейс хранилища изображений
+
+    Запись: stage() -> StagedImage.write(...) -> commit() или discard().
+    commit вызывается после того, как строка image_blobs заблокирована
+    в транзакции записи (см. AsyncDatabaseManager.store_image): тогда
+    сборщик не может удалить файл между проверкой и ссылкой на него.
+    """
+
+    def stage(self) -> StagedImage:
+        raise NotImplementedError
+
+    def commit(self, staged: StagedImage) -> bool:
+        """Сохранить изображение под его хэшем (если его ещё нет); True - файл создан"""
+        raise NotImplementedError
+
+    def discard(self, staged: StagedImage):
+        raise NotImplementedError
+
+    def path(self, hash_hex: str) -> Optional[str]:
+        """Путь к файлу изображения, если бэкенд хранит файлы локально"""
+        return None
+
+    def stat(self, hash_hex: str) -> Optional[Tuple[int, bytes]]:
+        """(размер, первые байты) или None, если изображения нет"""
+        raise NotImplementedError
+
+    def read(self, hash_hex: str) -> bytes:
+        raise NotImplementedError
+
+    def iter_range(self, hash_hex: str, start: int, end: int,
+                   chunk_size: int = IMAGE_CHUNK_SIZE) -> Iterator[bytes]:
+        """Байты с start по end включительно частями"""
+        raise NotImplementedError
+
+    def delete(self, hash_hex: str):
+        raise NotImplementedError
+
+    def iter_objects(self) -> Iterator[Tuple[str, float]]:
+        """Все хранимые изображения и временные файлы: (хэш или путь временного файла, mtime)"""
+        raise NotImplementedError
+
+
+class LocalImageStore(ImageStore):
+    """Файлы в локальном каталоге (или общем для процессов томе)"""
+
+    def __init__(self, directory: str, fsync: bool = True):
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, '.tmp')
+        self.fsync = fsync
+        self._ready = False
+
+    def _ensure_dirs(self):
+        if not self._ready:
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            self._ready = True
+
+    def path(self, hash_hex: str) -> str:
+        parts = [hash_hex[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+        return os.path.join(self.directory, *parts, hash_hex)
+
+    def stage(self) -> StagedImage:
+        self._ensure_dirs()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, prefix='img-')
+        return StagedImage(tmp_path, os.fdopen(fd, 'wb'))
+
+    def commit(self, staged: StagedImage) -> bool:
+        target = self.path(staged.hexdigest)
+        if os.path.exists(target):
+            self.discard(staged)
+            return False
+        try:
+            staged.file.flush()
+            if self.fsync:
+                os.fsync(staged.file.fileno())
+            staged.file.close()
+            shard = os.path.dirname(target)
+            os.makedirs(shard, exist_ok=True)
+            os.chmod(staged.path, 0o644)
+            # одинаковое содержимое: одновременная запись того же хэша безопасна
+            os.replace(staged.path, target)
+            if self.fsync:
+                dir_fd = os.open(shard, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+        except BaseException:
+            self.discard(staged)
+            raise
+        return True
+
+    def discard(self, staged: StagedImage):
+        staged.file.close()
+        try:
+            os.unlink(staged.path)
+        except FileNotFoundError:
+            pass
+
+    def stat(self, hash_hex: str) -> Optional[Tuple[int, bytes]]:
+        try:
+            with open(self.path(hash_hex), 'rb') as f:
+                return os.fstat(f.fileno()).st_size, f.read(IMAGE_HEAD_BYTES)
+        except FileNotFoundError:
+            return None
+
+    def read(self, hash_hex: str) -> bytes:
+        with open(self.path(hash_hex), 'rb') as f:
+            return f.read()
+
+    def iter_range(self, hash_hex: str, start: int, end: int,
+                   chunk_size: int = IMAGE_CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self.path(hash_hex), 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, hash_hex: str):
+        try:
+            os.unlink(self.path(hash_hex))
+        except FileNotFoundError:
+            pass
+
+    def iter_objects(self) -> Iterator[Tuple[str, float]]:
+        if not os.path.isdir(self.directory):
+            return
+        for root, dirs, files in os.walk(self.directory):
+            dirs.sort()
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                yield (name if root != self.tmp_dir and is_image_hash(name) else path), mtime
+
+
+BACKENDS = {'local': lambda: LocalImageStore(IMAGE_DIR)}
+
+
+def image_store_from_env() -> ImageStore:
+    """Хранилище по FSTR_IMAGE_STORE"""
+    try:
+        return BACKENDS[IMAGE_STORE]()
+    except KeyError:
+        raise ValueError(f"Неизвестное хранилище изображений FSTR_IMAGE_STORE={IMAGE_STORE}: "
+                         f"доступны {', '.join(sorted(BACKENDS))}")
+
+
+def move_legacy_images(conn, batch_size: int = 500, pause: float = 0.0,
+                       store: Optional[ImageStore] = None) -> Dict[str, int]:
+    """
+    Перенести изображения из pereval_images в хранилище (миграция 0009)
+
+    Записи pereval_added, в images которых остались числовые id, обрабатываются
+    пачками по id, каждая пачка - одной транзакцией: изображения записываются
+    в хранилище, id заменяются хэшами, соответствие старых id хэшам
+    сохраняется в image_legacy_ids (старые ссылки /images/{id} продолжают
+    работать), перенесённые строки pereval_images удаляются.
+    Повторный запуск продолжает с того, что не перенесено.
+    """
+    import orjson
+    import psycopg2
+
+    store = store or image_store_from_env()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT min(id) AS lo, max(id) AS hi FROM pereval_added")
+        bounds = cursor.fetchone()
+    conn.commit()
+    totals = {'records': 0, 'images': 0, 'missing': 0}
+    if bounds['lo'] is None:
+        return totals
+
+    start = bounds['lo'] - 1
+    reported = time.monotonic()
+    while start < bounds['hi']:
+        end = start + batch_size
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT id, images FROM pereval_added
+            WHERE id > %s AND id <= %s AND jsonb_path_exists(images, '$.images[*].id')
+            FOR UPDATE
+            """, (start, end))
+            rows = cursor.fetchall()
+            legacy_ids = sorted({
+                image['id'] for row in rows for image in row['images']['images']
+                if isinstance(image, dict) and isinstance(image.get('id'), int)
+            })
+            hashes = {}
+            if legacy_ids:
+                cursor.execute("SELECT id, hash FROM image_legacy_ids WHERE id = ANY(%s)", (legacy_ids,))
+                hashes = {row['id']: bytes(row['hash']).hex() for row in cursor.fetchall()}
+
+            moved = []
+            for image_id in legacy_ids:
+                if image_id in hashes:
+                    continue
+                cursor.execute("SELECT img FROM pereval_images WHERE id = %s", (image_id,))
+                found = cursor.fetchone()
+                if found is None:
+                    totals['missing'] += 1
+                    print(f"    изображение {image_id} не найдено в pereval_images, ссылка оставлена")
+                    continue
+                staged = store.stage()
+                try:
+                    data = found['img']
+                    for pos in range(0, len(data), IMAGE_CHUNK_SIZE):
+                        staged.write(bytes(data[pos:pos + IMAGE_CHUNK_SIZE]))
+                    cursor.execute(psycopg2_query(UPSERT_IMAGE_BLOB_QUERY),
+                                   (psycopg2.Binary(staged.digest), staged.size))
+                    store.commit(staged)
+                except BaseException:
+                    store.discard(staged)
+                    raise
+                cursor.execute("INSERT INTO image_legacy_ids (id, hash) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                               (image_id, psycopg2.Binary(staged.digest)))
+                hashes[image_id] = staged.hexdigest
+                moved.append(image_id)
+
+            for row in rows:
+                images = []
+                for image in row['images']['images']:
+                    if isinstance(image, dict) and image.get('id') in hashes:
+                        image = {'sha256': hashes[image['id']], 'title': image.get('title')}
+                    images.append(image)
+                cursor.execute("UPDATE pereval_added SET images = %s::jsonb WHERE id = %s",
+                               (orjson.dumps(dict(row['images'], images=images)).decode(), row['id']))
+            if moved:
+                cursor.execute("DELETE FROM pereval_images WHERE id = ANY(%s)", (moved,))
+        conn.commit()
+        totals['records'] += len(rows)
+        totals['images'] += len(moved)
+        start = end
+        if start >= bounds['hi'] or time.monotonic() - reported > 1:
+            reported = time.monotonic()
+            print(f"    pereval_added: id <= {min(end, bounds['hi'])} из {bounds['hi']}, "
+                  f"записей: {totals['records']}, перенесено изображений: {totals['images']}")
+        if pause:
+            time.sleep(pause)
+    return totals
+
+
+def sweep_orphans(conn, store: ImageStore, grace: float = IMAGE_GC_GRACE, batch_size: int = 1000) -> int:
+    """
+    Удалить файлы старше grace секунд, для которых нет строки image_blobs:
+    прерванные записи и временные файлы. Обходит всё хранилище
+    """
+    import psycopg2
+
+    deadline = time.time() - grace
+    deleted = 0
+    batch: List[str] = []
+
+    def flush():
+        nonlocal deleted
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT hash FROM image_blobs WHERE hash = ANY(%s)",
+                           ([psycopg2.Binary(bytes.fromhex(h)) for h in batch],))
+            known = {bytes(row['hash']).hex() for row in cursor.fetchall()}
+        conn.commit()
+        for hash_hex in batch:
+            if hash_hex not in known:
+                store.delete(hash_hex)
+                deleted += 1
+        batch.clear()
+
+    for name, mtime in store.iter_objects():
+        if mtime > deadline:
+            continue
+        if not is_image_hash(name):
+            # временный файл прерванной записи
+            try:
+                os.unlink(name)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            continue
+        batch.append(name)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return deleted
+
+
+def collect_images(conn, store: ImageStore, grace: float = IMAGE_GC_GRACE, batch_size: int = 1000) -> int:
+    """
+    Удалить изображения, на которые нет ссылок дольше grace секунд (psycopg2)
+    Файлы удаляются, пока строки заблокированы, см. COLLECT_IMAGES_QUERY
+    """
+    deleted = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute(psycopg2_query(COLLECT_IMAGES_QUERY), (grace, batch_size))
+            rows = cursor.fetchall()
+            for row in rows:
+                store.delete(bytes(row['hash']).hex())
+        conn.commit()
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+
+
+def main():
+    from app.database import DatabaseManager
+
+    parser = argparse.ArgumentParser(description="Хранилище изображений")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gc_parser = commands.add_parser("gc", help="удалить изображения без ссылок")
+    gc_parser.add_argument("--orphans", action="store_true", help="также файлы без строки в БД (обход хранилища)")
+    gc_parser.add_argument("--grace", type=float, default=IMAGE_GC_GRACE, help="не трогать изображения моложе, с")
+    migrate_parser = commands.add_parser("migrate", help="перенести изображения из pereval_images")
+    migrate_parser.add_argument("--batch-size", type=int, default=500, help="записей pereval_added в пачке")
+    migrate_parser.add_argument("--pause", type=float, default=0.0, help="пауза между пачками, с")
+    args = parser.parse_args()
+
+    store = image_store_from_env()
+    conn = DatabaseManager().connect()
+    try:
+        if args.command == "migrate":
+            totals = move_legacy_images(conn, args.batch_size, args.pause, store)
+            print(f"Записей: {totals['records']}, перенесено изображений: {totals['images']}, "
+                  f"не найдено: {totals['missing']}")
+        else:
+            deleted = collect_images(conn, store, args.grace)
+            print(f"Удалено изображений без ссылок: {deleted}")
+            if args.orphans:
+                print(f"Удалено файлов без строки в БД: {sweep_orphans(conn, store, args.grace)}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
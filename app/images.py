@@ -0,0 +1,177 @@
+import binascii
+import mmap
+import os
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from starlette.responses import Response
+
+IMAGE_CHUNK_SIZE = int(os.getenv('FSTR_IMAGE_CHUNK_SIZE', str(1024 * 1024)))
+
+_BASE64_WHITESPACE = str.maketrans('', '', ' \t\r\n')
+
+
+def iter_base64_chunks(data: str, chunk_size: int = IMAGE_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Декодирует base64-строку по частям
+
+    За раз в памяти находится не больше chunk_size декодированных байт,
+    поэтому большое изображение не копируется целиком ещё раз.
+    Поддерживается префикс data URI ("data:image/png;base64,...").
+    """
+    start = 0
+    if data.startswith('data:'):
+        start = data.find(',') + 1
+
+    # 4 символа base64 = 3 байта
+    step = max(chunk_size // 3, 1) * 4
+    carry = ''
+    for pos in range(start, len(data), step):
+        piece = carry + data[pos:pos + step]
+        if any(c in piece for c in ' \t\r\n'):
+            piece = piece.translate(_BASE64_WHITESPACE)
+        usable = len(piece) - len(piece) % 4
+        carry = piece[usable:]
+        if usable:
+            try:
+                yield binascii.a2b_base64(piece[:usable], strict_mode=True)
+            except binascii.Error as e:
+                raise ValueError(f"Некорректные данные изображения (base64): {e}")
+
+    if carry:
+        raise ValueError("Некорректные данные изображения (base64): неполный блок")
+
+
+async def iter_upload_chunks(upload, chunk_size: int = IMAGE_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Читает загруженный файл (UploadFile) по частям"""
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def payload_images(pereval_data) -> List[Any]:
+    """Список изображений из данных запроса (модели или словаря)"""
+    if isinstance(pereval_data, dict):
+        return pereval_data.get("images", [])
+    return getattr(pereval_data, "images", [])
+
+
+def image_sources_from_payload(images: List[Any]) -> List[Tuple[str, Iterable[bytes]]]:
+    """Пары (название, части содержимого) для изображений из JSON-запроса"""
+    sources = []
+    for img in images:
+        if isinstance(img, dict):
+            sources.append((img["title"], iter_base64_chunks(img["data"])))
+        else:
+            sources.append((img.title, iter_base64_chunks(img.data)))
+    return sources
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Разбирает заголовок Range вида bytes=a-b, bytes=a- или bytes=-n
+    Возвращает (start, end) включительно или None, если диапазон
+    не поддерживается (несколько диапазонов, другие единицы) или записан
+    с ошибкой (конец раньше начала) и нужно отдать файл целиком.
+    Для диапазона вне файла бросает ValueError.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                # по RFC 7233 такой заголовок игнорируется
+                return None
+        else:
+            suffix = int(last)
+            if suffix == 0:
+                raise ValueError("Пустой диапазон")
+            start = max(size - suffix, 0)
+            end = size - 1
+    except ValueError:
+        raise ValueError("Некорректный диапазон")
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError("Диапазон вне файла")
+    return start, end
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Проверяет заголовок If-None-Match (слабое сравнение)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag.removeprefix('W/'):
+            return True
+    return False
+
+
+def guess_image_type(head: bytes) -> str:
+    """Определяет MIME-тип изображения по первым байтам"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+class ImageFileResponse(Response):
+    """
+    Байты файла изображения с start по end включительно без чтения файла в память процесса
+
+    Если сервер поддерживает расширение ASGI http.response.zerocopysend,
+    файл отдаётся через sendfile; иначе файл отображается в память (mmap)
+    и отправляется срезами по chunk_size.
+    """
+
+    def __init__(self, path: str, start: int, end: int, status_code: int = 200,
+                 headers: Optional[Dict[str, str]] = None, media_type: Optional[str] = None,
+                 chunk_size: int = IMAGE_CHUNK_SIZE):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.chunk_size = chunk_size
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(dict(headers or {}, **{'Content-Length': str(max(end - start + 1, 0))}))
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        length = self.end - self.start + 1
+        if scope.get('method') == 'HEAD' or length <= 0:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        with open(self.path, 'rb') as f:
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.zerocopysend', 'file': f.fileno(),
+                            'offset': self.start, 'count': length})
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    pos = self.start
+                    while pos <= self.end:
+                        chunk_end = min(pos + self.chunk_size, self.end + 1)
+                        await send({'type': 'http.response.body', 'body': bytes(view[pos:chunk_end]),
+                                    'more_body': chunk_end <= self.end})
+                        pos = chunk_end
+                finally:
+                    view.release()
@@ -0,0 +1,509 @@
+"""
+Отложенная запись перевалов (режим FSTR_INGEST_MODE=queue)
+
+POST /submitData проверяет данные, выдаёт id из заранее зарезервированного
+блока pereval_id_seq, кладёт запись в ограниченную очередь в памяти и сразу
+отвечает 202. Фоновая задача пишет очередь в БД пачками: одна транзакция
+и один коммит на пачку (group commit), пачка уходит, когда набралось
+FSTR_INGEST_BATCH записей или прошло FSTR_INGEST_FLUSH_MS с первой.
+
+Для восстановления после падения процесса записи до ответа клиенту
+дописываются в журнал в каталоге FSTR_INGEST_SPILL_DIR. Журнал разбит на
+сегменты: новый сегмент начинается с каждой пачкой, сегмент удаляется,
+когда все его записи закоммичены. Сегменты упавших процессов (их файлы
+не заблокированы flock) дописываются в БД при запуске; id в журнале уже
+выданы, поэтому повторная запись не создаёт дублей.
+
+Надёжность (FSTR_INGEST_DURABILITY):
+  none  - журнала нет, очередь теряется при падении процесса;
+  os    - запись в файл без fsync: переживает падение процесса, но не ОС;
+  fsync - ответ после fsync журнала (fsync общий для одновременных запросов).
+
+Повторные отправки (app.idempotency) отсекаются до выдачи id. Если те же
+данные одновременно приняли два процесса, сохраняется одна запись, а вторая
+получает состояние failed с id сохранённой.
+
+Состояние записи видно из любого процесса (GET /submitData/{id}/status):
+зарезервированные id отмечаются в pereval_ingest_status как queued, после
+записи пачки сохранённые удаляются оттуда, а несохранённые получают failed
+(миграция 0013). Строки старше FSTR_INGEST_STATUS_TTL удаляются.
+"""
+import asyncio
+import fcntl
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import asyncpg
+import orjson
+
+from app import metrics
+from app.database import PoolExhaustedError
+from app.idempotency import payload_hash
+from app.images import iter_base64_chunks, payload_images
+from app.models import PerevalData
+
+INGEST_MODE = os.getenv('FSTR_INGEST_MODE', 'direct')
+INGEST_STATUS_TTL = int(os.getenv('FSTR_INGEST_STATUS_TTL', str(7 * 24 * 3600)))
+
+QUEUED = 'queued'
+PERSISTED = 'persisted'
+FAILED = 'failed'
+
+queue_depth = metrics.registry.register(metrics.Gauge(
+    "ingest_queue_depth", "Записей в очереди отложенной записи"))
+ingest_records = metrics.registry.register(metrics.Counter(
+    "ingest_records_total", "Записи очереди по результату", ("result",)))
+flush_size = metrics.registry.register(metrics.Histogram(
+    "ingest_flush_batch_size", "Записей в пачке", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)))
+flush_duration = metrics.registry.register(metrics.Histogram(
+    "ingest_flush_duration_seconds", "Время записи пачки в БД"))
+
+
+# Ошибки соединения с БД: пачка не записана и будет повторена позже
+RETRYABLE_ERRORS = (OSError, PoolExhaustedError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError,
+                    asyncpg.CannotConnectNowError, asyncpg.TooManyConnectionsError)
+
+
+RESERVE_IDS_QUERY = """
+INSERT INTO pereval_ingest_status (id, state)
+SELECT nextval('pereval_id_seq'), 'queued' FROM generate_series(1, $1)
+RETURNING id
+"""
+# $1 - id; сохранённая запись - persisted, иначе состояние из pereval_ingest_status
+INGEST_STATUS_QUERY = """
+SELECT CASE WHEN a.id IS NOT NULL THEN 'persisted' ELSE s.state END AS state,
+       CASE WHEN a.id IS NULL THEN s.error END AS error
+FROM (SELECT 1) AS one
+LEFT JOIN pereval_added a ON a.id = $1
+LEFT JOIN pereval_ingest_status s ON s.id = $1
+"""
+
+
+class QueueFullError(Exception):
+    """Очередь заполнена дольше допустимого ожидания: клиенту нужно повторить позже"""
+    pass
+
+
+def validate_images(pereval: PerevalData):
+    """Проверить base64 изображений до постановки в очередь (ValueError при ошибке)"""
+    for image in payload_images(pereval):
+        for _ in iter_base64_chunks(image.data):
+            pass
+
+
+class SpillLog:
+    """
+    Журнал принятых, но ещё не записанных в БД перевалов
+
+    Строка журнала - JSON {"id": ..., "data": ..., "key": ...} (key -
+    Idempotency-Key, если передан). Активный сегмент заблокирован flock,
+    пока процесс жив.
+    """
+
+    def __init__(self, directory: str, fsync: bool):
+        self.directory = directory
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self._prefix = f"segment-{os.getpid()}-{int(time.time() * 1000)}-"
+        self._number = 0
+        self._file = None
+        # номер сегмента -> (файл, незакоммиченных записей)
+        self._segments: Dict[int, list] = {}
+        self._sync_waiters: List[asyncio.Future] = []
+        self._sync_task: Optional[asyncio.Task] = None
+        self.rotate()
+
+    def _path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{self._prefix}{number:08d}.ndjson")
+
+    def rotate(self):
+        """Начать новый сегмент; прежний удалится, когда его записи будут закоммичены"""
+        previous = self._number if self._file is not None else None
+        self._number += 1
+        self._file = open(self._path(self._number), 'ab')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segments[self._number] = [self._file, 0]
+        if previous is not None:
+            self._release(previous)
+
+    def append(self, pereval_id: int, data: Dict[str, Any], key: Optional[str] = None) -> int:
+        """Дописать запись (и её ключ Idempotency-Key); возвращает номер сегмента"""
+        record = {"id": pereval_id, "data": data}
+        if key is not None:
+            record["key"] = key
+        self._file.write(orjson.dumps(record) + b'\n')
+        self._file.flush()
+        self._segments[self._number][1] += 1
+        return self._number
+
+    async def sync(self):
+        """Дождаться fsync журнала (один fsync на всех, кто ждёт одновременно)"""
+        if not self.fsync:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._sync_waiters.append(future)
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.get_running_loop().create_task(self._sync_loop())
+        await future
+
+    async def _sync_loop(self):
+        loop = asyncio.get_running_loop()
+        while self._sync_waiters:
+            waiters, self._sync_waiters = self._sync_waiters, []
+            try:
+                fds = [segment[0].fileno() for segment in self._segments.values()]
+                await loop.run_in_executor(None, lambda: [os.fsync(fd) for fd in fds])
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def committed(self, segment: int, count: int = 1):
+        """Записи сегмента закоммичены в БД"""
+        item = self._segments.get(segment)
+        if item is None:
+            return
+        item[1] -= count
+        if segment != self._number:
+            self._release(segment)
+
+    def _release(self, segment: int):
+        item = self._segments.get(segment)
+        if item is None or item[1] > 0:
+            return
+        del self._segments[segment]
+        os.unlink(self._path(segment))
+        item[0].close()
+
+    def close(self, drained: bool):
+        """Закрыть журнал; если очередь записана полностью, удалить сегменты"""
+        for number, (file, pending) in list(self._segments.items()):
+            if drained or pending == 0:
+                os.unlink(self._path(number))
+            file.close()
+        self._segments = {}
+        self._file = None
+
+    @staticmethod
+    def orphans(directory: str) -> List[Tuple[str, Any]]:
+        """
+        Сегменты завершившихся процессов: пары (путь, открытый файл под flock)
+        Файлы живых процессов заблокированы и пропускаются
+        """
+        result = []
+        if not os.path.isdir(directory):
+            return result
+        for name in sorted(os.listdir(directory)):
+            if not (name.startswith('segment-') and name.endswith('.ndjson')):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            if not os.path.exists(path):
+                # сегмент уже восстановил и удалил другой процесс
+                file.close()
+                continue
+            result.append((path, file))
+        return result
+
+
+class IngestQueue:
+    """Очередь отложенной записи перевалов с групповым коммитом"""
+
+    def __init__(self, db_manager, max_size: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 0.05, id_block: int = 100, enqueue_timeout: float = 1.0,
+                 spill_dir: Optional[str] = None, durability: str = 'os', retry_delay: float = 1.0,
+                 status_entries: int = 100000):
+        self.db = db_manager
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block = id_block
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_delay = retry_delay
+        self.spill_dir = spill_dir if durability != 'none' else None
+        self.durability = durability
+        self.spill: Optional[SpillLog] = None
+        # (id, перевал, сегмент журнала, хэш содержимого, Idempotency-Key, возможные дубликаты)
+        self._queue: Deque[Tuple[int, PerevalData, Optional[int], Optional[bytes], Optional[str],
+                                 Optional[list]]] = deque()
+        self._ids: Deque[int] = deque()
+        self._ids_lock = asyncio.Lock()
+        self._space = asyncio.Condition()
+        self._ready = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._closing = False
+        self._submitting = 0
+        self._flushing = False
+        # состояния последних записей: id -> (состояние, ошибка); самые старые вытесняются
+        self._status: "OrderedDict[int, Tuple[str, Optional[str]]]" = OrderedDict()
+        self._status_entries = status_entries
+        queue_depth.callback = lambda: {(): len(self._queue)}
+
+    @classmethod
+    def from_env(cls, db_manager) -> "IngestQueue":
+        return cls(
+            db_manager,
+            max_size=int(os.getenv('FSTR_INGEST_QUEUE_SIZE', '10000')),
+            batch_size=int(os.getenv('FSTR_INGEST_BATCH', '500')),
+            flush_interval=float(os.getenv('FSTR_INGEST_FLUSH_MS', '50')) / 1000,
+            id_block=int(os.getenv('FSTR_INGEST_ID_BLOCK', '100')),
+            enqueue_timeout=float(os.getenv('FSTR_INGEST_ENQUEUE_TIMEOUT', '1')),
+            spill_dir=os.getenv('FSTR_INGEST_SPILL_DIR') or None,
+            durability=os.getenv('FSTR_INGEST_DURABILITY', 'os'),
+        )
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def start(self):
+        """Дописать в БД сегменты журнала упавших процессов и запустить запись очереди"""
+        if self.spill_dir:
+            # журнал открывается здесь, а не в конструкторе: после fork у каждого процесса свой
+            self.spill = SpillLog(self.spill_dir, fsync=self.durability == 'fsync')
+            await self.recover(self.spill_dir)
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def recover(self, directory: str) -> int:
+        """Записать в БД перевалы из сегментов журнала завершившихся процессов"""
+        recovered = 0
+        for path, file in SpillLog.orphans(directory):
+            try:
+                records = {}
+                for line in file:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # строка, недописанная при падении
+                        continue
+                    records[record["id"]] = (PerevalData.model_validate(record["data"]), record.get("key"))
+                existing = await self.db.existing_ids(list(records))
+                missing = [pereval_id for pereval_id in records if pereval_id not in existing]
+                persisted = [pereval_id for pereval_id in records if pereval_id in existing]
+                failed = []
+                for pos in range(0, len(missing), self.batch_size):
+                    ids = missing[pos:pos + self.batch_size]
+                    perevals = [records[pereval_id][0] for pereval_id in ids]
+                    saved_ids = await self.db.add_perevals(
+                        perevals, ids=ids, content_hashes=[payload_hash(pereval) for pereval in perevals],
+                        keys=[records[pereval_id][1] for pereval_id in ids]
+                    )
+                    for pereval_id, saved_id in zip(ids, saved_ids):
+                        if saved_id == pereval_id:
+                            persisted.append(pereval_id)
+                            recovered += 1
+                        else:
+                            # такие же данные уже сохранены под другим id - как при записи очереди
+                            failed.append((pereval_id, f"Дубликат записи {saved_id}"))
+                            ingest_records.inc("duplicate")
+                await self.db.save_ingest_states(persisted, failed)
+                os.unlink(path)
+            except Exception as e:
+                print(f"Ошибка при восстановлении очереди из {path}: {e}")
+            finally:
+                file.close()
+        if recovered:
+            print(f"Восстановлено из журнала очереди перевалов: {recovered}")
+        return recovered
+
+    async def _next_id(self) -> int:
+        if not self._ids:
+            async with self._ids_lock:
+                if not self._ids:
+                    self._ids.extend(await self.db.reserve_ids(self.id_block))
+        return self._ids.popleft()
+
+    async def submit(self, pereval: PerevalData, content_hash: Optional[bytes] = None,
+                     idempotency_key: Optional[str] = None, duplicates: Optional[list] = None) -> int:
+        """
+        Принять перевал в очередь; возвращает выданный id
+        content_hash и idempotency_key сохраняются вместе с записью (app.idempotency),
+        duplicates - возможные дубликаты (app.duplicates; в журнал не пишутся)
+        Если очередь заполнена дольше enqueue_timeout, QueueFullError
+        """
+        if self._closing:
+            raise QueueFullError("Сервер завершает работу")
+
+        def has_space():
+            # места считаются вместе с запросами, которые ещё получают id или ждут fsync
+            return len(self._queue) + self._submitting < self.max_size
+
+        if not has_space():
+            async with self._space:
+                try:
+                    await asyncio.wait_for(self._space.wait_for(has_space), self.enqueue_timeout)
+                except asyncio.TimeoutError:
+                    ingest_records.inc("rejected")
+                    raise QueueFullError(
+                        f"Очередь записи заполнена ({self.max_size}), повторите запрос позже"
+                    )
+
+        self._submitting += 1
+        try:
+            pereval_id = await self._next_id()
+            segment = None
+            if self.spill is not None:
+                segment = self.spill.append(pereval_id, pereval.model_dump(mode="json"), idempotency_key)
+                await self.spill.sync()
+        finally:
+            self._submitting -= 1
+
+        self._queue.append((pereval_id, pereval, segment, content_hash, idempotency_key, duplicates))
+        self._set_status(pereval_id, QUEUED)
+        ingest_records.inc("queued")
+        self._ready.set()
+        if len(self._queue) >= self.batch_size:
+            self._batch_full.set()
+        return pereval_id
+
+    def _set_status(self, pereval_id: int, state: str, error: Optional[str] = None):
+        self._status[pereval_id] = (state, error)
+        self._status.move_to_end(pereval_id)
+        while len(self._status) > self._status_entries:
+            self._status.popitem(last=False)
+
+    def status(self, pereval_id: int) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Состояние записи, принятой этим процессом: (состояние, ошибка) или None
+        Записи других процессов - в pereval_ingest_status (get_ingest_status)
+        """
+        return self._status.get(pereval_id)
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            if not self._queue:
+                self._ready.clear()
+                continue
+            if len(self._queue) < self.batch_size and not self._closing:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._flushing = True
+            try:
+                await self.flush()
+            except Exception as e:
+                # задача записи не должна завершаться: иначе очередь только копится
+                print(f"Ошибка при записи очереди перевалов, повтор через {self.retry_delay} с: {e}")
+                await asyncio.sleep(self.retry_delay)
+            finally:
+                self._flushing = False
+
+    async def flush(self):
+        """Записать в БД одну пачку из начала очереди"""
+        batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        self._batch_full.clear()
+        if len(self._queue) >= self.batch_size:
+            self._batch_full.set()
+        if not batch:
+            return
+        if self.spill is not None:
+            # записи, принятые во время записи пачки, попадут в новый сегмент
+            try:
+                self.spill.rotate()
+            except OSError:
+                self._queue.extendleft(reversed(batch))
+                raise
+
+        started = time.perf_counter()
+        failed: List[Tuple[int, str]] = []
+        try:
+            done = await self._write(batch)
+        except RETRYABLE_ERRORS as e:
+            # БД недоступна: пачка возвращается в начало очереди и повторяется позже
+            print(f"Ошибка при записи очереди перевалов, повтор через {self.retry_delay} с: {e}")
+            self._queue.extendleft(reversed(batch))
+            await asyncio.sleep(self.retry_delay)
+            return
+        except Exception as e:
+            # ошибка в данных: записи пишутся по одной, чтобы найти виноватую
+            print(f"Ошибка при записи пачки перевалов, запись по одной: {e}")
+            done = []
+            failed = []
+            for pos, item in enumerate(batch):
+                try:
+                    done.extend(await self._write([item]))
+                except RETRYABLE_ERRORS as item_error:
+                    # БД стала недоступна: незаписанные записи возвращаются в очередь
+                    # вместе с сегментами журнала
+                    print(f"Ошибка при записи очереди перевалов, повтор через {self.retry_delay} с: {item_error}")
+                    self._queue.extendleft(reversed(batch[pos:]))
+                    await asyncio.sleep(self.retry_delay)
+                    break
+                except Exception as item_error:
+                    failed.append((item[0], str(item_error)))
+                    self._set_status(item[0], FAILED, str(item_error))
+                    ingest_records.inc("failed")
+                    if item[2] is not None:
+                        self.spill.committed(item[2])
+        finally:
+            flush_duration.observe(time.perf_counter() - started)
+            flush_size.observe(len(batch))
+
+        persisted = []
+        for (pereval_id, _, segment, _, _, _), saved_id in done:
+            if saved_id == pereval_id:
+                self._set_status(pereval_id, PERSISTED)
+                persisted.append(pereval_id)
+            else:
+                # такие же данные уже сохранены: отправлены через другой процесс раньше, чем попали в БД
+                failed.append((pereval_id, f"Дубликат записи {saved_id}"))
+                self._set_status(pereval_id, FAILED, failed[-1][1])
+                ingest_records.inc("duplicate")
+            if segment is not None:
+                self.spill.committed(segment)
+        ingest_records.inc("persisted", amount=len(persisted))
+        if persisted or failed:
+            try:
+                await self.db.save_ingest_states(persisted, failed)
+            except Exception as e:
+                # сохранённые записи видны и так; не видно только состояние failed
+                print(f"Ошибка при сохранении состояния записей очереди: {e}")
+        async with self._space:
+            self._space.notify_all()
+
+    async def _write(self, items) -> List[Tuple[tuple, int]]:
+        """Записать элементы очереди; пары (элемент, id сохранённой записи)"""
+        ids = await self.db.add_perevals(
+            [item[1] for item in items], ids=[item[0] for item in items],
+            content_hashes=[item[3] for item in items], keys=[item[4] for item in items],
+            duplicates=[item[5] for item in items]
+        )
+        return list(zip(items, ids))
+
+    async def close(self, timeout: float = 30.0):
+        """Перестать принимать записи и дописать очередь в БД (не дольше timeout)"""
+        self._closing = True
+        self._ready.set()
+        deadline = time.monotonic() + timeout
+        while (self._queue or self._flushing) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        if self._worker is not None:
+            self._worker.cancel()
+        if self.spill is not None:
+            self.spill.close(drained=not self._queue)
+        if self._ids:
+            # неиспользованные id не должны оставаться в состоянии queued
+            try:
+                await self.db.save_ingest_states(list(self._ids), [])
+            except Exception as e:
+                print(f"Ошибка при освобождении зарезервированных id: {e}")
+            self._ids.clear()
+        if self._queue:
+            print(f"Очередь перевалов записана не полностью: {len(self._queue)} записей "
+                  f"остались в журнале и будут записаны при следующем запуске")
@@ -1,24 +1,574 @@
-from fastapi import FastAPI, HTTPException, Query
-from app.models import PerevalData
-from app.database import DatabaseManager
-from typing import Dict, Any
+import asyncio
+import gc
+import json
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime
+from fastapi import Body, Depends, FastAPI, File, Form, Header, HTTPException, Query, Request, UploadFile
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import ValidationError
+from app.models import PerevalBase, PerevalData, PerevalPatch
+from app.admission import (ADMISSION_ENABLED, RATE_BURST, RATE_LIMIT, SUBMIT_RATE_BURST, SUBMIT_RATE_LIMIT,
+                           AdmissionController, AdmissionMiddleware, RateLimitedError, TokenBuckets, retry_after)
+from app.async_database import AsyncDatabaseManager
+from app.areas import AreaTree
+from app.cache import Cache, LRUTTLCache
+from app.changes import CHANGES_TTL, ChangeToken, ChangeTokenExpiredError, token_scope
+from app.database import PoolExhaustedError, VersionConflictError
+from app.duplicates import Candidate, DuplicateIndex
+from app.geo import KDTree, SpatialIndex, cells_for_bbox, parse_coord
+from app.search import SuggestTrie, normalize
+from app.serialization import FastJSONResponse, body_openapi, dumps, json_body, passthrough_row
+from app import metrics
+from app.export import EXPORT_BATCH_SIZE, EXPORT_FORMATS, check_format, export_chunks, local_time, prefetch
+from app.idempotency import IdempotencyKeyConflictError, SubmissionRegistry, check_key, payload_hash
+from app.ingest import INGEST_MODE, INGEST_STATUS_TTL, PERSISTED, IngestQueue, QueueFullError, validate_images
+from app.image_store import IMAGE_GC_GRACE, is_image_hash
+from app.images import ImageFileResponse, etag_matches, guess_image_type, iter_upload_chunks, parse_range
+from app.replicas import READ_YOUR_WRITES_SECONDS, ReadYourWritesMiddleware
+from app.stats import CONTRIBUTORS_MAX_LIMIT, STATS_RECONCILE_INTERVAL, StatsReader, area_bounds, ranked
+from app.thumbnails import BadImageError, ThumbnailCache, make_thumbnail
+from typing import Dict, Any, AsyncIterator, List, Literal, Optional
 
-app = FastAPI(title="Pereval API", description="API для добавления перевалов")
-db_manager = DatabaseManager()
+db_manager = AsyncDatabaseManager()
+thumbnail_cache = ThumbnailCache(
+    os.getenv('FSTR_THUMB_DIR', os.path.join(tempfile.gettempdir(), 'pereval_thumbs')),
+    int(os.getenv('FSTR_THUMB_CACHE_BYTES', str(256 * 1024 * 1024)))
+)
+_thumbnail_locks: Dict[str, asyncio.Lock] = {}
+IMAGE_CACHE_CONTROL = "public, max-age=86400"
+IMAGE_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_GC_INTERVAL = 3600
+CHANGES_PURGE_INTERVAL = 3600
+BATCH_MAX_ITEMS = int(os.getenv('FSTR_BATCH_MAX_ITEMS', '1000'))
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+MERGE_PATCH_MEDIA_TYPE = "application/merge-patch+json"
+spatial_index = SpatialIndex()
+suggest_trie = SuggestTrie()
+_suggest_pending: Optional[list] = None
+_suggest_ready = False
+area_tree = AreaTree()
+# возможные дубликаты при добавлении, см. app.duplicates
+duplicate_index = DuplicateIndex()
+_duplicates_pending: Optional[list] = None
+pereval_cache: Cache = LRUTTLCache(
+    max_entries=int(os.getenv('FSTR_CACHE_MAX_ENTRIES', '10000')),
+    ttl=float(os.getenv('FSTR_CACHE_TTL', '60'))
+)
+# растёт при каждой инвалидации: ответ, прочитанный из БД до неё, в кэш не кладётся
+_cache_epoch = 0
+_background_tasks: set = set()
+# id записей из NOTIFY pereval_changed, ещё не применённые к кэшу и индексам
+_changed_ids: set = set()
+_changed = asyncio.Event()
+CHANGES_CHUNK = 1000
+# очередь отложенной записи (FSTR_INGEST_MODE=queue), см. app.ingest
+ingest_queue: Optional[IngestQueue] = IngestQueue.from_env(db_manager) if INGEST_MODE == 'queue' else None
+# недавние отправки для Idempotency-Key и отсева повторов, см. app.idempotency
+submissions = SubmissionRegistry(db_manager)
+IDEMPOTENCY_PURGE_INTERVAL = 3600
+# счётчики статистики, см. app.stats
+stats = StatsReader(db_manager)
+# контроль допуска и частота запросов клиентов, см. app.admission
+admission = AdmissionController.from_env()
+client_rate = TokenBuckets(RATE_LIMIT, RATE_BURST)
+submit_rate = TokenBuckets(SUBMIT_RATE_LIMIT, SUBMIT_RATE_BURST)
+IDEMPOTENCY_KEY_HEADER = Header(None, description="Ключ повтора запроса (например, UUID): "
+                                                  "повтор с тем же ключом вернёт id первой записи")
 
 
-@app.post("/submitData")
-async def submit_data(pereval: PerevalData) -> Dict[str, Any]:
+def _spawn(coro):
+    """Запустить фоновую задачу, сохранив ссылку на неё до завершения"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _load_spatial_index():
+    spatial_index.begin_load()
+    try:
+        points = await db_manager.get_all_coords()
+        tree = await asyncio.to_thread(KDTree, points)
+        spatial_index.load(points, tree)
+    except Exception as e:
+        spatial_index.abort_rebuild()
+        print(f"Ошибка при построении геоиндекса: {e}")
+
+
+async def _load_suggest_trie():
+    global suggest_trie, _suggest_pending, _suggest_ready
+    # изменения, пришедшие во время загрузки, применяются к новому дереву после неё
+    _suggest_pending = []
+    try:
+        rows = await db_manager.get_all_titles()
+        trie = SuggestTrie()
+        await asyncio.to_thread(trie.load, rows)
+        for pereval_id, fields in _suggest_pending:
+            if fields is None:
+                trie.remove(pereval_id)
+            else:
+                trie.upsert(pereval_id, fields['title'], fields['other_titles'])
+        suggest_trie = trie
+        _suggest_ready = True
+    except Exception as e:
+        print(f"Ошибка при построении дерева подсказок: {e}")
+    finally:
+        _suggest_pending = None
+
+
+async def _load_duplicate_index():
+    global duplicate_index, _duplicates_pending
+    # изменения, пришедшие во время загрузки, применяются к новому индексу после неё
+    _duplicates_pending = []
+    try:
+        rows = await db_manager.get_duplicate_fields()
+        index = DuplicateIndex()
+        await asyncio.to_thread(index.load, rows)
+        for pereval_id, fields in _duplicates_pending:
+            if fields is None:
+                index.remove(pereval_id)
+            else:
+                index.upsert(pereval_id, fields['latitude'], fields['longitude'],
+                             fields['title'], fields['other_titles'])
+        duplicate_index = index
+    except Exception as e:
+        print(f"Ошибка при построении индекса дубликатов: {e}")
+    finally:
+        _duplicates_pending = None
+
+
+async def _load_indexes():
+    await asyncio.gather(_load_spatial_index(), _load_suggest_trie(), _load_duplicate_index())
+    # миллионы объектов индексов не должны просматриваться сборщиком циклов
+    # на каждом полном проходе: иначе запросы получают паузы в десятки мс.
+    # Замораживаем один раз после запуска: повторная заморозка после каждой
+    # перестройки оставляла бы в памяти навсегда и старые версии индексов
+    gc.freeze()
+
+
+def _find_duplicates(pereval: PerevalBase) -> List[Candidate]:
+    """Возможные дубликаты добавляемого перевала (пока индекс строится - пусто)"""
+    return duplicate_index.find(parse_coord(pereval.coords.latitude), parse_coord(pereval.coords.longitude),
+                                pereval.title, pereval.other_titles)
+
+
+async def _rebuild_spatial_index():
+    points = spatial_index.snapshot()
+    try:
+        tree = await asyncio.to_thread(KDTree, points)
+        spatial_index.swap(tree)
+    except Exception as e:
+        spatial_index.abort_rebuild()
+        print(f"Ошибка при перестройке геоиндекса: {e}")
+
+
+async def _invalidate_pereval(pereval_id: int):
+    global _cache_epoch
+    _cache_epoch += 1
+    await pereval_cache.delete(pereval_id)
+
+
+async def _refresh_perevals(ids: List[int]):
+    """Обновить кэш и индексы в памяти после изменения записей; записей, которых нет, - удалить"""
+    for pereval_id in ids:
+        db_manager.note_change(pereval_id)
+        await _invalidate_pereval(pereval_id)
+    rows = await db_manager.get_index_fields(ids)
+    for pereval_id in ids:
+        fields = rows.get(pereval_id)
+        if fields is None or fields['content_hash'] is None:
+            # запись удалена или изменена: повтор исходной отправки - новая запись
+            await submissions.forget(pereval_id)
+        if fields is None:
+            spatial_index.remove(pereval_id)
+            suggest_trie.remove(pereval_id)
+            duplicate_index.remove(pereval_id)
+        else:
+            spatial_index.upsert(pereval_id, fields['latitude'], fields['longitude'])
+            suggest_trie.upsert(pereval_id, fields['title'], fields['other_titles'])
+            duplicate_index.upsert(pereval_id, fields['latitude'], fields['longitude'],
+                                   fields['title'], fields['other_titles'])
+        if _suggest_pending is not None:
+            _suggest_pending.append((pereval_id, fields))
+        if _duplicates_pending is not None:
+            _duplicates_pending.append((pereval_id, fields))
+    if spatial_index.ready and spatial_index.needs_rebuild:
+        _spawn(_rebuild_spatial_index())
+
+
+async def _apply_changes():
+    """
+    Применять изменения записей (NOTIFY pereval_changed) к кэшу и индексам
+
+    Уведомления только добавляют id в _changed_ids, а эта задача забирает
+    их пачками по CHANGES_CHUNK и читает поля одним запросом: массовое
+    изменение строк занимает одно соединение пула, а не по соединению на
+    строку. Повторное изменение записи во время чтения вернёт её id
+    в множество, и последней применится последняя версия.
+    """
+    while True:
+        await _changed.wait()
+        _changed.clear()
+        while _changed_ids:
+            ids = [_changed_ids.pop() for _ in range(min(len(_changed_ids), CHANGES_CHUNK))]
+            try:
+                await _refresh_perevals(ids)
+            except Exception as e:
+                print(f"Ошибка при обновлении индексов после изменения записей: {e}")
+                _changed_ids.update(ids)
+                await asyncio.sleep(1)
+
+
+async def _load_areas():
+    global area_tree
+    try:
+        area_tree = AreaTree(await db_manager.get_areas())
+    except PoolExhaustedError:
+        raise
+    except Exception as e:
+        print(f"Ошибка при загрузке районов: {e}")
+
+
+async def _purge_idempotency_keys():
+    """Раз в час удалять устаревшие ключи Idempotency-Key"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL)
+        try:
+            await db_manager.purge_idempotency_keys()
+        except Exception as e:
+            print(f"Ошибка при удалении устаревших ключей Idempotency-Key: {e}")
+
+
+async def _collect_images():
+    """Раз в час удалять изображения, на которые давно нет ссылок (app.image_store)"""
+    while True:
+        await asyncio.sleep(IMAGE_GC_INTERVAL)
+        try:
+            await db_manager.collect_images(IMAGE_GC_GRACE)
+        except Exception as e:
+            print(f"Ошибка при удалении изображений без ссылок: {e}")
+
+
+async def _purge_deleted():
+    """Раз в час забывать удалённые записи старше FSTR_CHANGES_TTL (app.changes)"""
+    while True:
+        await asyncio.sleep(CHANGES_PURGE_INTERVAL)
+        try:
+            await db_manager.purge_deleted(CHANGES_TTL)
+        except Exception as e:
+            print(f"Ошибка при удалении устаревших записей об удалении: {e}")
+
+
+async def _purge_ingest_status():
+    """Раз в час удалять устаревшие состояния записей очереди (app.ingest)"""
+    while True:
+        await asyncio.sleep(CHANGES_PURGE_INTERVAL)
+        try:
+            await db_manager.purge_ingest_status(INGEST_STATUS_TTL)
+        except Exception as e:
+            print(f"Ошибка при удалении устаревших состояний записей очереди: {e}")
+
+
+async def _reconcile_stats():
+    """Периодически сверять счётчики статистики с данными (app.stats)"""
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            fixed = await db_manager.reconcile_stats()
+            if fixed:
+                print(f"Сверка статистики: исправлено счётчиков: {fixed}")
+        except Exception as e:
+            print(f"Ошибка при сверке статистики: {e}")
+
+
+def _on_areas_changed(payload: str):
+    _spawn(_load_areas())
+
+
+def _on_pereval_changed(payload: str):
+    _changed_ids.add(json.loads(payload)['id'])
+    _changed.set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db_manager.connect()
+    _spawn(_apply_changes())
+    await db_manager.listen('pereval_changed', _on_pereval_changed)
+    await db_manager.listen('pereval_areas_changed', _on_areas_changed)
+    _spawn(_load_indexes())
+    await _load_areas()
+    _spawn(_purge_idempotency_keys())
+    _spawn(_collect_images())
+    _spawn(_reconcile_stats())
+    _spawn(_purge_deleted())
+    if ingest_queue is not None:
+        await ingest_queue.start()
+        _spawn(_purge_ingest_status())
+    yield
+    if ingest_queue is not None:
+        await ingest_queue.close()
+    for task in list(_background_tasks):
+        task.cancel()
+    await db_manager.close()
+
+
+app = FastAPI(
+    title="Pereval API",
+    description="API для добавления перевалов",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
+)
+if db_manager.replicas and READ_YOUR_WRITES_SECONDS > 0:
+    app.add_middleware(ReadYourWritesMiddleware, seconds=READ_YOUR_WRITES_SECONDS)
+if ADMISSION_ENABLED:
+    app.add_middleware(AdmissionMiddleware, controller=admission, clients=client_rate)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.db_pool.callback = lambda: {(state,): value for state, value in db_manager.pool_stats().items()}
+metrics.db_replica_lag.callback = lambda: {
+    (replica['name'],): replica['lag'] for replica in db_manager.replica_stats() if replica['lag'] is not None
+}
+metrics.admission_requests.callback = lambda: {
+    (name, state): value for name, counts in admission.stats().items() for state, value in counts.items()
+}
+metrics.db_replica_available.callback = lambda: {
+    (replica['name'],): int(replica['healthy']) for replica in db_manager.replica_stats()
+}
+
+
+@app.exception_handler(PoolExhaustedError)
+async def pool_exhausted_handler(request: Request, exc: PoolExhaustedError):
+    metrics.db_pool_exhausted.inc()
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"}
+    )
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"}
+    )
+
+
+@app.exception_handler(RateLimitedError)
+async def rate_limited_handler(request: Request, exc: RateLimitedError):
+    route_class = admission.classify(request.scope)
+    metrics.admission_shed.inc(route_class.name if route_class else 'unmatched', 'rate_limit_email')
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": retry_after(exc.retry_after)}
+    )
+
+
+@app.exception_handler(IdempotencyKeyConflictError)
+async def idempotency_conflict_handler(request: Request, exc: IdempotencyKeyConflictError):
+    return JSONResponse(status_code=422, content={"status": 422, "message": str(exc), "id": None})
+
+
+def _replayed(pereval_id: int) -> Response:
+    """Ответ на повтор уже принятой отправки: id первой записи, ничего не записано"""
+    return FastJSONResponse({"status": 200, "message": None, "id": pereval_id},
+                            headers={"Idempotent-Replayed": "true"})
+
+
+@app.exception_handler(VersionConflictError)
+async def version_conflict_handler(request: Request, exc: VersionConflictError):
+    return JSONResponse(
+        status_code=412,
+        content={"state": 0, "message": str(exc), "version": exc.version},
+        headers={"ETag": pereval_etag(exc.version)}
+    )
+
+
+@app.post("/submitData", openapi_extra=body_openapi(PerevalData))
+async def submit_data(
+        pereval: PerevalData = Depends(json_body(PerevalData)),
+        idempotency_key: Optional[str] = IDEMPOTENCY_KEY_HEADER
+) -> Dict[str, Any]:
     """
     Метод для добавления нового перевала
 
     Принимает JSON с данными о перевале
     Возвращает JSON с результатом операции
+
+    Повтор запроса с тем же заголовком Idempotency-Key, как и повторная
+    отправка тех же данных тем же пользователем, новой записи не создаёт:
+    возвращается id первой (с заголовком Idempotent-Replayed: true).
+
+    В режиме очереди (FSTR_INGEST_MODE=queue) запись сохраняется позже,
+    ответ - 202 с выданным id; сохранение проверяется
+    через GET /submitData/{id}/status
+
+    Частота отправок одного пользователя ограничена (FSTR_SUBMIT_RATE_LIMIT),
+    при превышении - 429 с Retry-After
+
+    Похожие записи поблизости (возможные дубликаты) сохраняются вместе
+    с новой, см. GET /submitData/{id}/duplicates
     """
     try:
-        pereval_dict = pereval.dict()
+        idempotency_key = check_key(idempotency_key)
+        if ingest_queue is not None:
+            validate_images(pereval)
+    except ValueError as e:
+        return FastJSONResponse({"status": 400, "message": str(e), "id": None}, status_code=400)
 
-        pereval_id = db_manager.add_pereval(pereval_dict)
+    content_hash = payload_hash(pereval)
+    existing = await submissions.find(content_hash, idempotency_key, content_hash)
+    if existing is not None:
+        return _replayed(existing)
+    submit_rate.check(pereval.user.email)
+    duplicates = _find_duplicates(pereval)
+
+    if ingest_queue is not None:
+        pereval_id = await ingest_queue.submit(pereval, content_hash, idempotency_key, duplicates)
+        await submissions.remember(pereval_id, content_hash, idempotency_key, content_hash)
+        return FastJSONResponse({
+            "status": 202,
+            "message": "Принято в очередь на сохранение",
+            "id": pereval_id
+        }, status_code=202)
+
+    try:
+        pereval_id = await db_manager.add_pereval(pereval, content_hash=content_hash,
+                                                  idempotency_key=idempotency_key, duplicates=duplicates)
+
+        if pereval_id is None:
+            return {
+                "status": 500,
+                "message": "Ошибка при сохранении данных в базу данных",
+                "id": None
+            }
+
+        await submissions.remember(pereval_id, content_hash, idempotency_key, content_hash)
+        return FastJSONResponse({
+            "status": 200,
+            "message": None,
+            "id": pereval_id
+        })
+
+    except (PoolExhaustedError, IdempotencyKeyConflictError):
+        raise
+    except Exception as e:
+        return {
+            "status": 500,
+            "message": f"Внутренняя ошибка сервера: {str(e)}",
+            "id": None
+        }
+
+
+@app.post("/submitData/batch")
+async def submit_data_batch(
+        items: List[Any] = Body(..., description="Массив перевалов в формате /submitData")
+) -> Dict[str, Any]:
+    """
+    Метод для пакетного добавления перевалов (синхронизация офлайн-клиентов)
+
+    Все корректные записи сохраняются одной транзакцией.
+    Возвращает результат по каждой записи в порядке входного массива:
+    id сохранённой записи или ошибки валидации. Уже сохранённые данные
+    (повтор пакета или записи) не пишутся повторно, для них возвращается
+    id существующей записи.
+    """
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком много записей в пакете (максимум {BATCH_MAX_ITEMS})"
+        )
+
+    results: List[Dict[str, Any]] = []
+    valid = []
+    for item in items:
+        try:
+            pereval = PerevalData.model_validate(item)
+        except ValidationError as e:
+            results.append({
+                "status": 422,
+                "message": [
+                    {"loc": err["loc"], "msg": err["msg"], "type": err["type"]}
+                    for err in e.errors()
+                ],
+                "id": None
+            })
+            continue
+        valid.append((len(results), pereval))
+        results.append({"status": 200, "message": None, "id": None})
+
+    try:
+        ids = await db_manager.add_perevals([pereval for _, pereval in valid],
+                                            content_hashes=[payload_hash(pereval) for _, pereval in valid],
+                                            duplicates=[_find_duplicates(pereval) for _, pereval in valid])
+        for (idx, _), pereval_id in zip(valid, ids):
+            results[idx]["id"] = pereval_id
+    except PoolExhaustedError:
+        raise
+    except Exception as e:
+        print(f"Ошибка при пакетном добавлении перевалов: {e}")
+        for idx, _ in valid:
+            results[idx] = {
+                "status": 500,
+                "message": f"Ошибка при сохранении данных в базу данных: {str(e)}",
+                "id": None
+            }
+
+    return {
+        "status": 200,
+        "count": len(results),
+        "results": results
+    }
+
+
+@app.post("/submitData/multipart")
+async def submit_data_multipart(
+        data: str = Form(..., description="JSON с данными о перевале (без изображений)"),
+        images: List[UploadFile] = File([], description="Файлы изображений"),
+        titles: List[str] = Form([], description="Названия изображений в порядке файлов"),
+        idempotency_key: Optional[str] = IDEMPOTENCY_KEY_HEADER
+) -> Dict[str, Any]:
+    """
+    Метод для добавления нового перевала в формате multipart/form-data
+
+    Изображения передаются файлами и пишутся в БД по частям,
+    без base64 и без загрузки файла в память целиком.
+    Повторы отсекаются только по Idempotency-Key: файлы не читаются
+    заранее, поэтому хэша содержимого у таких записей нет.
+    """
+    try:
+        pereval = PerevalBase.model_validate_json(data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    try:
+        idempotency_key = check_key(idempotency_key)
+    except ValueError as e:
+        return FastJSONResponse({"status": 400, "message": str(e), "id": None}, status_code=400)
+
+    request_hash = payload_hash({"data": pereval.model_dump(mode="json"), "titles": titles})
+    if idempotency_key is not None:
+        existing = await submissions.find(request_hash, idempotency_key)
+        if existing is not None:
+            return _replayed(existing)
+    submit_rate.check(pereval.user.email)
+
+    try:
+        image_sources = []
+        for idx, upload in enumerate(images):
+            title = titles[idx] if idx < len(titles) else (upload.filename or "")
+            image_sources.append((title, iter_upload_chunks(upload)))
+
+        pereval_id = await db_manager.add_pereval(pereval, image_sources=image_sources,
+                                                  idempotency_key=idempotency_key, request_hash=request_hash,
+                                                  duplicates=_find_duplicates(pereval))
 
         if pereval_id is None:
             return {
@@ -27,12 +577,15 @@ async def submit_data(pereval: PerevalData) -> Dict[str, Any]:
                 "id": None
             }
 
+        await submissions.remember(pereval_id, request_hash, idempotency_key)
         return {
             "status": 200,
             "message": None,
             "id": pereval_id
         }
 
+    except (PoolExhaustedError, IdempotencyKeyConflictError):
+        raise
     except Exception as e:
         return {
             "status": 500,
@@ -46,13 +599,49 @@ async def root():
     return {"message": "Pereval API работает!"}
 
 
+def pereval_etag(version: int) -> str:
+    """ETag записи перевала - её версия (меняется при каждом изменении записи)"""
+    return f'"v{version}"'
+
+
+def parse_if_match(header: Optional[str]) -> Optional[List[int]]:
+    """
+    Версии из заголовка If-Match; None - проверять не нужно (нет заголовка или *)
+    If-Match сравнивает ETag строго, поэтому слабые (W/...) и чужие теги
+    не совпадают ни с одной версией
+    """
+    if header is None or header.strip() == '*':
+        return None
+    versions = []
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('"v') and tag.endswith('"') and tag[2:-1].isdigit():
+            versions.append(int(tag[2:-1]))
+    return versions
+
+
+def _cached_response(request: Request, etag: str, body: bytes) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 @app.get("/submitData/{pereval_id}")
-async def get_pereval(pereval_id: int):
+async def get_pereval(pereval_id: int, request: Request):
     """
     Получить информацию о перевале по ID
+
+    Готовый JSON ответа кэшируется и сбрасывается при изменении записи;
+    ETag - версия записи (её же ждёт If-Match в PATCH), на If-None-Match отвечаем 304
     """
     try:
-        pereval = db_manager.get_pereval_by_id(pereval_id)
+        cached = await pereval_cache.get(pereval_id)
+        if cached:
+            return _cached_response(request, *cached)
+
+        epoch = _cache_epoch
+        pereval = await db_manager.get_pereval_by_id(pereval_id)
 
         if not pereval:
             raise HTTPException(
@@ -60,12 +649,14 @@ async def get_pereval(pereval_id: int):
                 detail="Перевал не найден"
             )
 
-        if pereval.get('date_added'):
-            pereval['date_added'] = pereval['date_added'].isoformat()
+        body = dumps(passthrough_row(pereval))
+        etag = pereval_etag(pereval['version'])
+        if epoch == _cache_epoch:
+            await pereval_cache.set(pereval_id, (etag, body))
 
-        return pereval
+        return _cached_response(request, etag, body)
 
-    except HTTPException:
+    except (HTTPException, PoolExhaustedError):
         raise
     except Exception as e:
         raise HTTPException(
@@ -74,45 +665,552 @@ async def get_pereval(pereval_id: int):
         )
 
 
-@app.patch("/submitData/{pereval_id}")
-async def update_pereval(pereval_id: int, pereval_update: PerevalData):
+@app.get("/submitData/{pereval_id}/status")
+async def get_pereval_status(pereval_id: int):
     """
-    Обновить информацию о перевале (только если статус 'new')
+    Сохранена ли запись в БД
+
+    state: queued - в очереди на запись, persisted - сохранена,
+    failed - не удалось сохранить (error - причина). Запись, принятую
+    другим рабочим процессом, ищем в pereval_ingest_status
     """
-    try:
-        update_data = pereval_update.dict()
+    status = ingest_queue.status(pereval_id) if ingest_queue is not None else None
+    if status is not None and status[0] != PERSISTED:
+        return {"id": pereval_id, "state": status[0], "error": status[1]}
+
+    if status is None:
+        status = await db_manager.get_ingest_status(pereval_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Запись не найдена")
+    return {"id": pereval_id, "state": status[0], "error": status[1]}
 
-        success, message = db_manager.update_pereval(pereval_id, update_data)
 
-        if success:
-            return {"state": 1, "message": None}
+@app.get("/submitData/{pereval_id}/duplicates")
+async def get_pereval_duplicates(pereval_id: int):
+    """
+    Возможные дубликаты записи для модерации
+
+    Записи не дальше FSTR_DUPLICATE_RADIUS метров с похожими названиями,
+    найденные при добавлении этой записи, и более поздние записи, для которых
+    похожей оказалась она; similarity - сходство названий (0-1),
+    distance_m - расстояние в метрах
+    """
+    duplicates = await db_manager.get_duplicates(pereval_id)
+    if duplicates is None:
+        raise HTTPException(status_code=404, detail="Запись не найдена")
+    return {"id": pereval_id, "duplicates": duplicates}
+
+
+@app.patch("/submitData/{pereval_id}",
+           openapi_extra=body_openapi(PerevalPatch, media_types=(MERGE_PATCH_MEDIA_TYPE, "application/json")))
+async def update_pereval(
+        pereval_id: int,
+        pereval_update: PerevalPatch = Depends(json_body(PerevalPatch)),
+        if_match: Optional[str] = Header(None, description="ETag записи из GET /submitData/{id}")
+):
+    """
+    Частично обновить информацию о перевале (только если статус 'new')
+
+    Тело - JSON Merge Patch (RFC 7396): только изменяемые поля, вложенные
+    coords и level сливаются по полям; полный PerevalData тоже подходит.
+    Данные пользователя не меняются. С заголовком If-Match запись
+    обновляется, только если её версия не изменилась, иначе 412.
+    """
+    try:
+        version, message = await db_manager.update_pereval(
+            pereval_id, pereval_update, versions=parse_if_match(if_match)
+        )
+
+        if version is not None:
+            await _invalidate_pereval(pereval_id)
+            await submissions.forget(pereval_id)
+            return JSONResponse(
+                content={"state": 1, "message": None, "version": version},
+                headers={"ETag": pereval_etag(version)}
+            )
         else:
             return {"state": 0, "message": message}
 
+    except (PoolExhaustedError, VersionConflictError):
+        raise
     except Exception as e:
         return {"state": 0, "message": f"Ошибка: {str(e)}"}
 
 
+async def _ndjson_lines(rows) -> AsyncIterator[bytes]:
+    async for row in rows:
+        yield dumps(passthrough_row(row)) + b"\n"
+
+
 @app.get("/submitData/")
-async def get_perevals_by_email(user__email: str = Query(..., description="Email пользователя")):
+async def get_perevals_by_email(
+        request: Request,
+        user__email: str = Query(..., description="Email пользователя"),
+        limit: Optional[int] = Query(None, ge=1, le=PAGE_MAX_LIMIT,
+                                     description=f"Записей на странице (по умолчанию {PAGE_DEFAULT_LIMIT})"),
+        after: Optional[int] = Query(None, ge=0, description="Курсор: id последней записи предыдущей страницы")
+):
+    """
+    Получить перевалы, отправленные пользователем с указанным email
+
+    Постраничный вывод по курсору: в ответе поле next, которое нужно
+    передать в after для следующей страницы (null - страниц больше нет).
+    С заголовком Accept: application/x-ndjson записи отдаются потоком
+    по одной на строку (без ограничения limit, если он не задан).
+    """
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _ndjson_lines(db_manager.iter_perevals_by_email(user__email, after=after, limit=limit)),
+            media_type=NDJSON_MEDIA_TYPE
+        )
+
+    try:
+        limit = limit or PAGE_DEFAULT_LIMIT
+        perevals = await db_manager.get_perevals_by_email(user__email, limit=limit + 1, after=after)
+        has_more = len(perevals) > limit
+        perevals = perevals[:limit]
+
+        return FastJSONResponse({
+            "count": len(perevals),
+            "results": [passthrough_row(pereval) for pereval in perevals],
+            "next": perevals[-1]['id'] if has_more else None
+        })
+
+    except PoolExhaustedError:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка сервера: {str(e)}"
+        )
+
+
+async def _get_thumbnail(image_hash: str) -> bytes:
+    """
+    Эскиз из кэша; эскиз строится один раз даже при параллельных запросах
+    Отдаётся содержимое, а не путь: файл может вытеснить другой процесс
+    """
+    key = f"{image_hash}.jpg"
+    thumb = await run_in_threadpool(thumbnail_cache.get, key)
+    if thumb is not None:
+        return thumb
+
+    lock = _thumbnail_locks.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            thumb = await run_in_threadpool(thumbnail_cache.get, key)
+            if thumb is not None:
+                return thumb
+            data = await run_in_threadpool(db_manager.images.read, image_hash)
+            thumb = await run_in_threadpool(make_thumbnail, data)
+            try:
+                await run_in_threadpool(thumbnail_cache.put, key, thumb)
+            except OSError as e:
+                print(f"Ошибка при сохранении эскиза в кэш: {e}")
+            return thumb
+    finally:
+        if not lock.locked():
+            _thumbnail_locks.pop(key, None)
+
+
+@app.get("/changes")
+async def get_changes(
+        since: Optional[str] = Query(None, description="Токен next из предыдущего ответа; "
+                                                       "без него - все записи"),
+        user__email: Optional[str] = Query(None, description="Только записи пользователя с этим email"),
+        limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT, description="Записей на странице")
+):
+    """
+    Лента изменений для синхронизации (офлайн-клиенты)
+
+    Возвращает записи, созданные или изменённые после выдачи токена since
+    (changes, в формате GET /submitData/{id}), и id удалённых записей
+    (deleted). Токен из next передаётся в следующий запрос; пока more = true,
+    изменений больше, чем limit, и следующий запрос стоит сделать сразу.
+    Если изменений нет, ответ короткий: {"unchanged": true, "next": ...}.
+    Запись может прийти повторно - её нужно применять как обновление.
+    Токен старше FSTR_CHANGES_TTL - ответ 410: нужна полная синхронизация
+    (запрос без since).
+    """
+    try:
+        if since:
+            token = ChangeToken.decode(since, user__email)
+        else:
+            token = ChangeToken(token_scope(user__email))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ChangeTokenExpiredError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+
+    xmin, rows = await db_manager.get_changes(user__email, token.floor, token.cursor, limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    last = (rows[-1]['change_xid'], rows[-1]['id']) if more else None
+    next_token = token.advance(xmin, last).encode()
+    if not rows:
+        return FastJSONResponse({"unchanged": True, "next": next_token})
+
+    changes, deleted = [], []
+    for row in rows:
+        if row.pop('deleted'):
+            deleted.append(row['id'])
+        else:
+            del row['change_xid']
+            changes.append(passthrough_row(row))
+    return FastJSONResponse({"changes": changes, "deleted": deleted, "next": next_token, "more": more})
+
+
+@app.get("/images/{image_ref}")
+async def get_image(
+        image_ref: str,
+        request: Request,
+        size: Literal["full", "thumb"] = Query("full", description="full - оригинал, thumb - эскиз")
+):
+    """
+    Получить изображение перевала по sha256 (поле sha256 в images записи)
+
+    Содержимое по хэшу не меняется, поэтому ответ кэшируется клиентами
+    навсегда. Оригинал отдаётся из файла хранилища без чтения в память,
+    поддерживаются Range и If-None-Match. Эскиз (size=thumb) строится один
+    раз и хранится в кэше на диске. Числовой image_ref - id изображения
+    до переноса в хранилище.
+    """
+    image_hash = image_ref.lower()
+    cache_control = IMAGE_IMMUTABLE_CACHE_CONTROL
+    if image_ref.isdigit():
+        image_hash = await db_manager.get_legacy_image_hash(int(image_ref))
+        cache_control = IMAGE_CACHE_CONTROL
+    elif not is_image_hash(image_hash):
+        image_hash = None
+    info = await run_in_threadpool(db_manager.images.stat, image_hash) if image_hash else None
+    if not info:
+        raise HTTPException(status_code=404, detail="Изображение не найдено")
+    total, head = info
+
+    etag = f'"{image_hash}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if size == "thumb":
+        try:
+            thumb = await _get_thumbnail(image_hash)
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Эскизы недоступны: не установлен Pillow")
+        except BadImageError as e:
+            raise HTTPException(status_code=422, detail=f"Не удалось построить эскиз: {str(e)}")
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Изображение не найдено")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
+        return Response(thumb, media_type="image/jpeg", headers=headers)
+
+    start, end = 0, total - 1
+    status_code = 200
+    headers["Accept-Ranges"] = "bytes"
+
+    range_header = request.headers.get("range")
+    if range_header and total > 0:
+        try:
+            requested = parse_range(range_header, total)
+        except ValueError:
+            raise HTTPException(
+                status_code=416,
+                detail="Запрошенный диапазон недоступен",
+                headers={"Content-Range": f"bytes */{total}"}
+            )
+        if requested:
+            start, end = requested
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+
+    media_type = guess_image_type(head)
+    path = db_manager.images.path(image_hash)
+    if path is not None:
+        return ImageFileResponse(path, start, end, status_code=status_code, headers=headers, media_type=media_type)
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iterate_in_threadpool(db_manager.images.iter_range(image_hash, start, end)),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers
+    )
+
+
+@app.get("/perevals/bbox")
+async def get_perevals_in_bbox(
+        min_lat: float = Query(..., ge=-90, le=90, description="Южная граница"),
+        min_lon: float = Query(..., ge=-180, le=180, description="Западная граница"),
+        max_lat: float = Query(..., ge=-90, le=90, description="Северная граница"),
+        max_lon: float = Query(..., ge=-180, le=180, description="Восточная граница"),
+        limit: int = Query(500, ge=1, le=5000, description="Максимум записей")
+):
     """
-    Получить все перевалы, отправленные пользователем с указанным email
+    Перевалы в прямоугольнике координат (для карты)
+
+    Строки отбираются по индексу ячеек сетки geo_cell, затем
+    уточняются по координатам
     """
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=422, detail="Минимальные координаты больше максимальных")
+
     try:
-        perevals = db_manager.get_perevals_by_email(user__email)
+        cells = cells_for_bbox(min_lat, min_lon, max_lat, max_lon)
+        results = await db_manager.get_perevals_in_bbox(min_lat, min_lon, max_lat, max_lon, cells, limit)
+        return {
+            "count": len(results),
+            "results": results
+        }
+    except PoolExhaustedError:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка сервера: {str(e)}"
+        )
+
+
+@app.get("/perevals/nearest")
+async def get_nearest_perevals(
+        lat: float = Query(..., ge=-90, le=90, description="Широта"),
+        lon: float = Query(..., ge=-180, le=180, description="Долгота"),
+        limit: int = Query(20, ge=1, le=100, description="Сколько ближайших перевалов вернуть")
+):
+    """
+    Ближайшие перевалы к точке по расстоянию по поверхности Земли
 
-        # Преобразуем даты в строках
-        for pereval in perevals:
-            if pereval.get('date_added'):
-                pereval['date_added'] = pereval['date_added'].isoformat()
+    Поиск идёт по k-d дереву в памяти процесса, которое обновляется
+    по уведомлениям об изменениях записей
+    """
+    if not spatial_index.ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Геоиндекс ещё строится",
+            headers={"Retry-After": "5"}
+        )
 
+    try:
+        found = spatial_index.nearest(lat, lon, limit)
+        summaries = await db_manager.get_pereval_summaries([pereval_id for _, pereval_id in found])
+        results = []
+        for distance, pereval_id in found:
+            summary = summaries.get(pereval_id)
+            if summary:
+                summary["distance_km"] = round(distance, 3)
+                results.append(summary)
         return {
-            "count": len(perevals),
-            "results": perevals
+            "count": len(results),
+            "results": results
         }
+    except PoolExhaustedError:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка сервера: {str(e)}"
+        )
 
+
+@app.get("/perevals/search")
+async def search_perevals(
+        q: str = Query(..., min_length=2, max_length=200, description="Название или его часть, можно с опечатками"),
+        limit: int = Query(20, ge=1, le=100, description="Максимум записей")
+):
+    """
+    Нечёткий поиск перевалов по названию (title, other_titles, beautyTitle)
+
+    Без учёта регистра и разницы «е»/«ё»; допускает опечатки
+    (сходство по триграммам pg_trgm). Лучшие совпадения - первыми.
+    """
+    query = normalize(q)
+    if len(query) < 2:
+        raise HTTPException(status_code=422, detail="Слишком короткий запрос")
+    try:
+        results = await db_manager.search_perevals(query, limit)
+        for row in results:
+            row["score"] = round(row["score"], 3)
+        return {
+            "count": len(results),
+            "results": results
+        }
+    except PoolExhaustedError:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Ошибка сервера: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+
+@app.get("/perevals/suggest")
+async def suggest_perevals(
+        prefix: str = Query(..., min_length=1, max_length=100, description="Начало названия"),
+        limit: int = Query(10, ge=1, le=50, description="Сколько подсказок вернуть")
+):
+    """
+    Подсказки названий перевалов по началу названия или любого его слова
+
+    Ответ строится по префиксному дереву в памяти процесса, без запросов
+    к БД; count - число перевалов с таким названием
+    """
+    if not _suggest_ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Дерево подсказок ещё строится",
+            headers={"Retry-After": "5"}
+        )
+    results = suggest_trie.suggest(prefix, limit)
+    return {
+        "count": len(results),
+        "results": results
+    }
+
+
+@app.get("/areas")
+async def get_areas():
+    """
+    Все районы в порядке обхода дерева (родитель перед потомками)
+    """
+    return {
+        "count": len(area_tree),
+        "results": area_tree.all()
+    }
+
+
+@app.get("/areas/{area_id}/subtree")
+async def get_area_subtree(area_id: int):
+    """
+    Район и все вложенные в него районы
+    """
+    if area_id not in area_tree:
+        raise HTTPException(status_code=404, detail="Район не найден")
+    results = area_tree.subtree(area_id)
+    return {
+        "count": len(results),
+        "results": results
+    }
+
+
+@app.get("/areas/{area_id}/path")
+async def get_area_path(area_id: int):
+    """
+    Цепочка районов от корня до указанного
+    """
+    if area_id not in area_tree:
+        raise HTTPException(status_code=404, detail="Район не найден")
+    return {"results": area_tree.path(area_id)}
+
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Сводка: всего записей, по статусам и по категориям сложности
+
+    Все /stats/* читают счётчики, которые обновляются при каждом изменении
+    записей, и не зависят от их числа; данные могут отставать на FSTR_STATS_TTL секунд
+    """
+    return {
+        "total": await stats.total(),
+        "status": await stats.counts('status'),
+        "level": await stats.levels()
+    }
+
+
+@app.get("/stats/status")
+async def get_stats_by_status():
+    """
+    Число записей по статусам
+    """
+    results = [{"status": status, "count": count} for status, count in ranked(await stats.counts('status'))]
+    return {"count": len(results), "results": results}
+
+
+@app.get("/stats/levels")
+async def get_stats_by_level():
+    """
+    Число записей по категориям сложности для каждого сезона ("" - категория не указана)
+    """
+    return {
+        season: [{"level": level, "count": count} for level, count in sorted(counts.items())]
+        for season, counts in (await stats.levels()).items()
+    }
+
+
+@app.get("/stats/months")
+async def get_stats_by_month():
+    """
+    Число записей по месяцам add_time (YYYY-MM), по возрастанию месяца
+    """
+    results = [{"month": month, "count": count} for month, count in sorted((await stats.counts('month')).items())]
+    return {"count": len(results), "results": results}
+
+
+@app.get("/stats/areas")
+async def get_stats_by_area(limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT)):
+    """
+    Районы (ячейки 1 x 1 градус по координатам) с наибольшим числом записей
+    """
+    results = [dict(area_bounds(key), count=count) for key, count in ranked(await stats.counts('area'), limit)]
+    return {"count": len(results), "results": results}
+
+
+@app.get("/stats/contributors")
+async def get_stats_by_contributor(limit: int = Query(10, ge=1, le=CONTRIBUTORS_MAX_LIMIT)):
+    """
+    Авторы (по email) с наибольшим числом записей
+    """
+    results = await stats.contributors(limit)
+    return {"count": len(results), "results": results}
+
+
+@app.get("/export")
+async def export_perevals(
+        format: Literal["ndjson", "geojson", "parquet"] = Query("ndjson", description="Формат выгрузки"),
+        status: Optional[str] = Query(None, description="Только записи с этим статусом"),
+        date_from: Optional[datetime] = Query(None, description="date_added не раньше"),
+        date_to: Optional[datetime] = Query(None, description="date_added раньше"),
+        after_id: Optional[int] = Query(None, ge=0, description="Только записи с id больше (инкрементальная выгрузка)"),
+        batch_size: int = Query(EXPORT_BATCH_SIZE, ge=1, le=100000, description="Строк в порции")
+):
+    """
+    Выгрузка всех записей перевалов потоком (NDJSON, GeoJSON или Parquet)
+
+    Записи читаются серверным курсором порциями в порядке id, память
+    не растёт с числом записей. Для инкрементальной выгрузки передайте
+    в after_id наибольший id предыдущей. То же из командной строки:
+    python -m app.export.
+    """
+    try:
+        check_format(format)
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Выгрузка в Parquet недоступна: не установлен pyarrow")
+
+    media_type, extension = EXPORT_FORMATS[format]
+    try:
+        batches = await prefetch(db_manager.iter_export(
+            status=status, date_from=local_time(date_from), date_to=local_time(date_to),
+            after_id=after_id, batch_size=batch_size
+        ))
+    except PoolExhaustedError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
+    return StreamingResponse(
+        export_chunks(format, batches),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="perevals.{extension}"'}
+    )
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """
+    Счётчики попаданий и промахов кэша записей перевалов
+    """
+    return pereval_cache.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,332 @@
+"""
+Метрики процесса в формате Prometheus
+
+Счётчики, гистограммы и показатели хранятся в памяти процесса и отдаются
+текстом на /metrics. При нескольких процессах сервера у каждого свои
+значения, различаются они меткой instance на стороне Prometheus.
+"""
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(64 * 4 ** n for n in range(11))  # 64 Б .. 64 МиБ
+
+# Порог медленного запроса к БД, мс; 0 - журнал выключен
+SLOW_QUERY_MS = float(os.getenv('FSTR_SLOW_QUERY_MS', '0'))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Gauge(Metric):
+    """Текущее значение; callback, если задан, вызывается при каждом выводе"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.callback = callback
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> Iterable[str]:
+        values = dict(self._values)
+        if self.callback is not None:
+            values.update(self.callback())
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        # на набор меток: [счётчики по корзинам..., +Inf], сумма
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(labels)
+            if item is None:
+                item = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            item[0][index] += 1
+            item[1] += value
+
+    def count(self, *labels: str) -> int:
+        item = self._values.get(labels)
+        return sum(item[0]) if item else 0
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> bytes:
+        return ('\n'.join(metric.render() for metric in self.metrics) + '\n').encode()
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "Запросы HTTP по маршруту и коду ответа", ("method", "route", "status")))
+http_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Время обработки запроса HTTP", ("method", "route")))
+http_request_size = registry.register(Histogram(
+    "http_request_size_bytes", "Размер тела запроса", ("method", "route"), SIZE_BUCKETS))
+http_response_size = registry.register(Histogram(
+    "http_response_size_bytes", "Размер тела ответа", ("method", "route"), SIZE_BUCKETS))
+http_errors = registry.register(Counter(
+    "http_request_errors_total", "Ответы 5xx и необработанные исключения", ("method", "route")))
+codec_duration = registry.register(Histogram(
+    "serialization_duration_seconds", "Разбор и проверка тела запроса, кодирование ответа", ("operation",)))
+db_duration = registry.register(Histogram(
+    "db_operation_duration_seconds", "Время метода менеджера БД целиком", ("method",)))
+db_phase_duration = registry.register(Histogram(
+    "db_phase_duration_seconds",
+    "Время метода менеджера БД по фазам: connect - ожидание соединения из пула, "
+    "execute - выполнение запроса (у asyncpg вместе с передачей строк), fetch - получение строк", ("method", "phase")))
+db_errors = registry.register(Counter(
+    "db_errors_total", "Ошибки запросов к БД", ("method", "error")))
+db_slow_queries = registry.register(Counter(
+    "db_slow_queries_total", "Запросы дольше FSTR_SLOW_QUERY_MS", ("method",)))
+db_pool_exhausted = registry.register(Counter(
+    "db_pool_exhausted_total", "Отказы из-за отсутствия свободного соединения в пуле"))
+db_pool = registry.register(Gauge(
+    "db_pool_connections", "Соединения пула: size - открыто, in_use - занято, max - предел", ("state",)))
+db_reads = registry.register(Counter(
+    "db_reads_total", "Чтения менеджера БД: replica - с реплики, primary - с основного сервера, "
+    "fallback - на основном сервере после отказа реплики или без нужной записи на ней", ("target",)))
+db_replica_lag = registry.register(Gauge(
+    "db_replica_lag_seconds", "Отставание реплики по последней проверке", ("replica",)))
+db_replica_available = registry.register(Gauge(
+    "db_replica_available", "Реплика принимает чтения (1) или исключена (0)", ("replica",)))
+process_startup = registry.register(Gauge(
+    "process_startup_seconds", "Время от запуска рабочего процесса (fork) до готовности принимать запросы"))
+admission_shed = registry.register(Counter(
+    "admission_shed_total", "Отклонённые запросы по классу маршрута: queue_full - очередь полна, "
+    "timeout - место не освободилось за бюджет ожидания, rate_limit и rate_limit_email - превышена "
+    "частота запросов клиента", ("class", "reason")))
+admission_wait = registry.register(Histogram(
+    "admission_queue_wait_seconds", "Ожидание места допущенными запросами", ("class",)))
+admission_requests = registry.register(Gauge(
+    "admission_requests", "Запросы по классу маршрута: in_flight - выполняются, waiting - ждут места",
+    ("class", "state")))
+
+# Метод менеджера БД, выполняющийся в текущей задаче или потоке
+current_db_method: contextvars.ContextVar[str] = contextvars.ContextVar('current_db_method', default='other')
+
+
+def db_method(func):
+    """
+    Декоратор методов менеджеров БД: общее время метода и метка method
+    для фаз connect/execute/fetch, записываемых внутри него
+    """
+    name = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    token = current_db_method.set(name)
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        current_db_method.reset(token)
+                    yield item
+            finally:
+                await generator.aclose()
+                db_duration.observe(time.perf_counter() - started, name)
+    elif inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_db_method.set(name)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                db_duration.observe(time.perf_counter() - started, name)
+                current_db_method.reset(token)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = current_db_method.set(name)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                db_duration.observe(time.perf_counter() - started, name)
+                current_db_method.reset(token)
+    return wrapper
+
+
+def redact(params: Sequence) -> str:
+    """Параметры запроса без значений: только типы и размеры"""
+    result = []
+    for value in params or ():
+        if value is None:
+            result.append('NULL')
+        elif isinstance(value, (str, bytes, bytearray, memoryview, list, tuple, dict)):
+            result.append(f'<{type(value).__name__} {len(value)}>')
+        else:
+            result.append(f'<{type(value).__name__}>')
+    return '[' + ', '.join(result) + ']'
+
+
+def record_query(phase: str, elapsed: float, query: Optional[str] = None, params: Sequence = ()):
+    """Время одной фазы запроса к БД и запись в журнал медленных запросов"""
+    method = current_db_method.get()
+    db_phase_duration.observe(elapsed, method, phase)
+    if SLOW_QUERY_MS and phase != 'connect' and elapsed * 1000 >= SLOW_QUERY_MS:
+        db_slow_queries.inc(method)
+        text = ' '.join(str(query).split()) if query else '(получение строк)'
+        print(f"Медленный запрос ({elapsed * 1000:.1f} мс, {method}, {phase}): {text} "
+              f"параметры: {redact(params)}")
+
+
+def record_error(error: BaseException):
+    db_errors.inc(current_db_method.get(), type(error).__name__)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-посредник: время, размеры и коды ответов по шаблону маршрута
+
+    Метка route - шаблон пути ("/submitData/{pereval_id}"), а не сам путь,
+    чтобы число рядов не росло с числом записей; запросы, не совпавшие
+    ни с одним маршрутом, учитываются как "unmatched".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        request_size = 0
+        response_size = 0
+
+        async def counting_receive():
+            nonlocal request_size
+            message = await receive()
+            if message['type'] == 'http.request':
+                request_size += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, response_size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                response_size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        except BaseException:
+            status = 500
+            raise
+        finally:
+            route = scope.get('route')
+            route = getattr(route, 'path', None) or 'unmatched'
+            method = scope['method']
+            http_duration.observe(time.perf_counter() - started, method, route)
+            http_requests.inc(method, route, str(status))
+            http_request_size.observe(request_size, method, route)
+            http_response_size.observe(response_size, method, route)
+            if status >= 500:
+                http_errors.inc(method, route)
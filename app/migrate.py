@@ -0,0 +1,175 @@
+"""
+Применение миграций схемы БД
+
+    python -m app.migrate            применить все новые миграции
+    python -m app.migrate --status   показать состояние
+    python -m app.migrate --batch-size 10000 --pause 0.05
+
+Пакетные шаги коммитят каждую пачку отдельно и не держат долгих
+блокировок, поэтому миграции можно применять на работающей базе.
+Шаги идемпотентны: прерванную миграцию достаточно запустить ещё раз.
+"""
+import argparse
+import importlib
+import pkgutil
+import time
+from typing import List, Optional
+
+from app import migrations
+from app.database import DatabaseManager
+from app.migrations import Batched, Concurrent, Python, Sql
+
+
+class Migration:
+    def __init__(self, version: int, name: str, description: str, steps: list):
+        self.version = version
+        self.name = name
+        self.description = description
+        self.steps = steps
+
+
+def load_migrations() -> List[Migration]:
+    """Все миграции из пакета app.migrations, по возрастанию версии"""
+    result = []
+    for info in pkgutil.iter_modules(migrations.__path__):
+        if not info.name.startswith('m'):
+            continue
+        module = importlib.import_module(f"{migrations.__name__}.{info.name}")
+        version = int(info.name[1:5])
+        description = (module.__doc__ or '').strip().split('\n')[0]
+        result.append(Migration(version, info.name, description, module.STEPS))
+    return sorted(result, key=lambda m: m.version)
+
+
+def ensure_migrations_table(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version int PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamp NOT NULL DEFAULT now()
+        )
+        """)
+    conn.commit()
+
+
+def applied_versions(conn) -> set:
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT version FROM schema_migrations")
+        return {row['version'] for row in cursor.fetchall()}
+
+
+def _run_sql(conn, step: Sql):
+    with conn.cursor() as cursor:
+        cursor.execute(step.sql)
+    conn.commit()
+
+
+def _run_batched(conn, step: Batched, batch_size: int, pause: float):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT min({step.key}) AS lo, max({step.key}) AS hi FROM {step.table}")
+        bounds = cursor.fetchone()
+    conn.commit()
+    if bounds['lo'] is None:
+        return
+
+    start = bounds['lo'] - 1
+    total = 0
+    reported = time.monotonic()
+    while start < bounds['hi']:
+        end = start + batch_size
+        with conn.cursor() as cursor:
+            cursor.execute(step.sql, {'start': start, 'end': end})
+            total += max(cursor.rowcount, 0)
+        conn.commit()
+        start = end
+        if start >= bounds['hi'] or time.monotonic() - reported > 1:
+            reported = time.monotonic()
+            print(f"    {step.table}: {step.key} <= {min(end, bounds['hi'])} из {bounds['hi']}, "
+                  f"обновлено строк: {total}")
+        if pause:
+            time.sleep(pause)
+
+
+def _run_concurrent(conn, step: Concurrent):
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            if step.condition:
+                cursor.execute(step.condition)
+                if not cursor.fetchone():
+                    return
+            if step.index:
+                cursor.execute("""
+                SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = %s AND NOT i.indisvalid
+                """, (step.index,))
+                if cursor.fetchone():
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {step.index}")
+            cursor.execute(step.sql)
+    finally:
+        conn.autocommit = False
+
+
+def apply_migration(conn, migration: Migration, batch_size: int, pause: float):
+    for step in migration.steps:
+        if isinstance(step, Batched):
+            _run_batched(conn, step, batch_size, pause)
+        elif isinstance(step, Concurrent):
+            _run_concurrent(conn, step)
+        elif isinstance(step, Python):
+            step.func(conn, batch_size, pause)
+        else:
+            _run_sql(conn, step)
+
+    with conn.cursor() as cursor:
+        cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                       (migration.version, migration.name))
+    conn.commit()
+
+
+def migrate(target: Optional[int] = None, batch_size: int = 5000, pause: float = 0.0):
+    """Применить все неприменённые миграции (до версии target включительно)"""
+    conn = DatabaseManager().connect()
+    try:
+        ensure_migrations_table(conn)
+        done = applied_versions(conn)
+        for migration in load_migrations():
+            if migration.version in done or (target is not None and migration.version > target):
+                continue
+            print(f"Миграция {migration.version:04d}: {migration.description}")
+            started = time.perf_counter()
+            try:
+                apply_migration(conn, migration, batch_size, pause)
+            except Exception:
+                conn.rollback()
+                raise
+            print(f"  готово за {time.perf_counter() - started:.2f} с")
+    finally:
+        conn.close()
+
+
+def status():
+    conn = DatabaseManager().connect()
+    try:
+        ensure_migrations_table(conn)
+        done = applied_versions(conn)
+        for migration in load_migrations():
+            mark = 'x' if migration.version in done else ' '
+            print(f"[{mark}] {migration.version:04d} {migration.description}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    parser.add_argument("--status", action="store_true", help="показать применённые миграции")
+    parser.add_argument("--target", type=int, help="применить миграции до этой версии")
+    parser.add_argument("--batch-size", type=int, default=5000, help="строк в пачке пакетных шагов")
+    parser.add_argument("--pause", type=float, default=0.0, help="пауза между пачками, с")
+    args = parser.parse_args()
+
+    if args.status:
+        status()
+    else:
+        migrate(args.target, args.batch_size, args.pause)
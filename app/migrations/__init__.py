@@ -0,0 +1,54 @@
+"""
+Версионные миграции схемы БД
+
+Каждая миграция - модуль mNNNN_<название>.py с docstring (описание)
+и списком шагов STEPS. Шаги выполняются app.migrate по порядку.
+"""
+
+
+class Sql:
+    """Обычный SQL, выполняется в одной транзакции"""
+
+    def __init__(self, sql: str):
+        self.sql = sql
+
+
+class Batched:
+    """
+    UPDATE по диапазонам ключа, каждая пачка - отдельная транзакция
+
+    В sql доступны параметры %(start)s и %(end)s: обработать строки
+    с key > start AND key <= end. Границы берутся на момент запуска шага;
+    строки, появившиеся позже, должны обрабатываться триггером.
+    """
+
+    def __init__(self, sql: str, table: str = 'pereval_added', key: str = 'id'):
+        self.sql = sql
+        self.table = table
+        self.key = key
+
+
+class Concurrent:
+    """
+    Команда, которая не может выполняться в транзакции
+    (CREATE INDEX CONCURRENTLY). Если задан index и такой индекс
+    остался невалидным после прерванного запуска, он пересоздаётся.
+    Если задан condition (SELECT), шаг выполняется, только когда
+    запрос вернул строку.
+    """
+
+    def __init__(self, sql: str, index: str = None, condition: str = None):
+        self.sql = sql
+        self.index = index
+        self.condition = condition
+
+
+class Python:
+    """
+    Шаг на Python: func(conn, batch_size, pause) для переноса данных, который
+    нельзя выразить в SQL (например, в файлы). Функция сама коммитит пачки
+    и должна быть идемпотентной, как и остальные шаги.
+    """
+
+    def __init__(self, func):
+        self.func = func
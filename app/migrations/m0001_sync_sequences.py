@@ -0,0 +1,15 @@
+"""
+Выравнивание последовательностей id по данным из init_db.sql
+
+Дамп вставляет строки с явными id, но не сдвигает последовательности,
+из-за чего первая же вставка падала на дубликате первичного ключа.
+"""
+from app.migrations import Sql
+
+STEPS = [
+    Sql("""
+    SELECT setval('pereval_id_seq', GREATEST((SELECT max(id) FROM pereval_added), 1));
+    SELECT setval('pereval_added_id_seq', GREATEST((SELECT max(id) FROM pereval_images), 1));
+    SELECT setval('pereval_areas_id_seq', GREATEST((SELECT max(id) FROM pereval_areas), 1));
+    """),
+]
@@ -0,0 +1,53 @@
+"""
+Перевод raw_data и images из json в jsonb без долгой блокировки таблицы
+
+ALTER COLUMN ... TYPE jsonb переписывает всю таблицу под эксклюзивной
+блокировкой. Вместо этого добавляются новые столбцы, триггер поддерживает
+их для новых записей, старые заполняются пачками, а затем столбцы
+меняются местами в короткой транзакции.
+"""
+from app.migrations import Batched, Sql
+
+STEPS = [
+    Sql("""
+    ALTER TABLE pereval_added
+        ADD COLUMN IF NOT EXISTS raw_data_jsonb jsonb,
+        ADD COLUMN IF NOT EXISTS images_jsonb jsonb;
+
+    CREATE OR REPLACE FUNCTION pereval_added_copy_jsonb() RETURNS trigger AS $$
+    BEGIN
+        NEW.raw_data_jsonb := NEW.raw_data::jsonb;
+        NEW.images_jsonb := NEW.images::jsonb;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_copy_jsonb ON pereval_added;
+    CREATE TRIGGER pereval_added_copy_jsonb
+        BEFORE INSERT OR UPDATE ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_copy_jsonb();
+    """),
+    Batched("""
+    UPDATE pereval_added
+    SET raw_data_jsonb = raw_data::jsonb, images_jsonb = images::jsonb
+    WHERE id > %(start)s AND id <= %(end)s
+      AND (raw_data_jsonb IS NULL AND raw_data IS NOT NULL
+           OR images_jsonb IS NULL AND images IS NOT NULL)
+    """),
+    Sql("""
+    LOCK TABLE pereval_added IN ACCESS EXCLUSIVE MODE;
+
+    UPDATE pereval_added
+    SET raw_data_jsonb = raw_data::jsonb, images_jsonb = images::jsonb
+    WHERE raw_data_jsonb IS NULL AND raw_data IS NOT NULL
+       OR images_jsonb IS NULL AND images IS NOT NULL;
+
+    DROP TRIGGER pereval_added_copy_jsonb ON pereval_added;
+    DROP FUNCTION pereval_added_copy_jsonb();
+
+    ALTER TABLE pereval_added DROP COLUMN raw_data;
+    ALTER TABLE pereval_added DROP COLUMN images;
+    ALTER TABLE pereval_added RENAME COLUMN raw_data_jsonb TO raw_data;
+    ALTER TABLE pereval_added RENAME COLUMN images_jsonb TO images;
+    """),
+]
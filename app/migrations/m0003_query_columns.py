@@ -0,0 +1,66 @@
+"""
+Извлечённые из raw_data столбцы email, status, title и координаты с индексами
+
+Столбцы поддерживаются триггером, а не GENERATED ... STORED: добавление
+генерируемого столбца переписывает таблицу целиком, а триггерные столбцы
+заполняются пачками на работающей базе. Индексы строятся CONCURRENTLY.
+"""
+from app.migrations import Batched, Concurrent, Sql
+
+STEPS = [
+    Sql("""
+    ALTER TABLE pereval_added
+        ADD COLUMN IF NOT EXISTS email text,
+        ADD COLUMN IF NOT EXISTS status text,
+        ADD COLUMN IF NOT EXISTS title text,
+        ADD COLUMN IF NOT EXISTS latitude double precision,
+        ADD COLUMN IF NOT EXISTS longitude double precision;
+
+    CREATE OR REPLACE FUNCTION pereval_try_float(value text) RETURNS double precision AS $$
+    BEGIN
+        RETURN value::double precision;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION pereval_added_extract() RETURNS trigger AS $$
+    BEGIN
+        NEW.email := NEW.raw_data->'user'->>'email';
+        NEW.status := NEW.raw_data->>'status';
+        NEW.title := NEW.raw_data->>'title';
+        NEW.latitude := pereval_try_float(NEW.raw_data->'coords'->>'latitude');
+        NEW.longitude := pereval_try_float(NEW.raw_data->'coords'->>'longitude');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_extract ON pereval_added;
+    CREATE TRIGGER pereval_added_extract
+        BEFORE INSERT OR UPDATE OF raw_data ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_extract();
+    """),
+    Batched("""
+    UPDATE pereval_added
+    SET raw_data = raw_data
+    WHERE id > %(start)s AND id <= %(end)s
+      AND (email, status, title) IS DISTINCT FROM
+          (raw_data->'user'->>'email', raw_data->>'status', raw_data->>'title')
+    """),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_email_idx ON pereval_added (email, id)",
+        index='pereval_added_email_idx'
+    ),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_status_idx ON pereval_added (status, id)",
+        index='pereval_added_status_idx'
+    ),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_title_idx ON pereval_added (lower(title))",
+        index='pereval_added_title_idx'
+    ),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_coords_idx ON pereval_added (latitude, longitude)",
+        index='pereval_added_coords_idx'
+    ),
+]
@@ -0,0 +1,62 @@
+"""
+Ячейка географической сетки geo_cell с индексом и уведомления об изменениях перевалов
+
+geo_cell - номер ячейки 0.25 x 0.25 градуса (см. app.geo.geo_cell); поиск
+в прямоугольнике сначала отбирает строки по списку ячеек через B-tree индекс.
+Триггер pereval_added_notify шлёт NOTIFY pereval_changed с id записи,
+чтобы процессы API обновляли свои индексы в памяти.
+"""
+from app.migrations import Batched, Concurrent, Sql
+
+STEPS = [
+    Sql("""
+    ALTER TABLE pereval_added ADD COLUMN IF NOT EXISTS geo_cell integer;
+
+    CREATE OR REPLACE FUNCTION pereval_geo_cell(lat double precision, lon double precision)
+    RETURNS integer AS $$
+        SELECT CASE
+            WHEN lat IS NULL OR lon IS NULL OR lat NOT BETWEEN -90 AND 90 OR lon NOT BETWEEN -180 AND 180
+                THEN NULL
+            ELSE (LEAST(floor((lat + 90) / 0.25), 719) * 1440 + LEAST(floor((lon + 180) / 0.25), 1439))::integer
+        END
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION pereval_added_extract() RETURNS trigger AS $$
+    BEGIN
+        NEW.email := NEW.raw_data->'user'->>'email';
+        NEW.status := NEW.raw_data->>'status';
+        NEW.title := NEW.raw_data->>'title';
+        NEW.latitude := pereval_try_float(NEW.raw_data->'coords'->>'latitude');
+        NEW.longitude := pereval_try_float(NEW.raw_data->'coords'->>'longitude');
+        NEW.geo_cell := pereval_geo_cell(NEW.latitude, NEW.longitude);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION pereval_added_notify() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('pereval_changed', json_build_object('id', OLD.id, 'op', TG_OP)::text);
+        ELSE
+            PERFORM pg_notify('pereval_changed', json_build_object('id', NEW.id, 'op', TG_OP)::text);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_notify ON pereval_added;
+    CREATE TRIGGER pereval_added_notify
+        AFTER INSERT OR UPDATE OR DELETE ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_notify();
+    """),
+    Batched("""
+    UPDATE pereval_added
+    SET geo_cell = pereval_geo_cell(latitude, longitude)
+    WHERE id > %(start)s AND id <= %(end)s
+      AND geo_cell IS DISTINCT FROM pereval_geo_cell(latitude, longitude)
+    """),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_geo_cell_idx ON pereval_added (geo_cell)",
+        index='pereval_added_geo_cell_idx'
+    ),
+]
@@ -0,0 +1,22 @@
+"""
+Уведомление pereval_areas_changed при любом изменении справочника районов
+
+Процессы API держат дерево районов в памяти и перечитывают его по этому сигналу.
+"""
+from app.migrations import Sql
+
+STEPS = [
+    Sql("""
+    CREATE OR REPLACE FUNCTION pereval_areas_notify() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('pereval_areas_changed', TG_OP);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_areas_notify ON pereval_areas;
+    CREATE TRIGGER pereval_areas_notify
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pereval_areas
+        FOR EACH STATEMENT EXECUTE FUNCTION pereval_areas_notify();
+    """),
+]
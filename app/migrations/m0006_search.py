@@ -0,0 +1,68 @@
+"""
+Нормализованный текст названий search_text для нечёткого поиска с триграммным индексом
+
+search_text - beautyTitle, title и other_titles из raw_data в нижнем регистре
+и с «ё», заменённой на «е» (функция pereval_normalize; должна совпадать
+с app.search.normalize). Регистр переводится через translate, а не lower():
+lower() зависит от локали БД и при локали C не меняет кириллицу.
+
+Индекс GIN gin_trgm_ops строится, только если доступно расширение pg_trgm
+(contrib). Без него поиск работает подстрочным сравнением без индекса;
+после установки расширения индекс можно построить той же командой вручную.
+Триграммы pg_trgm учитывают кириллицу, только если локаль БД не C.
+"""
+from app.migrations import Batched, Concurrent, Sql
+
+STEPS = [
+    Sql("""
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        END IF;
+    EXCEPTION WHEN insufficient_privilege THEN
+        RAISE NOTICE 'Нет прав на CREATE EXTENSION pg_trgm, поиск будет без индекса';
+    END
+    $$;
+
+    ALTER TABLE pereval_added ADD COLUMN IF NOT EXISTS search_text text;
+
+    CREATE OR REPLACE FUNCTION pereval_normalize(value text) RETURNS text AS $$
+        SELECT btrim(regexp_replace(
+            translate(value,
+                      'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯёABCDEFGHIJKLMNOPQRSTUVWXYZ',
+                      'абвгдеежзийклмнопрстуфхцчшщъыьэюяеabcdefghijklmnopqrstuvwxyz'),
+            '\\s+', ' ', 'g'))
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION pereval_search_text(raw_data jsonb) RETURNS text AS $$
+        SELECT pereval_normalize(concat_ws(' ', raw_data->>'beautyTitle', raw_data->>'title',
+                                           raw_data->>'other_titles'))
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION pereval_added_extract() RETURNS trigger AS $$
+    BEGIN
+        NEW.email := NEW.raw_data->'user'->>'email';
+        NEW.status := NEW.raw_data->>'status';
+        NEW.title := NEW.raw_data->>'title';
+        NEW.latitude := pereval_try_float(NEW.raw_data->'coords'->>'latitude');
+        NEW.longitude := pereval_try_float(NEW.raw_data->'coords'->>'longitude');
+        NEW.geo_cell := pereval_geo_cell(NEW.latitude, NEW.longitude);
+        NEW.search_text := pereval_search_text(NEW.raw_data);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    """),
+    Batched("""
+    UPDATE pereval_added
+    SET search_text = pereval_search_text(raw_data)
+    WHERE id > %(start)s AND id <= %(end)s
+      AND search_text IS DISTINCT FROM pereval_search_text(raw_data)
+    """),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_search_trgm_idx "
+        "ON pereval_added USING gin (search_text gin_trgm_ops)",
+        index='pereval_added_search_trgm_idx',
+        condition="SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+    ),
+]
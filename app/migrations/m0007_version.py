@@ -0,0 +1,52 @@
+"""
+Номер версии записи для оптимистической блокировки и частичное обновление JSON Merge Patch
+
+version увеличивается триггером при каждом изменении raw_data или images
+(в том числе при смене статуса модератором) и отдаётся клиенту в ETag.
+pereval_merge_patch(target, patch) применяет к документу jsonb патч
+по RFC 7396: объекты сливаются рекурсивно, null удаляет ключ,
+остальные значения (в том числе массивы) заменяются целиком.
+"""
+from app.migrations import Sql
+
+STEPS = [
+    Sql("""
+    ALTER TABLE pereval_added ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1;
+
+    CREATE OR REPLACE FUNCTION pereval_merge_patch(target jsonb, patch jsonb) RETURNS jsonb AS $$
+    DECLARE
+        item record;
+    BEGIN
+        IF jsonb_typeof(patch) IS DISTINCT FROM 'object' THEN
+            RETURN patch;
+        END IF;
+        IF jsonb_typeof(target) IS DISTINCT FROM 'object' THEN
+            target := '{}'::jsonb;
+        END IF;
+        FOR item IN SELECT key, value FROM jsonb_each(patch) LOOP
+            IF jsonb_typeof(item.value) = 'null' THEN
+                target := target - item.key;
+            ELSE
+                target := jsonb_set(target, ARRAY[item.key],
+                                    pereval_merge_patch(target->item.key, item.value));
+            END IF;
+        END LOOP;
+        RETURN target;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION pereval_added_version() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.raw_data IS DISTINCT FROM OLD.raw_data OR NEW.images IS DISTINCT FROM OLD.images THEN
+            NEW.version := OLD.version + 1;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_version ON pereval_added;
+    CREATE TRIGGER pereval_added_version
+        BEFORE UPDATE ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_version();
+    """),
+]
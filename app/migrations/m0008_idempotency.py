@@ -0,0 +1,29 @@
+"""
+Повторные отправки: ключи Idempotency-Key и хэш содержимого записи
+
+pereval_idempotency хранит недавние ключи запросов и id созданных по ним
+записей (старые ключи удаляет сервер, см. FSTR_IDEMPOTENCY_TTL).
+content_hash - sha256 данных отправленной записи вместе с пользователем
+(app.idempotency.payload_hash); уникальный индекс не даёт сохранить одну
+и ту же отправку дважды. У записей, созданных до миграции, хэша нет.
+"""
+from app.migrations import Concurrent, Sql
+
+STEPS = [
+    Sql("""
+    ALTER TABLE pereval_added ADD COLUMN IF NOT EXISTS content_hash bytea;
+
+    CREATE TABLE IF NOT EXISTS pereval_idempotency (
+        key text PRIMARY KEY,
+        request_hash bytea,
+        pereval_id integer NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS pereval_idempotency_created_idx ON pereval_idempotency (created_at);
+    """),
+    Concurrent(
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_content_hash_idx "
+        "ON pereval_added (content_hash) WHERE content_hash IS NOT NULL",
+        index='pereval_added_content_hash_idx'
+    ),
+]
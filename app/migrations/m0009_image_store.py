@@ -0,0 +1,80 @@
+"""
+Изображения в хранилище вне БД (app.image_store) со счётчиком ссылок
+
+image_blobs - хранимые изображения по sha256 и число ссылок на них из
+pereval_added.images; счётчик ведёт триггер при любом изменении images.
+Когда ссылок не остаётся, запоминается released_at: после FSTR_IMAGE_GC_GRACE
+изображение удаляет сборщик. image_legacy_ids - соответствие id бывших строк
+pereval_images хэшам, чтобы старые ссылки /images/{id} продолжали работать.
+
+Изображения переносятся из pereval_images в хранилище FSTR_IMAGE_DIR
+(каталог должен быть доступен процессу миграции), перенесённые строки
+удаляются; место в таблице освобождает VACUUM FULL pereval_images.
+"""
+from app.image_store import move_legacy_images
+from app.migrations import Python, Sql
+
+STEPS = [
+    Sql("""
+    CREATE TABLE IF NOT EXISTS image_blobs (
+        hash bytea PRIMARY KEY,
+        size bigint NOT NULL,
+        refcount integer NOT NULL DEFAULT 0,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        released_at timestamptz
+    );
+    CREATE INDEX IF NOT EXISTS image_blobs_released_idx
+        ON image_blobs (coalesce(released_at, created_at)) WHERE refcount <= 0;
+
+    CREATE TABLE IF NOT EXISTS image_legacy_ids (
+        id integer PRIMARY KEY,
+        hash bytea NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION image_hashes(images jsonb) RETURNS bytea[] AS $$
+        SELECT coalesce(array_agg(decode(image->>'sha256', 'hex')), '{}')
+        FROM jsonb_array_elements(
+            CASE WHEN jsonb_typeof(images->'images') = 'array' THEN images->'images' ELSE '[]' END
+        ) AS image
+        WHERE jsonb_typeof(image) = 'object' AND image->>'sha256' IS NOT NULL
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION pereval_added_image_refs() RETURNS trigger AS $$
+    DECLARE
+        added bytea[] := '{}';
+        removed bytea[] := '{}';
+    BEGIN
+        IF TG_OP <> 'DELETE' THEN
+            added := image_hashes(NEW.images);
+        END IF;
+        IF TG_OP <> 'INSERT' THEN
+            removed := image_hashes(OLD.images);
+        END IF;
+        IF added = removed THEN
+            RETURN NULL;
+        END IF;
+        UPDATE image_blobs b
+        SET refcount = b.refcount + d.delta,
+            released_at = CASE WHEN b.refcount + d.delta <= 0 THEN now() END
+        FROM (
+            SELECT hash, sum(delta)::integer AS delta
+            FROM (
+                SELECT unnest(added) AS hash, 1 AS delta
+                UNION ALL
+                SELECT unnest(removed), -1
+            ) AS refs
+            GROUP BY hash
+            HAVING sum(delta) <> 0
+        ) AS d
+        WHERE b.hash = d.hash;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_image_refs ON pereval_added;
+    CREATE TRIGGER pereval_added_image_refs
+        AFTER INSERT OR DELETE OR UPDATE OF images ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_image_refs();
+    """),
+    Python(move_legacy_images),
+]
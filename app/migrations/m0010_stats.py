@@ -0,0 +1,170 @@
+"""
+Счётчики статистики перевалов, обновляемые триггерами
+
+pereval_stats - число записей по разрезам: всего, статус, категория
+сложности по сезонам, месяц add_time и район - ячейка сетки 1 x 1 градус
+по координатам (см. app.stats). Счётчик ключа разбит на 8 строк
+(slot = pg_backend_pid() % 8): одновременные записи из разных соединений
+не ждут друг друга на одной строке, значение - сумма по слотам.
+pereval_contributors - число записей по email автора.
+
+Триггеры уровня оператора с таблицами переходов: пачка записей меняет
+каждый счётчик один раз, строки счётчиков блокируются в порядке ключа,
+поэтому параллельные пачки не создают взаимных блокировок.
+pereval_stats_reconcile() сверяет счётчики с данными и добавляет разницу;
+она же заполняет счётчики для уже существующих записей.
+"""
+from app.migrations import Sql
+
+STEPS = [
+    Sql("""
+    CREATE TABLE IF NOT EXISTS pereval_stats (
+        dimension text NOT NULL,
+        key text NOT NULL,
+        slot smallint NOT NULL DEFAULT 0,
+        count bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (dimension, key, slot)
+    );
+
+    CREATE TABLE IF NOT EXISTS pereval_contributors (
+        email text PRIMARY KEY,
+        count bigint NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS pereval_contributors_count_idx ON pereval_contributors (count DESC, email);
+
+    CREATE OR REPLACE FUNCTION pereval_stat_keys(status text, raw_data jsonb,
+                                                 latitude double precision, longitude double precision)
+    RETURNS TABLE (dimension text, key text) AS $$
+        SELECT 'total', ''
+        UNION ALL
+        SELECT 'status', coalesce(status, '')
+        UNION ALL
+        SELECT 'level_' || season, coalesce(raw_data->'level'->>season, '')
+        FROM unnest(ARRAY['winter', 'summer', 'autumn', 'spring']) AS season
+        UNION ALL
+        SELECT 'month', left(raw_data->>'add_time', 7)
+        WHERE raw_data->>'add_time' ~ '^[0-9]{4}-[0-9]{2}'
+        UNION ALL
+        SELECT 'area', floor(latitude)::integer || ',' || floor(longitude)::integer
+        WHERE pereval_geo_cell(latitude, longitude) IS NOT NULL
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION pereval_stats_apply(added pereval_added[], removed pereval_added[])
+    RETURNS void AS $$
+        WITH changed AS (
+            SELECT status, raw_data, latitude, longitude, email, 1 AS delta FROM unnest(added)
+            UNION ALL
+            SELECT status, raw_data, latitude, longitude, email, -1 FROM unnest(removed)
+        )
+        INSERT INTO pereval_stats AS s (dimension, key, slot, count)
+        SELECT k.dimension, k.key, pg_backend_pid() % 8, sum(c.delta)
+        FROM changed c, pereval_stat_keys(c.status, c.raw_data, c.latitude, c.longitude) AS k
+        GROUP BY k.dimension, k.key
+        HAVING sum(c.delta) <> 0
+        ORDER BY k.dimension, k.key
+        ON CONFLICT (dimension, key, slot) DO UPDATE SET count = s.count + EXCLUDED.count;
+
+        INSERT INTO pereval_contributors AS p (email, count)
+        SELECT email, sum(delta)
+        FROM (
+            SELECT email, 1 AS delta FROM unnest(added)
+            UNION ALL
+            SELECT email, -1 FROM unnest(removed)
+        ) AS changed
+        WHERE email IS NOT NULL
+        GROUP BY email
+        HAVING sum(delta) <> 0
+        ORDER BY email
+        ON CONFLICT (email) DO UPDATE SET count = p.count + EXCLUDED.count;
+    $$ LANGUAGE sql;
+
+    CREATE OR REPLACE FUNCTION pereval_added_stats() RETURNS trigger AS $$
+    DECLARE
+        added pereval_added[] := '{}';
+        removed pereval_added[] := '{}';
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            added := ARRAY(SELECT n FROM new_rows n);
+        ELSIF TG_OP = 'DELETE' THEN
+            removed := ARRAY(SELECT o FROM old_rows o);
+        ELSE
+            -- только записи, у которых изменилось что-то учитываемое в статистике
+            SELECT coalesce(array_agg(n), '{}'), coalesce(array_agg(o), '{}') INTO added, removed
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.status, n.email, n.latitude, n.longitude, n.raw_data->'level', n.raw_data->>'add_time')
+                  IS DISTINCT FROM
+                  (o.status, o.email, o.latitude, o.longitude, o.raw_data->'level', o.raw_data->>'add_time');
+        END IF;
+        IF cardinality(added) > 0 OR cardinality(removed) > 0 THEN
+            PERFORM pereval_stats_apply(added, removed);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_stats_insert ON pereval_added;
+    CREATE TRIGGER pereval_added_stats_insert
+        AFTER INSERT ON pereval_added REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION pereval_added_stats();
+    DROP TRIGGER IF EXISTS pereval_added_stats_update ON pereval_added;
+    CREATE TRIGGER pereval_added_stats_update
+        AFTER UPDATE ON pereval_added REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION pereval_added_stats();
+    DROP TRIGGER IF EXISTS pereval_added_stats_delete ON pereval_added;
+    CREATE TRIGGER pereval_added_stats_delete
+        AFTER DELETE ON pereval_added REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION pereval_added_stats();
+
+    CREATE OR REPLACE FUNCTION pereval_stats_reconcile() RETURNS integer AS $$
+    -- Разница между данными и счётчиками считается одним запросом (один
+    -- снимок данных), поэтому её можно прибавлять к счётчикам, пока идут
+    -- записи: изменения, не попавшие в снимок, учтут их собственные триггеры.
+    -- Одновременно сверку выполняет только один процесс, остальные получают NULL.
+    DECLARE
+        fixed integer;
+        fixed_contributors integer;
+    BEGIN
+        IF NOT pg_try_advisory_xact_lock(hashtext('pereval_stats_reconcile')) THEN
+            RETURN NULL;
+        END IF;
+
+        WITH actual AS (
+            SELECT k.dimension, k.key, count(*) AS count
+            FROM pereval_added a, pereval_stat_keys(a.status, a.raw_data, a.latitude, a.longitude) AS k
+            GROUP BY k.dimension, k.key
+        ), stored AS (
+            SELECT dimension, key, sum(count) AS count FROM pereval_stats GROUP BY dimension, key
+        )
+        INSERT INTO pereval_stats AS s (dimension, key, slot, count)
+        SELECT dimension, key, 0, coalesce(actual.count, 0) - coalesce(stored.count, 0)
+        FROM actual FULL JOIN stored USING (dimension, key)
+        WHERE coalesce(actual.count, 0) <> coalesce(stored.count, 0)
+        ORDER BY dimension, key
+        ON CONFLICT (dimension, key, slot) DO UPDATE SET count = s.count + EXCLUDED.count;
+        GET DIAGNOSTICS fixed = ROW_COUNT;
+
+        WITH actual AS (
+            SELECT email, count(*) AS count FROM pereval_added WHERE email IS NOT NULL GROUP BY email
+        )
+        INSERT INTO pereval_contributors AS p (email, count)
+        SELECT email, coalesce(actual.count, 0) - coalesce(stored.count, 0)
+        FROM actual FULL JOIN pereval_contributors AS stored USING (email)
+        WHERE coalesce(actual.count, 0) <> coalesce(stored.count, 0)
+        ORDER BY email
+        ON CONFLICT (email) DO UPDATE SET count = p.count + EXCLUDED.count;
+        GET DIAGNOSTICS fixed_contributors = ROW_COUNT;
+
+        -- занятые записями строки пропускаются: ожидание их блокировок в другом
+        -- порядке, чем у триггеров, могло бы привести к взаимной блокировке
+        DELETE FROM pereval_stats WHERE (dimension, key, slot) IN (
+            SELECT dimension, key, slot FROM pereval_stats WHERE count = 0 FOR UPDATE SKIP LOCKED
+        );
+        DELETE FROM pereval_contributors WHERE email IN (
+            SELECT email FROM pereval_contributors WHERE count = 0 FOR UPDATE SKIP LOCKED
+        );
+        RETURN fixed + fixed_contributors;
+    END
+    $$ LANGUAGE plpgsql;
+    """),
+    Sql("SELECT pereval_stats_reconcile()"),
+]
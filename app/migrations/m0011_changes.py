@@ -0,0 +1,76 @@
+"""
+Лента изменений для синхронизации: транзакция последнего изменения записи и удалённые записи
+
+change_xid - номер транзакции (pg_current_xact_id), которая создала запись
+или последней изменила raw_data или images (в том числе сменой статуса);
+у записей, созданных до миграции, - 0. pereval_deleted - удалённые записи
+и записи, сменившие email (для ленты прежнего пользователя), с номером
+удалившей транзакции; старые строки удаляет сервер (FSTR_CHANGES_TTL).
+Как по номерам транзакций строится лента без пропусков, см. app.changes.
+"""
+from app.migrations import Concurrent, Sql
+
+STEPS = [
+    Sql("""
+    ALTER TABLE pereval_added ADD COLUMN IF NOT EXISTS change_xid bigint NOT NULL DEFAULT 0;
+
+    CREATE TABLE IF NOT EXISTS pereval_deleted (
+        id integer NOT NULL,
+        email text NOT NULL,
+        change_xid bigint NOT NULL,
+        deleted_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, email)
+    );
+    CREATE INDEX IF NOT EXISTS pereval_deleted_email_idx ON pereval_deleted (email, change_xid, id);
+    CREATE INDEX IF NOT EXISTS pereval_deleted_xid_idx ON pereval_deleted (change_xid, id);
+    CREATE INDEX IF NOT EXISTS pereval_deleted_at_idx ON pereval_deleted (deleted_at);
+
+    CREATE OR REPLACE FUNCTION pereval_added_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR NEW.raw_data IS DISTINCT FROM OLD.raw_data
+                OR NEW.images IS DISTINCT FROM OLD.images THEN
+            NEW.change_xid := pg_current_xact_id()::text::bigint;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_change ON pereval_added;
+    CREATE TRIGGER pereval_added_change
+        BEFORE INSERT OR UPDATE ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_change();
+
+    CREATE OR REPLACE FUNCTION pereval_added_deleted() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO pereval_deleted (id, email, change_xid)
+        VALUES (OLD.id, coalesce(OLD.email, ''), pg_current_xact_id()::text::bigint)
+        ON CONFLICT (id, email) DO UPDATE
+            SET change_xid = EXCLUDED.change_xid, deleted_at = now();
+        IF TG_OP = 'UPDATE' THEN
+            -- запись вернулась к прежнему email
+            DELETE FROM pereval_deleted WHERE id = NEW.id AND email = coalesce(NEW.email, '');
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_deleted ON pereval_added;
+    CREATE TRIGGER pereval_added_deleted
+        AFTER DELETE ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_deleted();
+    DROP TRIGGER IF EXISTS pereval_added_email_changed ON pereval_added;
+    CREATE TRIGGER pereval_added_email_changed
+        AFTER UPDATE ON pereval_added
+        FOR EACH ROW WHEN (OLD.email IS DISTINCT FROM NEW.email)
+        EXECUTE FUNCTION pereval_added_deleted();
+    """),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_email_change_idx "
+        "ON pereval_added (email, change_xid, id)",
+        index='pereval_added_email_change_idx'
+    ),
+    Concurrent(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_change_idx ON pereval_added (change_xid, id)",
+        index='pereval_added_change_idx'
+    ),
+]
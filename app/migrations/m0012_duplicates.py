@@ -0,0 +1,34 @@
+"""
+Возможные дубликаты перевалов, найденные при добавлении записи (app.duplicates)
+
+pereval_duplicates - пары (новая запись, похожая существующая) со сходством
+названий и расстоянием. Ссылка на новую запись - внешний ключ; у похожей
+записи ключа нет, чтобы её одновременное удаление не мешало добавлению:
+строки удаляются триггером, а чтение соединяет пары с pereval_added.
+"""
+from app.migrations import Sql
+
+STEPS = [
+    Sql("""
+    CREATE TABLE IF NOT EXISTS pereval_duplicates (
+        pereval_id integer NOT NULL REFERENCES pereval_added (id) ON DELETE CASCADE,
+        duplicate_id integer NOT NULL,
+        similarity double precision NOT NULL,
+        distance_m double precision NOT NULL,
+        PRIMARY KEY (pereval_id, duplicate_id)
+    );
+    CREATE INDEX IF NOT EXISTS pereval_duplicates_duplicate_idx ON pereval_duplicates (duplicate_id);
+
+    CREATE OR REPLACE FUNCTION pereval_added_duplicates_deleted() RETURNS trigger AS $$
+    BEGIN
+        DELETE FROM pereval_duplicates d USING old_rows o WHERE d.duplicate_id = o.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS pereval_added_duplicates_deleted ON pereval_added;
+    CREATE TRIGGER pereval_added_duplicates_deleted
+        AFTER DELETE ON pereval_added REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION pereval_added_duplicates_deleted();
+    """),
+]
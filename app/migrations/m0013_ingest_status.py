@@ -0,0 +1,21 @@
+"""
+Состояние записей очереди отложенной записи, общее для всех процессов (app.ingest)
+
+pereval_ingest_status - id, зарезервированные очередью (state = queued), и
+записи, которые не удалось сохранить (failed, error - причина). Сохранённые
+записи удаляются отсюда после коммита пачки: их состояние - наличие строки
+в pereval_added. Старые строки удаляет сервер (FSTR_INGEST_STATUS_TTL).
+"""
+from app.migrations import Sql
+
+STEPS = [
+    Sql("""
+    CREATE TABLE IF NOT EXISTS pereval_ingest_status (
+        id integer PRIMARY KEY,
+        state text NOT NULL,
+        error text,
+        updated_at timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS pereval_ingest_status_updated_idx ON pereval_ingest_status (updated_at);
+    """),
+]
@@ -0,0 +1,26 @@
+"""
+NOTIFY pereval_changed только при изменении данных записи
+
+Раньше уведомление шло на каждое изменение строки, в том числе служебных
+столбцов (geo_cell, search_text, content_hash, change_xid), и массовые
+обновления заваливали процессы API уведомлениями. Теперь UPDATE уведомляет,
+только если изменились raw_data, images или date_added: из них берутся ответ
+API и поля индексов в памяти (координаты и названия - столбцы из raw_data).
+"""
+from app.migrations import Sql
+
+STEPS = [
+    Sql("""
+    DROP TRIGGER IF EXISTS pereval_added_notify ON pereval_added;
+    CREATE TRIGGER pereval_added_notify
+        AFTER INSERT OR DELETE ON pereval_added
+        FOR EACH ROW EXECUTE FUNCTION pereval_added_notify();
+
+    DROP TRIGGER IF EXISTS pereval_added_notify_update ON pereval_added;
+    CREATE TRIGGER pereval_added_notify_update
+        AFTER UPDATE ON pereval_added
+        FOR EACH ROW
+        WHEN ((OLD.raw_data, OLD.images, OLD.date_added) IS DISTINCT FROM (NEW.raw_data, NEW.images, NEW.date_added))
+        EXECUTE FUNCTION pereval_added_notify();
+    """),
+]
@@ -3,6 +3,14 @@ from typing import List, Optional
 from datetime import datetime
 
 
+def check_date_format(v: str) -> str:
+    try:
+        datetime.strptime(v, '%Y-%m-%d %H:%M:%S')
+        return v
+    except ValueError:
+        raise ValueError('Неверный формат даты. Используйте: YYYY-MM-DD HH:MM:SS')
+
+
 class User(BaseModel):
     fam: str = Field(..., description="Фамилия")
     name: str = Field(..., description="Имя")
@@ -29,8 +37,9 @@ class Image(BaseModel):
     title: str = Field(..., description="Название изображения")
 
 
-class PerevalData(BaseModel):
-    beauty_title: Optional[str] = Field("", description="Красивое название")
+class PerevalBase(BaseModel):
+    beauty_title: Optional[str] = Field("", description="Красивое название",
+                                        serialization_alias="beautyTitle")
     title: str = Field(..., description="Название перевала")
     other_titles: Optional[str] = Field("", description="Другие названия")
     connect: Optional[str] = Field("", description="Что соединяет")
@@ -39,12 +48,50 @@ class PerevalData(BaseModel):
     user: User
     coords: Coordinates
     level: Level
+
+    @validator('add_time')
+    def validate_date_format(cls, v):
+        return check_date_format(v)
+
+
+class PerevalData(PerevalBase):
     images: List[Image]
 
+
+class CoordinatesPatch(BaseModel):
+    latitude: str = Field(None, description="Широта")
+    longitude: str = Field(None, description="Долгота")
+    height: str = Field(None, description="Высота")
+
+
+class LevelPatch(BaseModel):
+    winter: Optional[str] = Field(None, description="Зима")
+    summer: Optional[str] = Field(None, description="Лето")
+    autumn: Optional[str] = Field(None, description="Осень")
+    spring: Optional[str] = Field(None, description="Весна")
+
+
+class PerevalPatch(BaseModel):
+    """
+    Частичное обновление перевала (JSON Merge Patch, RFC 7396)
+
+    Передаются только изменяемые поля; вложенные coords и level сливаются
+    по полям. null у необязательного поля сбрасывает его в "", у обязательного
+    (title, add_time, координаты, images) - ошибка. images, если переданы,
+    заменяют список изображений целиком. user и статус не меняются:
+    такие поля в патче игнорируются, поэтому подходит и полный PerevalData.
+    """
+    beauty_title: Optional[str] = Field(None, description="Красивое название",
+                                        serialization_alias="beautyTitle")
+    title: str = Field(None, description="Название перевала")
+    other_titles: Optional[str] = Field(None, description="Другие названия")
+    connect: Optional[str] = Field(None, description="Что соединяет")
+    add_time: str = Field(None, description="Время добавления")
+
+    coords: CoordinatesPatch = None
+    level: LevelPatch = None
+    images: List[Image] = None
+
     @validator('add_time')
     def validate_date_format(cls, v):
-        try:
-            datetime.strptime(v, '%Y-%m-%d %H:%M:%S')
-            return v
-        except ValueError:
-            raise ValueError('Неверный формат даты. Используйте: YYYY-MM-DD HH:MM:SS')
\ No newline at end of file
+        return check_date_format(v)
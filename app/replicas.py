@@ -0,0 +1,193 @@
+"""
+Чтение с реплик PostgreSQL (AsyncDatabaseManager)
+
+FSTR_DB_REPLICAS - реплики потоковой репликации через запятую, "host[:port]";
+база, пользователь и пароль - как у основного сервера (FSTR_DB_*).
+Запись, update_pereval и чтения для индексов в памяти идут на основной сервер,
+остальные чтения - по кругу на доступные реплики.
+
+Раз в FSTR_DB_REPLICA_CHECK_INTERVAL секунд проверяется каждая реплика.
+Отставание меряется по журналу: основной сервер запоминает свою позицию
+WAL с отметкой времени, отставание реплики - время с последней отметки,
+которую она уже применила (простой основного сервера отставанием не
+считается). Реплика исключается, если она недоступна, не в режиме
+восстановления или отстаёт больше чем на FSTR_DB_REPLICA_MAX_LAG секунд;
+тогда чтения идут на основной сервер.
+
+Read-your-writes: после успешного изменяющего запроса клиент получает cookie,
+и FSTR_READ_YOUR_WRITES секунд его чтения идут на основной сервер.
+"""
+import asyncio
+import contextvars
+import os
+import time
+from collections import deque
+from http.cookies import SimpleCookie
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from app.database import PoolExhaustedError
+
+REPLICA_MAX_LAG = float(os.getenv('FSTR_DB_REPLICA_MAX_LAG', '5'))
+REPLICA_CHECK_INTERVAL = float(os.getenv('FSTR_DB_REPLICA_CHECK_INTERVAL', '2'))
+READ_YOUR_WRITES_SECONDS = float(os.getenv('FSTR_READ_YOUR_WRITES', '5'))
+READ_YOUR_WRITES_COOKIE = "fstr_primary_until"
+
+# Ошибки, после которых чтение повторяется на основном сервере; конфликт
+# с применением журнала на реплике отменяет запрос (QueryCanceledError)
+REPLICA_ERRORS = (OSError, asyncio.TimeoutError, PoolExhaustedError, asyncpg.InterfaceError,
+                  asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError,
+                  asyncpg.TooManyConnectionsError, asyncpg.QueryCanceledError,
+                  asyncpg.SerializationError)
+
+PRIMARY_LSN_QUERY = "SELECT (pg_current_wal_lsn() - '0/0'::pg_lsn)::bigint"
+REPLICA_LSN_QUERY = "SELECT pg_is_in_recovery(), (pg_last_wal_replay_lsn() - '0/0'::pg_lsn)::bigint"
+
+# Чтения текущей задачи идут на основной сервер (read-your-writes)
+read_from_primary: contextvars.ContextVar[bool] = contextvars.ContextVar('read_from_primary', default=False)
+
+
+def replica_hosts_from_env() -> List[Tuple[str, int]]:
+    """Реплики из FSTR_DB_REPLICAS: [(host, port)]; порт по умолчанию - как у основного сервера"""
+    default_port = int(os.getenv('FSTR_DB_PORT', '5432'))
+    hosts = []
+    for item in os.getenv('FSTR_DB_REPLICAS', '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, sep, port = item.rpartition(':')
+        if not sep:
+            host, port = item, ''
+        hosts.append((host, int(port) if port else default_port))
+    return hosts
+
+
+class Replica:
+    """Реплика: пул соединений и результат последней проверки"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.pool: Optional[asyncpg.Pool] = None
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.pool is not None
+
+    def mark_failed(self, error):
+        """Исключить реплику до следующей успешной проверки"""
+        if self.healthy:
+            print(f"Реплика {self.name} исключена: {error}")
+        self.healthy = False
+        self.error = str(error) or type(error).__name__
+
+    def mark_checked(self, lag: float, max_lag: float):
+        self.lag = lag
+        self.checked_at = time.monotonic()
+        if lag > max_lag:
+            self.mark_failed(f"отставание {lag:.1f} с больше {max_lag:g} с")
+            return
+        if not self.healthy:
+            print(f"Реплика {self.name} доступна, отставание {lag:.1f} с")
+        self.healthy = True
+        self.error = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {'name': self.name, 'healthy': self.healthy, 'lag': self.lag, 'error': self.error}
+
+
+class LagTracker:
+    """
+    Отставание реплик во времени по позициям WAL основного сервера
+
+    sample() запоминает текущую позицию основного сервера; отставание
+    реплики, применившей журнал до позиции lsn, - время с последней
+    запомненной позиции не дальше lsn (0, если реплика догнала последнюю).
+    Если такой позиции среди запомненных нет, отставание больше окна.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._samples: Deque[Tuple[float, int]] = deque()
+
+    def sample(self, lsn: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self._samples.append((now, lsn))
+        # одна позиция старше окна остаётся: от неё отсчитывается отставание
+        while len(self._samples) > 1 and self._samples[1][0] < now - self.window:
+            self._samples.popleft()
+
+    def lag(self, replica_lsn: Optional[int], now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        if replica_lsn is None or not self._samples:
+            return float('inf')
+        if replica_lsn >= self._samples[-1][1]:
+            return 0.0
+        for sampled_at, lsn in reversed(self._samples):
+            if lsn <= replica_lsn:
+                return now - sampled_at
+        return float('inf')
+
+
+def _cookie_until(scope) -> float:
+    for name, value in scope.get('headers', ()):
+        if name == b'cookie':
+            cookie = SimpleCookie()
+            try:
+                cookie.load(value.decode('latin-1'))
+            except Exception:
+                return 0.0
+            morsel = cookie.get(READ_YOUR_WRITES_COOKIE)
+            if morsel is not None:
+                try:
+                    return float(morsel.value)
+                except ValueError:
+                    return 0.0
+    return 0.0
+
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI-посредник read-your-writes
+
+    После успешного (не 4xx/5xx) изменяющего запроса ставит cookie со временем
+    (unix), до которого чтения клиента идут на основной сервер; запросы
+    с неистёкшей cookie выполняются с read_from_primary.
+    """
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, app, seconds: float = READ_YOUR_WRITES_SECONDS):
+        self.app = app
+        self.seconds = seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        token = None
+        if _cookie_until(scope) > time.time():
+            token = read_from_primary.set(True)
+        writes = scope['method'] not in self.SAFE_METHODS
+
+        async def cookie_send(message):
+            if writes and message['type'] == 'http.response.start' and message['status'] < 400:
+                until = time.time() + self.seconds
+                cookie = (f"{READ_YOUR_WRITES_COOKIE}={until:.3f}; Max-Age={int(self.seconds) + 1}; "
+                          f"Path=/; HttpOnly; SameSite=Lax")
+                message = dict(message, headers=list(message.get('headers', [])) + [
+                    (b'set-cookie', cookie.encode('latin-1'))
+                ])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, cookie_send)
+        finally:
+            if token is not None:
+                read_from_primary.reset(token)
@@ -0,0 +1,180 @@
+import os
+import re
+import string
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Должно совпадать с SQL-функцией pereval_normalize (миграция 0006)
+_UPPER = 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯё' + string.ascii_uppercase
+_LOWER = 'абвгдеежзийклмнопрстуфхцчшщъыьэюяе' + string.ascii_lowercase
+_NORMALIZE = str.maketrans(_UPPER, _LOWER)
+
+_NAME_SEPARATORS = re.compile(r'[,;/]')
+_WORD_START = re.compile(r'(?:^|[\s\-(«"])(?=\w)')
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, «ё» -> «е», пробелы схлопнуты"""
+    return ' '.join(text.translate(_NORMALIZE).split())
+
+
+def pass_names(title: Optional[str], other_titles: Optional[str]) -> List[str]:
+    """Названия перевала для подсказок: title и каждое из other_titles"""
+    names = [title] if title and title.strip() else []
+    if other_titles:
+        names.extend(name for name in _NAME_SEPARATORS.split(other_titles) if name.strip())
+    return [' '.join(name.split()) for name in names]
+
+
+def _keys(name: str) -> List[str]:
+    """
+    Ключи названия в дереве: всё название и его окончания с начала каждого
+    следующего слова (кроме чисел), чтобы «анз» находило и «пер. Анзоб»
+    """
+    text = normalize(name)
+    keys = [text] if text else []
+    for match in _WORD_START.finditer(text, 1):
+        key = text[match.end():]
+        # с номеров («Анзоб 2») подсказки не ищут, а ключей таких много
+        if key and not key[0].isdigit() and key not in keys:
+            keys.append(key)
+    return keys
+
+
+class _Node:
+    __slots__ = ('children', 'names')
+
+    def __init__(self):
+        # первый символ ребра -> (метка ребра, узел)
+        self.children: Dict[str, Tuple[str, "_Node"]] = {}
+        # названия, ключ которых заканчивается в этом узле: название -> число перевалов
+        self.names: Optional[Dict[str, int]] = None
+
+
+class SuggestTrie:
+    """
+    Сжатое префиксное дерево (radix tree) названий перевалов для автодополнения
+
+    Ключи нормализованы (см. normalize); в листьях хранятся исходные названия
+    и число перевалов с таким названием. Дерево обновляется по одной записи
+    (add/remove), поиск по префиксу длины m - O(m + размер ответа).
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self._by_id: Dict[int, Tuple[str, ...]] = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def load(self, rows: Iterable[Tuple[int, Optional[str], Optional[str]]]):
+        """Заполнить дерево строками (id, title, other_titles)"""
+        for pereval_id, title, other_titles in rows:
+            self.upsert(pereval_id, title, other_titles)
+
+    def upsert(self, pereval_id: int, title: Optional[str], other_titles: Optional[str]):
+        names = tuple(pass_names(title, other_titles))
+        if self._by_id.get(pereval_id) == names:
+            return
+        self.remove(pereval_id)
+        if not names:
+            return
+        self._by_id[pereval_id] = names
+        for name in names:
+            for key in _keys(name):
+                node = self._insert(key)
+                if node.names is None:
+                    node.names = {}
+                node.names[name] = node.names.get(name, 0) + 1
+
+    def remove(self, pereval_id: int):
+        for name in self._by_id.pop(pereval_id, ()):
+            for key in _keys(name):
+                self._discard(key, name)
+
+    def _insert(self, key: str) -> _Node:
+        node = self.root
+        while key:
+            edge = node.children.get(key[0])
+            if edge is None:
+                child = _Node()
+                node.children[key[0]] = (key, child)
+                return child
+            label, child = edge
+            if key.startswith(label):
+                common = len(label)
+            else:
+                common = len(os.path.commonprefix((label, key)))
+            if common < len(label):
+                # разбить ребро: общая часть -> промежуточный узел -> остаток
+                middle = _Node()
+                middle.children[label[common]] = (label[common:], child)
+                node.children[key[0]] = (label[:common], middle)
+                child = middle
+            node = child
+            key = key[common:]
+        return node
+
+    def _discard(self, key: str, name: str):
+        path = []
+        node = self.root
+        while key:
+            edge = node.children.get(key[0])
+            if edge is None or not key.startswith(edge[0]):
+                return
+            path.append((node, key[0]))
+            node = edge[1]
+            key = key[len(edge[0]):]
+        if not node.names or name not in node.names:
+            return
+        node.names[name] -= 1
+        if node.names[name] <= 0:
+            del node.names[name]
+        if not node.names:
+            node.names = None
+        # убрать опустевшие узлы и склеить рёбра у узлов с одним потомком
+        while path and node.names is None and len(node.children) <= 1:
+            parent, first = path.pop()
+            label, _ = parent.children[first]
+            if not node.children:
+                del parent.children[first]
+            else:
+                (child_label, child), = node.children.values()
+                parent.children[first] = (label + child_label, child)
+            node = parent
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[Dict[str, object]]:
+        """
+        Названия, у которых начало названия или одного из слов совпадает с prefix
+        Порядок - по алфавиту ключей, поэтому название идёт раньше своих продолжений
+        """
+        key = normalize(prefix)
+        node = self.root
+        matched = ''
+        while len(matched) < len(key):
+            rest = key[len(matched):]
+            edge = node.children.get(rest[0])
+            if edge is None:
+                return []
+            label, child = edge
+            if label.startswith(rest):
+                matched = key
+                node = child
+                break
+            if not rest.startswith(label):
+                return []
+            matched += label
+            node = child
+
+        found: Dict[str, int] = {}
+        # обход в глубину в алфавитном порядке ключей: название раньше своих продолжений
+        stack = [node]
+        while stack and len(found) < limit:
+            current = stack.pop()
+            if current.names:
+                for name in sorted(current.names):
+                    if name not in found:
+                        found[name] = current.names[name]
+                        if len(found) >= limit:
+                            break
+            stack.extend(child for _, (_, child) in sorted(current.children.items(), reverse=True))
+        return [{"title": name, "count": count} for name, count in found.items()]
@@ -0,0 +1,99 @@
+import time
+from typing import Any, Dict, Sequence, Type
+
+import orjson
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response
+from pydantic import BaseModel, ValidationError
+from starlette.requests import Request
+
+from app.metrics import codec_duration
+
+# Столбцы jsonb, которые при чтении отдаются клиенту как есть, без разбора в Python
+PASSTHROUGH_COLUMNS = ("raw_data", "images")
+
+
+def dumps(content: Any) -> bytes:
+    """JSON в байтах через orjson (datetime кодируется в ISO 8601 самим кодировщиком)"""
+    started = time.perf_counter()
+    try:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    finally:
+        codec_duration.observe(time.perf_counter() - started, "encode")
+
+
+def passthrough_row(row) -> Dict[str, Any]:
+    """
+    Запись из БД для ответа: текст jsonb из драйвера вставляется в ответ
+    как готовый фрагмент JSON (orjson.Fragment), без json.loads/dumps
+    """
+    result = dict(row)
+    for column in PASSTHROUGH_COLUMNS:
+        value = result.get(column)
+        if isinstance(value, str):
+            result[column] = orjson.Fragment(value)
+    return result
+
+
+class FastJSONResponse(Response):
+    """
+    JSON-ответ через orjson; bytes отдаются как уже закодированное тело
+
+    Возврат экземпляра Response из обработчика минует jsonable_encoder FastAPI.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+def inline_schema_refs(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON Schema модели с подставленными $defs (для openapi_extra)"""
+    defs = schema.get("$defs", {})
+
+    def resolve(node):
+        if isinstance(node, dict):
+            ref = node.get("$ref")
+            if ref and ref.startswith("#/$defs/"):
+                return resolve(defs[ref[len("#/$defs/"):]])
+            return {key: resolve(value) for key, value in node.items() if key != "$defs"}
+        if isinstance(node, list):
+            return [resolve(item) for item in node]
+        return node
+
+    return resolve(schema)
+
+
+def json_body(model: Type[BaseModel]):
+    """
+    Зависимость FastAPI: модель из тела запроса через model_validate_json
+
+    Байты тела проверяются pydantic-core напрямую, без промежуточного dict
+    из json.loads. Ошибки оформляются как обычная ошибка валидации (422).
+    """
+    async def dependency(request: Request) -> BaseModel:
+        body = await request.body()
+        started = time.perf_counter()
+        try:
+            return model.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(
+                [dict(error, loc=("body", *error["loc"])) for error in e.errors(include_url=False)]
+            )
+        finally:
+            codec_duration.observe(time.perf_counter() - started, "decode")
+
+    return dependency
+
+
+def body_openapi(model: Type[BaseModel], media_types: Sequence[str] = ("application/json",)) -> Dict[str, Any]:
+    """openapi_extra с описанием тела запроса для обработчиков с json_body"""
+    schema = inline_schema_refs(model.model_json_schema())
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {media_type: {"schema": schema} for media_type in media_types}
+        }
+    }
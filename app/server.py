@@ -0,0 +1,342 @@
+"""
+Запуск API в рабочем режиме: несколько процессов с общим сокетом
+
+    python -m app.server                      FSTR_WORKERS процессов (по умолчанию - по числу ядер)
+    python -m app.server --workers 4 --port 8000
+
+run.py - для разработки (один процесс, перезапуск при изменении файлов).
+
+Главный процесс один раз загружает приложение (app.main), открывает сокет
+и порождает рабочие процессы через fork: загруженный код у них общий
+(copy-on-write), поэтому процесс готов за время lifespan - пул соединений
+с БД (у каждого процесса свой, создаётся после fork), LISTEN, справочник
+районов. Время загрузки приложения и готовности процессов печатается,
+у процесса оно же в метрике process_startup_seconds. Упавший процесс
+перезапускается. Процесс, который не запустился (ошибка в lifespan,
+например БД недоступна), перезапускается с паузой, растущей вдвое до
+минуты; если после запуска сервера ни один процесс так и не стал готов
+за FSTR_SERVER_STARTUP_ATTEMPTS попыток подряд, главный процесс
+завершается с кодом 3.
+
+Цикл событий uvloop и разбор HTTP httptools (FSTR_SERVER_LOOP,
+FSTR_SERVER_HTTP); если их нет, используются asyncio и h11.
+
+Сигналы главному процессу:
+    SIGTERM, SIGINT  процессы перестают принимать соединения, дорабатывают
+                     начатые запросы (не дольше FSTR_SERVER_GRACEFUL_TIMEOUT)
+                     и завершаются
+    SIGHUP           замена без простоя: главный процесс перезапускает себя
+                     (заново загружая код) с тем же сокетом, запускает новые
+                     процессы и, когда они готовы, завершает старые так же,
+                     как по SIGTERM
+"""
+import argparse
+import gc
+import importlib
+import os
+import select
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SERVER_WORKERS = int(os.getenv('FSTR_WORKERS', '0')) or os.cpu_count() or 1
+SERVER_HOST = os.getenv('FSTR_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('FSTR_PORT', '8000'))
+SERVER_BACKLOG = int(os.getenv('FSTR_SERVER_BACKLOG', '2048'))
+SERVER_KEEPALIVE = int(os.getenv('FSTR_SERVER_KEEPALIVE', '5'))
+SERVER_GRACEFUL_TIMEOUT = float(os.getenv('FSTR_SERVER_GRACEFUL_TIMEOUT', '30'))
+SERVER_LOOP = os.getenv('FSTR_SERVER_LOOP', 'uvloop')
+SERVER_HTTP = os.getenv('FSTR_SERVER_HTTP', 'httptools')
+SERVER_ACCESS_LOG = os.getenv('FSTR_SERVER_ACCESS_LOG', '0') == '1'
+SERVER_LOG_LEVEL = os.getenv('FSTR_SERVER_LOG_LEVEL', 'info')
+APP = "app.main:app"
+
+# Передаются перезапущенному по SIGHUP главному процессу
+SOCKET_FD_ENV = "FSTR_SERVER_FD"
+OLD_WORKERS_ENV = "FSTR_SERVER_OLD_WORKERS"
+
+# Процесс, упавший быстрее, перезапускается с паузой (чтобы не крутить цикл падений)
+MIN_WORKER_LIFETIME = 1.0
+# Код выхода процесса, не прошедшего lifespan; пауза перед его перезапуском растёт до MAX_RESPAWN_DELAY
+STARTUP_FAILED = 3
+MAX_RESPAWN_DELAY = 60.0
+SERVER_STARTUP_ATTEMPTS = int(os.getenv('FSTR_SERVER_STARTUP_ATTEMPTS', '5'))
+
+
+def available(option: str, module: str, fallback: str) -> str:
+    """option, если модуль module установлен, иначе fallback"""
+    try:
+        importlib.import_module(module)
+        return option
+    except ImportError:
+        print(f"{module} не установлен, используется {fallback}")
+        return fallback
+
+
+def load_app(path: str):
+    """Объект приложения по строке "модуль:атрибут" """
+    module_name, _, attr = path.partition(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def open_socket(host: str, port: int, backlog: int) -> socket.socket:
+    """Сокет, унаследованный от прежнего главного процесса (SIGHUP), или новый"""
+    fd = os.environ.pop(SOCKET_FD_ENV, None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock: socket.socket, config: Dict, forked_at: float, ready_fd: int) -> bool:
+    """
+    Рабочий процесс: uvicorn на общем сокете; после lifespan сообщает
+    о готовности. False, если процесс не запустился (ошибка в lifespan)
+    """
+    import uvicorn
+    from app import metrics
+
+    master_pid = os.getppid()
+
+    class WorkerServer(uvicorn.Server):
+        async def startup(self, sockets=None):
+            await super().startup(sockets=sockets)
+            if self.should_exit:
+                return
+            startup = time.perf_counter() - forked_at
+            metrics.process_startup.set(startup)
+            print(f"Процесс {os.getpid()} готов за {startup:.3f} с")
+            os.write(ready_fd, f"{os.getpid()}\n".encode())
+
+        async def on_tick(self, counter: int) -> bool:
+            # главный процесс завершился аварийно - дорабатываем и выходим
+            if os.getppid() != master_pid:
+                self.should_exit = True
+            return await super().on_tick(counter)
+
+    server = WorkerServer(uvicorn.Config(app, **config))
+    server.run(sockets=[sock])
+    return server.started
+
+
+class Master:
+    """Главный процесс: порождает рабочие процессы, следит за ними и обрабатывает сигналы"""
+
+    def __init__(self, app, sock: socket.socket, workers: int, config: Dict, old_workers: List[int]):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.config = config
+        self.children: Dict[int, float] = {}  # pid -> время запуска
+        self.ready: set = set()
+        # процессы прежнего главного процесса (до SIGHUP): завершаются, когда новые готовы
+        self.old_workers = set(old_workers)
+        self.stopping = False
+        self.exit_code = 0
+        # был ли готов хоть один процесс, неудачные запуски подряд и когда можно порождать процессы
+        self.started = False
+        self.failures = 0
+        self.respawn_at = 0.0
+        self._signals: List[int] = []
+        self._ready_r, self._ready_w = os.pipe()
+        self._wake_r, self._wake_w = os.pipe()
+
+    def spawn(self):
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        # рабочий процесс; SIGTERM и SIGINT обрабатывает uvicorn, SIGHUP - только главный процесс
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            for fd in (self._ready_r, self._wake_r, self._wake_w):
+                os.close(fd)
+            code = 0 if run_worker(self.app, self.sock, self.config, forked_at, self._ready_w) else STARTUP_FAILED
+        except Exception as e:
+            print(f"Ошибка в процессе {os.getpid()}: {e}")
+        finally:
+            sys.stdout.flush()
+            os._exit(code)
+
+    def run(self) -> int:
+        """Код выхода: 0 или STARTUP_FAILED, если процессы так и не запустились"""
+        for fd in (self._wake_r, self._wake_w, self._ready_r):
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self._wake_w)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, self._on_signal)
+
+        # старые процессы могли завершиться, пока главный процесс перезапускался
+        self.reap()
+        for _ in range(self.workers):
+            self.spawn()
+        print(f"Главный процесс {os.getpid()}: процессов {self.workers}, "
+              f"адрес {self.sock.getsockname()[:2]}")
+
+        while self.children or not self.stopping:
+            try:
+                readable, _, _ = select.select([self._wake_r, self._ready_r], [], [], 1.0)
+            except InterruptedError:
+                readable = []
+            if self._ready_r in readable:
+                self.read_ready()
+            if self._wake_r in readable:
+                self._drain(self._wake_r)
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reexec()
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+            self.reap()
+            if self.exit_code and not self.stopping:
+                self.stop()
+            if not self.stopping and time.monotonic() >= self.respawn_at:
+                for _ in range(self.workers - len(self.children)):
+                    self.spawn()
+        print(f"Главный процесс {os.getpid()} завершён")
+        return self.exit_code
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    @staticmethod
+    def _drain(fd: int) -> bytes:
+        data = b''
+        try:
+            while True:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    break
+                data += chunk
+        except BlockingIOError:
+            pass
+        return data
+
+    def read_ready(self):
+        for line in self._drain(self._ready_r).split():
+            self.ready.add(int(line))
+            self.started = True
+            self.failures = 0
+        if self.old_workers and self.children and self.ready >= set(self.children):
+            print(f"Новые процессы готовы, завершаются прежние: {sorted(self.old_workers)}")
+            self.terminate(self.old_workers)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.old_workers.discard(pid)
+            self.ready.discard(pid)
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            delay = 0.0
+            if code == STARTUP_FAILED:
+                self.failures += 1
+                if not self.started and not self.old_workers and self.failures >= SERVER_STARTUP_ATTEMPTS:
+                    print(f"Процесс {pid} не запустился (код {code}), попыток подряд: {self.failures}; "
+                          f"сервер завершается")
+                    self.exit_code = STARTUP_FAILED
+                    continue
+                delay = min(MIN_WORKER_LIFETIME * 2 ** (self.failures - 1), MAX_RESPAWN_DELAY)
+            elif time.monotonic() - started < MIN_WORKER_LIFETIME:
+                delay = MIN_WORKER_LIFETIME
+            print(f"Процесс {pid} завершился (код {code}), новый запускается через {delay:.0f} с")
+            # пауза без sleep: сигналы главному процессу обрабатываются и во время неё
+            self.respawn_at = max(self.respawn_at, time.monotonic() + delay)
+
+    @staticmethod
+    def terminate(pids):
+        for pid in list(pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        """Плавное завершение: процессы дорабатывают начатые запросы, потом принудительно"""
+        if self.stopping:
+            return
+        self.stopping = True
+        pids = set(self.children) | self.old_workers
+        print(f"Завершение: процессов {len(pids)}")
+        self.terminate(pids)
+        deadline = time.monotonic() + SERVER_GRACEFUL_TIMEOUT + 5
+        while (self.children or self.old_workers) and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in set(self.children) | self.old_workers:
+            print(f"Процесс {pid} не завершился вовремя")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.children.clear()
+        self.old_workers.clear()
+
+    def reexec(self):
+        """SIGHUP: перезапустить главный процесс с новым кодом, сохранив сокет и процессы"""
+        print(f"Перезапуск главного процесса {os.getpid()}: процессы {sorted(self.children)} "
+              f"завершатся, когда будут готовы новые")
+        sys.stdout.flush()
+        signal.set_wakeup_fd(-1)
+        env = dict(os.environ)
+        env[SOCKET_FD_ENV] = str(self.sock.fileno())
+        env[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in set(self.children) | self.old_workers)
+        os.execve(sys.executable, [sys.executable, '-m', 'app.server'] + sys.argv[1:], env)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Запуск API в рабочем режиме")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="рабочих процессов")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--app", default=APP, help="приложение, модуль:атрибут")
+    args = parser.parse_args(argv)
+
+    config = dict(
+        loop=available('uvloop', 'uvloop', 'asyncio') if SERVER_LOOP == 'uvloop' else SERVER_LOOP,
+        http=available('httptools', 'httptools', 'h11') if SERVER_HTTP == 'httptools' else SERVER_HTTP,
+        lifespan='on',
+        access_log=SERVER_ACCESS_LOG,
+        log_level=SERVER_LOG_LEVEL,
+        timeout_keep_alive=SERVER_KEEPALIVE,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT,
+        backlog=SERVER_BACKLOG,
+    )
+    sock = open_socket(args.host, args.port, SERVER_BACKLOG)
+    started = time.perf_counter()
+    app = load_app(args.app)
+    # загруженные объекты не просматриваются сборщиком циклов: страницы
+    # памяти, общие с рабочими процессами, не копируются при сборке
+    gc.freeze()
+    print(f"Приложение загружено за {time.perf_counter() - started:.3f} с")
+
+    old_workers = [int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid]
+    sys.exit(Master(app, sock, args.workers, config, old_workers).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Статистика перевалов из счётчиков (миграция 0010)
+
+Счётчики pereval_stats и pereval_contributors обновляют триггеры
+при каждом добавлении, изменении (в том числе смене статуса) и удалении
+записи, поэтому чтение не зависит от числа записей: суммируются
+несколько строк одного разреза. Ответы кэшируются в процессе на
+FSTR_STATS_TTL секунд.
+
+Сервер раз в FSTR_STATS_RECONCILE_INTERVAL секунд сверяет счётчики
+с данными (pereval_stats_reconcile) - на случай записей в обход триггеров
+(отключённые триггеры, восстановление из копии). То же вручную:
+
+    python -m app.stats reconcile
+"""
+import argparse
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.cache import LRUTTLCache
+
+STATS_TTL = float(os.getenv('FSTR_STATS_TTL', '10'))
+STATS_RECONCILE_INTERVAL = float(os.getenv('FSTR_STATS_RECONCILE_INTERVAL', str(6 * 3600)))
+LEVEL_SEASONS = ('winter', 'summer', 'autumn', 'spring')
+# Разрезы pereval_stats (функция pereval_stat_keys)
+STATS_DIMENSIONS = ('total', 'status', 'month', 'area') + tuple(f'level_{season}' for season in LEVEL_SEASONS)
+# Сколько авторов читается из БД; запрос с меньшим limit берёт начало списка
+CONTRIBUTORS_MAX_LIMIT = 100
+# Район - ячейка сетки AREA_STEP x AREA_STEP градусов
+AREA_STEP = 1
+
+STATS_QUERY = """
+SELECT dimension, key, sum(count)::bigint AS count
+FROM pereval_stats
+WHERE dimension = ANY($1::text[])
+GROUP BY dimension, key
+HAVING sum(count) > 0
+"""
+TOP_CONTRIBUTORS_QUERY = """
+SELECT email, count FROM pereval_contributors
+WHERE count > 0
+ORDER BY count DESC, email
+LIMIT $1
+"""
+RECONCILE_QUERY = "SELECT pereval_stats_reconcile()"
+
+
+def area_bounds(key: str) -> Dict[str, Any]:
+    """Границы района по ключу "широта,долгота" юго-западного угла ячейки"""
+    lat, lon = (int(value) for value in key.split(','))
+    return {"lat_min": lat, "lon_min": lon, "lat_max": lat + AREA_STEP, "lon_max": lon + AREA_STEP}
+
+
+class StatsReader:
+    """Чтение счётчиков статистики с кэшем в памяти процесса"""
+
+    def __init__(self, db_manager, ttl: float = STATS_TTL):
+        self.db = db_manager
+        self._cache = LRUTTLCache(max_entries=len(STATS_DIMENSIONS) + 1, ttl=ttl)
+
+    async def counts(self, dimension: str) -> Dict[str, int]:
+        """Число записей по ключам разреза: {ключ: число}"""
+        counts = await self._cache.get(dimension)
+        if counts is None:
+            counts = (await self.db.get_stats([dimension])).get(dimension, {})
+            await self._cache.set(dimension, counts)
+        return counts
+
+    async def total(self) -> int:
+        return (await self.counts('total')).get('', 0)
+
+    async def levels(self) -> Dict[str, Dict[str, int]]:
+        """Категории сложности по сезонам: {сезон: {категория: число}}; "" - без категории"""
+        return {season: await self.counts(f'level_{season}') for season in LEVEL_SEASONS}
+
+    async def contributors(self, limit: int) -> List[Dict[str, Any]]:
+        """Авторы с наибольшим числом записей"""
+        top = await self._cache.get('contributors')
+        if top is None:
+            top = await self.db.get_top_contributors(CONTRIBUTORS_MAX_LIMIT)
+            await self._cache.set('contributors', top)
+        return top[:limit]
+
+
+def ranked(counts: Dict[str, int], limit: Optional[int] = None) -> List[Tuple[str, int]]:
+    """Пары (ключ, число) по убыванию числа, не больше limit"""
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def main():
+    from app.database import DatabaseManager
+
+    parser = argparse.ArgumentParser(description="Статистика перевалов")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("reconcile", help="сверить счётчики с данными и исправить расхождения")
+    parser.parse_args()
+
+    conn = DatabaseManager().connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(RECONCILE_QUERY)
+            fixed = cursor.fetchone()['pereval_stats_reconcile']
+        conn.commit()
+    finally:
+        conn.close()
+    if fixed is None:
+        print("Сверка уже выполняется другим процессом")
+    else:
+        print(f"Исправлено счётчиков: {fixed}")
+
+
+if __name__ == "__main__":
+    main()
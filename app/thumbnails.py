@@ -0,0 +1,126 @@
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+THUMB_SIZE = int(os.getenv('FSTR_THUMB_SIZE', '320'))
+# при переполнении кэш вытесняется до этой доли объёма, чтобы не пересчитывать каталог на каждой записи
+THUMB_CACHE_LOW_WATERMARK = 0.9
+
+
+class BadImageError(ValueError):
+    """Изображение не удалось разобрать"""
+
+
+def make_thumbnail(data: bytes, size: int = THUMB_SIZE) -> bytes:
+    """
+    Уменьшает изображение до size точек по большей стороне, возвращает JPEG
+    Pillow импортируется лениво: без него эскизы недоступны, остальное API работает
+    """
+    from PIL import Image as PILImage
+
+    try:
+        with PILImage.open(io.BytesIO(data)) as img:
+            img.thumbnail((size, size))
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            out = io.BytesIO()
+            img.save(out, format='JPEG', quality=80, optimize=True)
+            return out.getvalue()
+    except (OSError, ValueError, SyntaxError, PILImage.DecompressionBombError) as e:
+        # так Pillow сообщает о повреждённых и неподдерживаемых файлах
+        raise BadImageError(str(e))
+
+
+class ThumbnailCache:
+    """
+    Ограниченный по объёму кэш эскизов на диске с вытеснением LRU
+
+    Порядок использования хранится в памяти и при запуске восстанавливается
+    по времени последнего доступа к файлам. Запись атомарная (временный файл
+    и os.replace), поэтому несколько процессов могут делить один каталог:
+    эскиз, которого нет в памяти, сначала ищется на диске, а перед
+    вытеснением каталог пересчитывается заново, чтобы max_bytes ограничивал
+    его целиком, а не долю каждого процесса.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        self._entries.clear()
+        self._total = 0
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            files.append((st.st_atime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Эскиз из кэша (в том числе записанный другим процессом) или None"""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # нет или вытеснил другой процесс
+            with self._lock:
+                self._total -= self._entries.pop(key, 0)
+            return None
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total += len(data)
+        return data
+
+    def put(self, key: str, data: bytes) -> str:
+        """Сохраняет эскиз и вытесняет самые старые, если кэш переполнен"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total += len(data)
+            evicted = []
+            if self._total > self.max_bytes:
+                # в каталоге есть и эскизы других процессов
+                self._load()
+                self._entries.move_to_end(key)
+            while self._total > self.max_bytes * THUMB_CACHE_LOW_WATERMARK and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.unlink(self.path(old_key))
+            except FileNotFoundError:
+                pass
+        return self.path(key)
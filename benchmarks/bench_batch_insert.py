@@ -0,0 +1,63 @@
+"""
+Сравнение скорости вставки: по одной записи (как POST /submitData)
+и пакетом (как POST /submitData/batch)
+
+Запуск (БД из переменных FSTR_DB_*; записи остаются в pereval_added):
+    python -m benchmarks.bench_batch_insert --rows 2000 --batch 100
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from app.async_database import AsyncDatabaseManager
+from benchmarks.synthetic import make_pereval
+
+
+async def bench_single(db: AsyncDatabaseManager, items, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def add(item):
+        async with semaphore:
+            await db.add_pereval(item)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(add(item) for item in items))
+    return time.perf_counter() - start
+
+
+async def bench_batch(db: AsyncDatabaseManager, items, batch: int) -> float:
+    start = time.perf_counter()
+    for pos in range(0, len(items), batch):
+        await db.add_perevals(items[pos:pos + batch])
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--images", type=int, default=1, help="изображений на запись")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="параллельных вставок в режиме по одной записи")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    items = [make_pereval(i, rng, images=args.images) for i in range(args.rows)]
+
+    db = AsyncDatabaseManager()
+    await db.connect()
+    try:
+        single = await bench_single(db, items, args.concurrency)
+        batched = await bench_batch(db, items, args.batch)
+    finally:
+        await db.close()
+
+    print(f"Записей: {args.rows}, изображений на запись: {args.images}")
+    print(f"По одной (concurrency={args.concurrency}): {args.rows / single:.1f} строк/с ({single:.2f} с)")
+    print(f"Пакетами по {args.batch}: {args.rows / batched:.1f} строк/с ({batched:.2f} с)")
+    print(f"Ускорение: x{single / batched:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
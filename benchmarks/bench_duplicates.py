@@ -0,0 +1,104 @@
+"""
+Индекс возможных дубликатов (app.duplicates.DuplicateIndex): построение,
+память и время проверки одной отправки - столько добавляет поиск
+дубликатов к POST /submitData
+
+Проверяются два вида отправок: новые перевалы в случайных местах
+и повторы существующих (другая запись названия, «пер.»/«перевал»,
+название из other_titles, смещение до 500 м); для повторов считается
+доля найденных.
+
+Запуск:
+    python -m benchmarks.bench_duplicates --rows 100000 1000000
+"""
+import argparse
+import math
+import random
+import statistics
+import time
+
+from app.duplicates import METERS_PER_DEGREE, DuplicateIndex
+from benchmarks.bench_suggest import resident_memory
+from benchmarks.synthetic import make_pereval
+
+PREFIXES = ["", "пер. ", "перевал ", "Пер. "]
+
+
+def respelled(rng: random.Random, record: tuple) -> tuple:
+    """Повтор записи другим пользователем: другое написание и координаты в пределах 500 м"""
+    _, lat, lon, title, other_titles = record
+    name = title if rng.random() < 0.7 or not other_titles else other_titles
+    if rng.random() < 0.3:
+        name = name.upper()
+    shift = rng.uniform(0, 500) / METERS_PER_DEGREE
+    angle = rng.uniform(0, 2 * math.pi)
+    lat += shift * math.sin(angle)
+    lon += shift * math.cos(angle) / math.cos(math.radians(lat))
+    return lat, lon, rng.choice(PREFIXES) + name, None
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return (statistics.median(timings) * 1e6, timings[int(len(timings) * 0.99)] * 1e6, timings[-1] * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000])
+    parser.add_argument("--queries", type=int, default=10000)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        rng = random.Random(42)
+        data = []
+        for i in range(rows):
+            item = make_pereval(i, rng, images=0)
+            data.append((i, float(item["coords"]["latitude"]), float(item["coords"]["longitude"]),
+                         item["beauty_title"] + item["title"], item["other_titles"]))
+
+        rss = resident_memory()
+        started = time.perf_counter()
+        index = DuplicateIndex()
+        index.load(data)
+        build = time.perf_counter() - started
+        memory = resident_memory() - rss
+
+        fresh = []
+        for i in range(args.queries):
+            item = make_pereval(rows + i, rng, images=0)
+            fresh.append((float(item["coords"]["latitude"]), float(item["coords"]["longitude"]),
+                          item["title"], item["other_titles"]))
+        originals = [rng.choice(data) for _ in range(args.queries)]
+        repeats = [respelled(rng, record) for record in originals]
+
+        fresh_timings = []
+        fresh_found = 0
+        for query in fresh:
+            started = time.perf_counter()
+            found = index.find(*query)
+            fresh_timings.append(time.perf_counter() - started)
+            fresh_found += bool(found)
+
+        repeat_timings = []
+        hits = 0
+        for original, query in zip(originals, repeats):
+            started = time.perf_counter()
+            found = index.find(*query)
+            repeat_timings.append(time.perf_counter() - started)
+            hits += any(pereval_id == original[0] for pereval_id, _, _ in found)
+
+        started = time.perf_counter()
+        for i in range(1000):
+            index.upsert(i, *fresh[i])
+        update = (time.perf_counter() - started) / 1000
+
+        print(f"Перевалов: {rows}: построение {build:.1f} с, память {memory / 2 ** 20:.0f} МиБ, "
+              f"обновление {update * 1e6:.0f} мкс, ячеек {len(index.cells)}")
+        print("  новый перевал: p50 {:.0f} мкс, p99 {:.0f} мкс, max {:.0f} мкс".format(*percentiles(fresh_timings)),
+              f"с кандидатами {fresh_found / len(fresh):.1%}")
+        print("  повтор:        p50 {:.0f} мкс, p99 {:.0f} мкс, max {:.0f} мкс".format(*percentiles(repeat_timings)),
+              f"найден оригинал {hits / len(repeats):.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Время поиска перевалов по email в зависимости от числа строк:
+старая схема (json, фильтр по raw_data->'user'->>'email', без индексов)
+против новой (jsonb, столбец email с индексом (email, id))
+
+Таблицы создаются как временные в отдельном соединении,
+рабочие данные не затрагиваются. Запуск (БД из FSTR_DB_*):
+    python -m benchmarks.bench_email_lookup --rows 1000 10000 100000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from app.database import DatabaseManager
+
+SEED_SQL = """
+INSERT INTO {table} (id, raw_data)
+SELECT g, json_build_object(
+    'title', 'Перевал ' || g,
+    'status', 'new',
+    'user', json_build_object('email', 'user' || (g %% %(users)s) || '@example.com'),
+    'coords', json_build_object('latitude', '45.3842', 'longitude', '7.1525', 'height', '1200')
+){cast}
+FROM generate_series(%(lo)s, %(hi)s) AS g
+"""
+
+
+def create_tables(cursor):
+    cursor.execute("""
+    CREATE TEMP TABLE old_layout (id int PRIMARY KEY, raw_data json);
+    CREATE TEMP TABLE new_layout (id int PRIMARY KEY, raw_data jsonb,
+        email text GENERATED ALWAYS AS (raw_data->'user'->>'email') STORED);
+    CREATE INDEX ON new_layout (email, id);
+    """)
+
+
+def grow(cursor, start: int, rows: int, users: int):
+    for table, cast in (('old_layout', ''), ('new_layout', '::jsonb')):
+        cursor.execute(SEED_SQL.format(table=table, cast=cast),
+                       {'lo': start + 1, 'hi': rows, 'users': users})
+        cursor.execute(f"ANALYZE {table}")
+
+
+def measure(cursor, query: str, emails) -> float:
+    timings = []
+    for email in emails:
+        started = time.perf_counter()
+        cursor.execute(query, (email,))
+        cursor.fetchall()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--users", type=int, default=1000, help="различных email")
+    parser.add_argument("--lookups", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    conn = DatabaseManager().connect()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            create_tables(cursor)
+            print(f"{'строк':>10} {'json, мс':>10} {'индекс, мс':>11} {'ускорение':>10}")
+            current = 0
+            for rows in sorted(args.rows):
+                grow(cursor, current, rows, args.users)
+                current = rows
+                emails = [f"user{rng.randrange(args.users)}@example.com" for _ in range(args.lookups)]
+                old = measure(cursor, "SELECT id, raw_data FROM old_layout "
+                                      "WHERE raw_data->'user'->>'email' = %s ORDER BY id LIMIT 100", emails)
+                new = measure(cursor, "SELECT id, raw_data FROM new_layout "
+                                      "WHERE email = %s ORDER BY id LIMIT 100", emails)
+                print(f"{rows:>10} {old:>10.2f} {new:>11.2f} {old / new:>9.1f}x")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
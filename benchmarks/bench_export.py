@@ -0,0 +1,100 @@
+"""
+Память и скорость кодирования выгрузки (app.export) в зависимости от числа записей
+
+Записи в том виде, в каком их отдаёт AsyncDatabaseManager.iter_export,
+генерируются порциями и кодируются в NDJSON, GeoJSON и Parquet; байты
+выгрузки отбрасываются. Каждый замер - в отдельном процессе, чтобы пиковый
+RSS не зависел от предыдущих. Память должна оставаться постоянной при росте
+числа записей. БД не нужна. Запуск:
+    python -m benchmarks.bench_export --rows 1000 100000 1000000
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import multiprocessing
+import random
+import resource
+import time
+
+import orjson
+
+from app.database import build_images_json, build_raw_data
+from app.export import EXPORT_BATCH_SIZE, ENCODERS, check_format
+from app.geo import parse_coord
+from benchmarks.synthetic import make_pereval
+
+DISTINCT_ROWS = 1000
+
+
+def make_rows():
+    rng = random.Random(42)
+    rows = []
+    for i in range(DISTINCT_ROWS):
+        payload = make_pereval(i, rng, images=0)
+        raw_data = build_raw_data(payload)
+        rows.append({
+            "date_added": datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=i),
+            "version": 1,
+            "raw_data": orjson.dumps(raw_data).decode(),
+            "images": orjson.dumps(build_images_json(
+                ["Фото 1", "Фото 2"], [hashlib.sha256(b"%d" % n).hexdigest() for n in (2 * i, 2 * i + 1)]
+            )).decode(),
+            "status": "new",
+            "latitude": parse_coord(raw_data["coords"]["latitude"]),
+            "longitude": parse_coord(raw_data["coords"]["longitude"]),
+        })
+    return rows
+
+
+async def batches(rows, total: int, batch_size: int):
+    for start in range(0, total, batch_size):
+        yield [dict(rows[n % DISTINCT_ROWS], id=n + 1) for n in range(start, min(start + batch_size, total))]
+
+
+def run(fmt: str, total: int, batch_size: int, result):
+    rows = make_rows()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    async def consume():
+        size = 0
+        async for chunk in ENCODERS[fmt](batches(rows, total, batch_size)):
+            size += len(chunk)
+        return size
+
+    started = time.perf_counter()
+    size = asyncio.run(consume())
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result.put((elapsed, size, baseline, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument("--formats", nargs="+", default=sorted(ENCODERS))
+    args = parser.parse_args()
+
+    formats = []
+    for fmt in args.formats:
+        try:
+            check_format(fmt)
+            formats.append(fmt)
+        except ImportError:
+            print(f"{fmt}: пропущен, не установлен pyarrow")
+
+    print(f"{'формат':>8} {'записей':>9} {'записей/с':>10} {'МиБ/с':>7} {'размер, МиБ':>12} {'пик RSS, МиБ':>13} {'прирост, МиБ':>13}")
+    for fmt in formats:
+        for total in args.rows:
+            result = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run, args=(fmt, total, args.batch_size, result))
+            process.start()
+            elapsed, size, baseline, peak = result.get()
+            process.join()
+            print(f"{fmt:>8} {total:>9} {total / elapsed:>10.0f} {size / elapsed / 2 ** 20:>7.1f} "
+                  f"{size / 2 ** 20:>12.1f} {peak / 1024:>13.1f} {(peak - baseline) / 1024:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Задержки геопоиска на синтетических точках
+
+- построение k-d дерева и запрос 20 ближайших (в памяти процесса);
+- поиск в прямоугольнике ~1x1 градус в БД по индексу geo_cell
+  (временная таблица, рабочие данные не затрагиваются).
+
+Запуск (БД из FSTR_DB_*):
+    python -m benchmarks.bench_geo --points 10000 100000 1000000
+    python -m benchmarks.bench_geo --no-db
+"""
+import argparse
+import gc
+import random
+import statistics
+import time
+
+from app.database import DatabaseManager
+from app.geo import KDTree, cells_for_bbox
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return (statistics.median(timings) * 1000,
+            timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1000)
+
+
+def random_point(rng):
+    return rng.uniform(36.0, 55.0), rng.uniform(40.0, 100.0)
+
+
+def bench_memory(n: int, queries: int, rng):
+    points = [(i, *random_point(rng)) for i in range(n)]
+    started = time.perf_counter()
+    tree = KDTree(points)
+    build = time.perf_counter() - started
+    # как в приложении после загрузки индекса
+    gc.freeze()
+
+    timings = []
+    for _ in range(queries):
+        lat, lon = random_point(rng)
+        started = time.perf_counter()
+        tree.nearest(lat, lon, 20)
+        timings.append(time.perf_counter() - started)
+    return build, percentiles(timings)
+
+
+def bench_db(cursor, n: int, queries: int, rng):
+    cursor.execute("DROP TABLE IF EXISTS bench_geo")
+    cursor.execute("""
+    CREATE TEMP TABLE bench_geo AS
+    SELECT g AS id, 36 + random() * 19 AS latitude, 40 + random() * 60 AS longitude
+    FROM generate_series(1, %s) AS g
+    """, (n,))
+    cursor.execute("ALTER TABLE bench_geo ADD COLUMN geo_cell integer")
+    cursor.execute("""
+    UPDATE bench_geo SET geo_cell = (LEAST(floor((latitude + 90) / 0.25), 719) * 1440
+                                     + LEAST(floor((longitude + 180) / 0.25), 1439))::integer
+    """)
+    cursor.execute("CREATE INDEX ON bench_geo (geo_cell)")
+    cursor.execute("ANALYZE bench_geo")
+
+    timings = []
+    for _ in range(queries):
+        lat, lon = random_point(rng)
+        box = (lat, lon, lat + 1, lon + 1)
+        started = time.perf_counter()
+        cursor.execute("""
+        SELECT id, latitude, longitude FROM bench_geo
+        WHERE geo_cell = ANY(%s) AND latitude BETWEEN %s AND %s AND longitude BETWEEN %s AND %s
+        LIMIT 500
+        """, (cells_for_bbox(*box), box[0], box[2], box[1], box[3]))
+        cursor.fetchall()
+        timings.append(time.perf_counter() - started)
+    return percentiles(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--points", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--no-db", action="store_true", help="не измерять поиск в БД")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    conn = None
+    if not args.no_db:
+        conn = DatabaseManager().connect()
+        conn.autocommit = True
+    try:
+        print(f"{'точек':>9} {'дерево, с':>10} {'20 ближ. p50/p99, мс':>22} {'bbox БД p50/p99, мс':>21}")
+        for n in args.points:
+            build, (near50, near99) = bench_memory(n, args.queries, rng)
+            bbox = '-'
+            if conn:
+                with conn.cursor() as cursor:
+                    box50, box99 = bench_db(cursor, n, args.queries, rng)
+                bbox = f"{box50:.2f} / {box99:.2f}"
+            print(f"{n:>9} {build:>10.2f} {f'{near50:.3f} / {near99:.3f}':>22} {bbox:>21}")
+    finally:
+        if conn:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Запись перевалов по одной (add_pereval, коммит на запрос) против очереди
+отложенной записи с групповым коммитом (app.ingest.IngestQueue)
+
+Время очереди - до записи в БД последнего перевала, а не до ответа клиенту.
+Запуск (БД из переменных FSTR_DB_*; записи остаются в pereval_added):
+    python -m benchmarks.bench_ingest --rows 2000 --concurrency 32 --durability fsync
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+
+from app.async_database import AsyncDatabaseManager
+from app.ingest import PERSISTED, IngestQueue
+from app.models import PerevalData
+from benchmarks.synthetic import make_pereval
+
+
+async def run_limited(items, concurrency: int, func):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(call(item) for item in items))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременных запросов")
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--flush-ms", type=float, default=50)
+    parser.add_argument("--durability", choices=("none", "os", "fsync"), default="os")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    items = [PerevalData.model_validate(make_pereval(i, rng)) for i in range(args.rows)]
+
+    db = AsyncDatabaseManager()
+    await db.connect()
+    try:
+        started = time.perf_counter()
+        await run_limited(items, args.concurrency, db.add_pereval)
+        direct = time.perf_counter() - started
+
+        with tempfile.TemporaryDirectory() as spill_dir:
+            queue = IngestQueue(db, batch_size=args.batch, flush_interval=args.flush_ms / 1000,
+                                spill_dir=spill_dir, durability=args.durability)
+            await queue.start()
+            started = time.perf_counter()
+            ids = await run_limited(items, args.concurrency, queue.submit)
+            accepted = time.perf_counter() - started
+            while any(queue.status(pereval_id)[0] != PERSISTED for pereval_id in ids):
+                await asyncio.sleep(0.005)
+            queued = time.perf_counter() - started
+            await queue.close()
+    finally:
+        await db.close()
+
+    print(f"Записей: {args.rows}, одновременных запросов: {args.concurrency}")
+    print(f"По одной: {args.rows / direct:.0f} записей/с ({direct:.2f} с)")
+    print(f"Очередь (журнал: {args.durability}): {args.rows / queued:.0f} записей/с ({queued:.2f} с), "
+          f"приём {args.rows / accepted:.0f} записей/с")
+    print(f"Ускорение: x{direct / queued:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
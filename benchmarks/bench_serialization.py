@@ -0,0 +1,69 @@
+"""
+CPU на сериализацию одного запроса без учёта БД: прежний путь и быстрый
+
+Запись (POST /submitData):
+  было:  json.loads -> PerevalData.model_validate -> .dict() -> сборка raw_data -> json.dumps
+  стало: PerevalData.model_validate_json(bytes) -> model_dump(by_alias) -> orjson
+Чтение (GET /submitData/{id}):
+  было:  json.loads jsonb -> dict(row) -> isoformat -> jsonable_encoder -> json.dumps
+  стало: текст jsonb как orjson.Fragment, datetime кодирует orjson
+
+Запуск:
+    python -m benchmarks.bench_serialization --iterations 20000
+"""
+import argparse
+import datetime
+import json
+import random
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+
+from app.database import build_raw_data
+from app.models import PerevalData
+from app.serialization import dumps, passthrough_row
+from benchmarks.synthetic import make_pereval
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    payload = make_pereval(1, random.Random(42), images=2)
+    body = json.dumps(payload, ensure_ascii=False).encode()
+
+    def submit_before():
+        model = PerevalData.model_validate(json.loads(body))
+        json.dumps(build_raw_data(model.model_dump()))
+
+    def submit_after():
+        model = PerevalData.model_validate_json(body)
+        dumps(build_raw_data(model))
+
+    raw_text = json.dumps(build_raw_data(PerevalData.model_validate(payload)), ensure_ascii=False)
+    images_text = json.dumps({"images": [{"id": 1, "title": "Фото 1"}, {"id": 2, "title": "Фото 2"}]},
+                             ensure_ascii=False)
+    date_added = datetime.datetime(2024, 7, 1, 12, 30, 15, 123456)
+
+    def read_before():
+        row = {"id": 1, "date_added": date_added,
+               "raw_data": json.loads(raw_text), "images": json.loads(images_text)}
+        pereval = dict(row)
+        pereval['date_added'] = pereval['date_added'].isoformat()
+        json.dumps(jsonable_encoder(pereval), ensure_ascii=False).encode()
+
+    def read_after():
+        row = {"id": 1, "date_added": date_added, "raw_data": raw_text, "images": images_text}
+        dumps(passthrough_row(row))
+
+    print(f"{'путь':<8} {'было, мкс':>10} {'стало, мкс':>11} {'ускорение':>10}")
+    for name, before, after in (("запись", submit_before, submit_after),
+                                ("чтение", read_before, read_after)):
+        old = min(timeit.repeat(before, number=args.iterations, repeat=3)) / args.iterations * 1e6
+        new = min(timeit.repeat(after, number=args.iterations, repeat=3)) / args.iterations * 1e6
+        print(f"{name:<8} {old:>10.1f} {new:>11.1f} {old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Дерево подсказок названий (app.search.SuggestTrie): построение, память
+и время ответа на префиксы длиной 1-5 символов
+
+Запуск:
+    python -m benchmarks.bench_suggest --rows 100000 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+from app.search import SuggestTrie, normalize
+from benchmarks.synthetic import make_pereval
+
+
+def resident_memory() -> int:
+    """Резидентная память процесса, байт (Linux)"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000])
+    parser.add_argument("--queries", type=int, default=10000)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        rng = random.Random(42)
+        data = []
+        for i in range(rows):
+            item = make_pereval(i, rng, images=0)
+            data.append((i, item["title"], item["other_titles"]))
+
+        rss = resident_memory()
+        started = time.perf_counter()
+        trie = SuggestTrie()
+        trie.load(data)
+        build = time.perf_counter() - started
+        memory = resident_memory() - rss
+
+        prefixes = []
+        for _ in range(args.queries):
+            title = normalize(rng.choice(data)[1])
+            prefixes.append(title[:rng.randint(1, 5)])
+        timings = []
+        for prefix in prefixes:
+            started = time.perf_counter()
+            trie.suggest(prefix, 10)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+
+        started = time.perf_counter()
+        for i in range(1000):
+            trie.upsert(i, f"Новое название {i}", None)
+        update = (time.perf_counter() - started) / 1000
+
+        print(f"Перевалов: {rows}: построение {build:.1f} с, память {memory / 2 ** 20:.0f} МиБ, "
+              f"обновление {update * 1e6:.0f} мкс")
+        print(f"  подсказка: p50 {statistics.median(timings) * 1e6:.0f} мкс, "
+              f"p99 {timings[int(len(timings) * 0.99)] * 1e6:.0f} мкс, max {timings[-1] * 1e6:.0f} мкс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,560 @@
+"""
+Нагрузочный прогон API на одноразовой локальной БД
+
+Порядок работы:
+  1. initdb во временном каталоге и запуск postgres на свободном порту
+     (программы PostgreSQL ищутся в --pg-bin, FSTR_PG_BIN, PATH, pg_config);
+  2. схема из Pereval_api/init_db.sql и миграции app.migrate;
+  3. синтетические районы и --rows перевалов с изображениями (сид фиксирован);
+  4. сервер в рабочем режиме (app.server) в отдельном процессе;
+  5. каждый сценарий (конечная точка) прогоняется на каждом уровне
+     параллельности --concurrency фиксированным числом запросов.
+
+Результат - JSON-отчёт: пропускная способность, p50/p95/p99/max задержки
+и коды ответов по каждому сценарию и уровню. Отчёты разных коммитов
+сравниваются командой compare.
+
+Запуск:
+    python -m benchmarks.loadtest run --rows 20000 --concurrency 1 8 32 --out base.json
+    python -m benchmarks.loadtest run --only get_pereval bbox nearest
+    python -m benchmarks.loadtest compare base.json new.json --threshold 0.1
+
+С --external-db вместо временной БД используется БД из FSTR_DB_*
+(в неё добавляются синтетические записи). С --replicas N к временной БД
+добавляются N реплик (pg_basebackup), сервер читает с них (FSTR_DB_REPLICAS).
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import psycopg2
+
+from benchmarks.synthetic import NAMES, TINY_PNG, make_pereval
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INIT_SQL = os.path.join(ROOT, "Pereval_api", "init_db.sql")
+SEED = 42
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def find_pg_bin(explicit: Optional[str] = None) -> str:
+    """Каталог с initdb/pg_ctl"""
+    candidates = [explicit, os.getenv("FSTR_PG_BIN")]
+    initdb = shutil.which("initdb")
+    if initdb:
+        candidates.append(os.path.dirname(initdb))
+    pg_config = shutil.which("pg_config")
+    if pg_config:
+        candidates.append(subprocess.run([pg_config, "--bindir"], capture_output=True,
+                                         text=True).stdout.strip())
+    for path in candidates:
+        if path and os.path.exists(os.path.join(path, "initdb")):
+            return path
+    raise SystemExit("Не найдены программы PostgreSQL: укажите --pg-bin или FSTR_PG_BIN")
+
+
+class LocalPostgres:
+    """Одноразовый экземпляр PostgreSQL во временном каталоге"""
+
+    def __init__(self, pg_bin: str, dbname: str = "pereval", os_user: Optional[str] = None):
+        self.pg_bin = pg_bin
+        self.dbname = dbname
+        self.port = free_port()
+        self.directory = tempfile.mkdtemp(prefix="pereval-pg-")
+        self.data_dir = os.path.join(self.directory, "data")
+        # initdb отказывается работать от root: сервер запускается от другого пользователя
+        self.os_user = os_user
+        if os.geteuid() == 0:
+            if not os_user:
+                raise SystemExit("Запуск от root: укажите --pg-os-user (или FSTR_PG_OS_USER)")
+            shutil.chown(self.directory, user=os_user)
+
+    def _run(self, program: str, *args):
+        command = [os.path.join(self.pg_bin, program), *args]
+        if os.geteuid() == 0:
+            command = ["runuser", "-u", self.os_user, "--", *command]
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise SystemExit(f"{program}: {result.stderr.strip()}")
+
+    def start(self) -> Dict[str, str]:
+        """Создать кластер и базу; возвращает переменные FSTR_DB_* для неё"""
+        self._run("initdb", "-D", self.data_dir, "-U", "postgres", "-A", "trust",
+                  "-E", "UTF8", "--locale=C")
+        self._run("pg_ctl", "-D", self.data_dir, "-w", "-l", os.path.join(self.directory, "log"),
+                  "-o", f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1",
+                  "start")
+        conn = psycopg2.connect(host="127.0.0.1", port=self.port, user="postgres", dbname="postgres")
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE DATABASE {self.dbname}")
+        conn.close()
+        return {
+            "FSTR_DB_HOST": "127.0.0.1",
+            "FSTR_DB_PORT": str(self.port),
+            "FSTR_DB_LOGIN": "postgres",
+            "FSTR_DB_PASS": "",
+            "FSTR_DB_NAME": self.dbname,
+        }
+
+    def start_replica(self) -> "LocalPostgres":
+        """Реплика потоковой репликации этого сервера (pg_basebackup) на свободном порту"""
+        replica = LocalPostgres(self.pg_bin, self.dbname, self.os_user)
+        replica._run("pg_basebackup", "-h", "127.0.0.1", "-p", str(self.port), "-U", "postgres",
+                     "-D", replica.data_dir, "-R", "-X", "stream")
+        replica._run("pg_ctl", "-D", replica.data_dir, "-w", "-l", os.path.join(replica.directory, "log"),
+                     "-o", f"-p {replica.port} -k {replica.directory} -c listen_addresses=127.0.0.1",
+                     "start")
+        return replica
+
+    def stop(self):
+        try:
+            self._run("pg_ctl", "-D", self.data_dir, "-m", "fast", "-w", "stop")
+        except SystemExit:
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def make_image(rng: random.Random, kilobytes: int) -> str:
+    """PNG 1x1 с хвостом случайных байт до нужного размера (декодеры хвост игнорируют)"""
+    data = base64.b64decode(TINY_PNG)
+    if kilobytes > 0:
+        data += rng.randbytes(max(0, kilobytes * 1024 - len(data)))
+    return base64.b64encode(data).decode()
+
+
+def make_item(i: int, rng: random.Random, users: int, images: int, image: str) -> dict:
+    """Перевал с изображениями размера image; у каждого изображения свой хвост, чтобы их хэши различались"""
+    item = make_pereval(i, rng, users=users, images=images)
+    data = base64.b64decode(image) if item["images"] else b""
+    for n, img in enumerate(item["images"]):
+        img["data"] = base64.b64encode(data + (i * 64 + n).to_bytes(8, "big")).decode()
+    return item
+
+
+def seed(env: Dict[str, str], rows: int, users: int, images: int, image_kb: int,
+         areas: int, fresh: bool) -> Dict[str, Any]:
+    """Схема, районы и перевалы; возвращает данные для генерации запросов"""
+    from app.database import DatabaseManager
+    from app.migrate import migrate
+
+    os.environ.update(env)
+    db = DatabaseManager()
+    db.connect()
+    rng = random.Random(SEED)
+    try:
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                if fresh:
+                    with open(INIT_SQL, encoding="utf-8") as f:
+                        cursor.execute(f.read())
+                cursor.execute("SELECT id FROM pereval_areas")
+                area_ids = [row["id"] for row in cursor.fetchall()]
+                new_areas = []
+                next_id = max(area_ids) + 1
+                for _ in range(areas):
+                    new_areas.append((next_id, rng.choice(area_ids), f"Район {next_id}"))
+                    area_ids.append(next_id)
+                    next_id += 1
+                if new_areas:
+                    cursor.executemany(
+                        "INSERT INTO pereval_areas (id, id_parent, title) VALUES (%s, %s, %s)", new_areas
+                    )
+            conn.commit()
+        finally:
+            db.release_connection(conn)
+
+        migrate()
+
+        image = make_image(rng, image_kb)
+        pereval_ids: List[int] = []
+        payloads: Dict[int, dict] = {}
+        started = time.perf_counter()
+        for start in range(0, rows, 1000):
+            batch = [make_item(i, rng, users, images, image) for i in range(start, min(rows, start + 1000))]
+            ids = db.add_perevals(batch)
+            pereval_ids.extend(ids)
+            # для PATCH нужны исходные данные пользователя: запоминаем часть записей
+            for pereval_id, item in zip(ids[:10], batch[:10]):
+                payloads[pereval_id] = item
+        print(f"Добавлено перевалов: {len(pereval_ids)} за {time.perf_counter() - started:.1f} с")
+
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("ANALYZE")
+                cursor.execute("SELECT encode(hash, 'hex') AS hash FROM image_blobs ORDER BY created_at DESC LIMIT 1000")
+                image_ids = [row["hash"] for row in cursor.fetchall()]
+            conn.commit()
+        finally:
+            db.release_connection(conn)
+    finally:
+        db.close()
+
+    return {
+        "pereval_ids": pereval_ids,
+        "patch_payloads": payloads,
+        "image_ids": image_ids,
+        "area_ids": area_ids,
+        "users": users,
+        "image": image,
+    }
+
+
+class Server:
+    """API в рабочем режиме (python -m app.server) в отдельном процессе"""
+
+    def __init__(self, env: Dict[str, str], workers: int = 1):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ, **env)
+        self.env.setdefault("FSTR_THUMB_DIR", tempfile.mkdtemp(prefix="pereval-thumbs-"))
+        self.env.setdefault("FSTR_SERVER_LOG_LEVEL", "warning")
+        # все запросы нагрузки идут с одного адреса - частоту клиентов не ограничиваем
+        self.env.setdefault("FSTR_RATE_LIMIT", "0")
+        self.env.setdefault("FSTR_SUBMIT_RATE_LIMIT", "0")
+        self.workers = workers
+        self.process = None
+
+    def start(self, timeout: float = 60.0):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "app.server", "--host", "127.0.0.1",
+             "--port", str(self.port), "--workers", str(self.workers)],
+            cwd=ROOT, env=self.env
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit(f"Сервер завершился с кодом {self.process.returncode}")
+            try:
+                if httpx.get(self.url + "/", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise SystemExit("Сервер не ответил за отведённое время")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+# Сценарий: функция (rng, данные сида) -> параметры запроса httpx
+Scenario = Callable[[random.Random, Dict[str, Any]], Dict[str, Any]]
+
+
+def _submit(rng, data):
+    return {"method": "POST", "url": "/submitData",
+            "json": make_item(rng.randrange(10 ** 6), rng, data["users"], 1, data["image"])}
+
+
+def _submit_batch(rng, data):
+    return {"method": "POST", "url": "/submitData/batch",
+            "json": [make_item(rng.randrange(10 ** 6), rng, data["users"], 1, data["image"])
+                     for _ in range(10)]}
+
+
+def _submit_multipart(rng, data):
+    item = make_item(rng.randrange(10 ** 6), rng, data["users"], 0, data["image"])
+    del item["images"]
+    return {"method": "POST", "url": "/submitData/multipart",
+            "data": {"data": json.dumps(item, ensure_ascii=False), "titles": ["Фото 1"]},
+            "files": [("images", ("photo.png", base64.b64decode(data["image"]), "image/png"))]}
+
+
+def _patch(rng, data):
+    pereval_id = rng.choice(list(data["patch_payloads"]))
+    item = dict(data["patch_payloads"][pereval_id])
+    item["title"] = f"{item['title']} {rng.randrange(1000)}"
+    return {"method": "PATCH", "url": f"/submitData/{pereval_id}", "json": item}
+
+
+def _email(rng, data):
+    return f"user{rng.randrange(data['users'])}@example.com"
+
+
+def _bbox(rng, data):
+    lat = rng.uniform(36.0, 54.0)
+    lon = rng.uniform(40.0, 99.0)
+    return {"method": "GET", "url": "/perevals/bbox",
+            "params": {"min_lat": lat, "min_lon": lon, "max_lat": lat + 1, "max_lon": lon + 1}}
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "root": lambda rng, data: {"method": "GET", "url": "/"},
+    "get_pereval": lambda rng, data: {"method": "GET",
+                                      "url": f"/submitData/{rng.choice(data['pereval_ids'])}"},
+    "get_missing": lambda rng, data: {"method": "GET", "url": f"/submitData/{10 ** 9 + rng.randrange(1000)}"},
+    "list_by_email": lambda rng, data: {"method": "GET", "url": "/submitData/",
+                                        "params": {"user__email": _email(rng, data), "limit": 20}},
+    "list_ndjson": lambda rng, data: {"method": "GET", "url": "/submitData/",
+                                      "params": {"user__email": _email(rng, data)},
+                                      "headers": {"Accept": "application/x-ndjson"}},
+    "image_full": lambda rng, data: {"method": "GET", "url": f"/images/{rng.choice(data['image_ids'])}"},
+    "image_range": lambda rng, data: {"method": "GET", "url": f"/images/{rng.choice(data['image_ids'])}",
+                                      "headers": {"Range": "bytes=0-1023"}},
+    "image_thumb": lambda rng, data: {"method": "GET", "url": f"/images/{rng.choice(data['image_ids'])}",
+                                      "params": {"size": "thumb"}},
+    "bbox": _bbox,
+    "nearest": lambda rng, data: {"method": "GET", "url": "/perevals/nearest",
+                                  "params": {"lat": rng.uniform(36.0, 55.0),
+                                             "lon": rng.uniform(40.0, 100.0), "limit": 20}},
+    "search": lambda rng, data: {"method": "GET", "url": "/perevals/search",
+                                 "params": {"q": f"{rng.choice(NAMES)[:-1]} {rng.randrange(100)}"}},
+    "suggest": lambda rng, data: {"method": "GET", "url": "/perevals/suggest",
+                                  "params": {"prefix": rng.choice(NAMES)[:rng.randint(1, 4)]}},
+    "areas": lambda rng, data: {"method": "GET", "url": "/areas"},
+    "area_subtree": lambda rng, data: {"method": "GET",
+                                       "url": f"/areas/{rng.choice(data['area_ids'])}/subtree"},
+    "area_path": lambda rng, data: {"method": "GET", "url": f"/areas/{rng.choice(data['area_ids'])}/path"},
+    "changes": lambda rng, data: {"method": "GET", "url": "/changes",
+                                  "params": {"user__email": _email(rng, data), "limit": 20}},
+    "stats": lambda rng, data: {"method": "GET", "url": "/stats"},
+    "stats_contributors": lambda rng, data: {"method": "GET", "url": "/stats/contributors"},
+    "cache_stats": lambda rng, data: {"method": "GET", "url": "/cache/stats"},
+    "patch": _patch,
+    "submit": _submit,
+    "submit_batch": _submit_batch,
+    "submit_multipart": _submit_multipart,
+}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(q / 100 * len(sorted_values) + 0.5 - 1e-9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+async def drive(url: str, scenario: Scenario, data: Dict[str, Any], concurrency: int,
+                requests: int, warmup: int, seed_value: int) -> Dict[str, Any]:
+    """Прогон одного сценария: requests запросов, не больше concurrency одновременно"""
+    rng = random.Random(seed_value)
+    prepared = [scenario(rng, data) for _ in range(warmup + requests)]
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+    position = 0
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def worker(queue: List[Dict[str, Any]], record: bool):
+            nonlocal position, errors
+            while position < len(queue):
+                request = queue[position]
+                position += 1
+                started = time.perf_counter()
+                try:
+                    response = await client.request(**request)
+                    await response.aread()
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - started
+                if not record:
+                    continue
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                if not status.isdigit() or int(status) >= 500:
+                    errors += 1
+
+        await asyncio.gather(*(worker(prepared[:warmup], False) for _ in range(concurrency)))
+        position = 0
+        measured = prepared[warmup:]
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(measured, True) for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "status": dict(sorted(statuses.items())),
+        "seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 1) if wall else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+    }
+
+
+def git_revision() -> Dict[str, Any]:
+    def git(*args):
+        result = subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--", "app"))}
+
+
+def run(args) -> Dict[str, Any]:
+    names = args.only or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(unknown)}")
+
+    postgres = None
+    replicas = []
+    server = None
+    try:
+        if args.external_db:
+            from app.database import db_params_from_env
+            params = db_params_from_env()
+            env = {"FSTR_DB_HOST": params["host"], "FSTR_DB_PORT": str(params["port"]),
+                   "FSTR_DB_LOGIN": params["user"], "FSTR_DB_PASS": params["password"] or "",
+                   "FSTR_DB_NAME": params["database"]}
+        else:
+            postgres = LocalPostgres(find_pg_bin(args.pg_bin),
+                                     os_user=args.pg_os_user or os.getenv("FSTR_PG_OS_USER"))
+            env = postgres.start()
+            env["FSTR_IMAGE_DIR"] = os.path.join(postgres.directory, "images")
+        data = seed(env, args.rows, args.users, args.images, args.image_kb, args.areas,
+                    fresh=not args.external_db)
+        if args.replicas:
+            if postgres is None:
+                raise SystemExit("--replicas работает только с временной БД")
+            replicas = [postgres.start_replica() for _ in range(args.replicas)]
+            env = dict(env, FSTR_DB_REPLICAS=",".join(f"127.0.0.1:{replica.port}" for replica in replicas))
+
+        server = Server(env, workers=args.workers)
+        server.start()
+
+        results = []
+        for name in names:
+            for concurrency in args.concurrency:
+                result = asyncio.run(drive(server.url, SCENARIOS[name], data, concurrency,
+                                           args.requests, args.warmup, SEED + concurrency))
+                result = {"scenario": name, "concurrency": concurrency, **result}
+                results.append(result)
+                latency = result["latency_ms"]
+                print(f"{name:<18} c={concurrency:<4} {result['throughput_rps']:>9.1f} зап/с  "
+                      f"p50 {latency['p50']:>8.2f}  p95 {latency['p95']:>8.2f}  "
+                      f"p99 {latency['p99']:>8.2f} мс  ошибок {result['errors']}")
+    finally:
+        if server:
+            server.stop()
+        for replica in replicas:
+            replica.stop()
+        if postgres:
+            postgres.stop()
+
+    return {
+        "meta": {
+            **git_revision(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": SEED,
+            "rows": args.rows,
+            "users": args.users,
+            "images": args.images,
+            "image_kb": args.image_kb,
+            "areas": args.areas,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "workers": args.workers,
+            "external_db": args.external_db,
+            "replicas": args.replicas,
+        },
+        "results": results,
+    }
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> bool:
+    """Таблица изменений; False, если есть регрессия больше threshold (доля)"""
+    base_results = {(r["scenario"], r["concurrency"]): r for r in base["results"]}
+    ok = True
+    print(f"{'сценарий':<18} {'c':>4} {'зап/с':>17} {'p50, мс':>21} {'p99, мс':>21}")
+    for result in new["results"]:
+        key = (result["scenario"], result["concurrency"])
+        old = base_results.get(key)
+        if old is None:
+            continue
+        rps_change = result["throughput_rps"] / old["throughput_rps"] - 1 if old["throughput_rps"] else 0
+        p50_change = result["latency_ms"]["p50"] / old["latency_ms"]["p50"] - 1 if old["latency_ms"]["p50"] else 0
+        p99_change = result["latency_ms"]["p99"] / old["latency_ms"]["p99"] - 1 if old["latency_ms"]["p99"] else 0
+        regressed = rps_change < -threshold or p99_change > threshold or p50_change > threshold
+        ok = ok and not regressed
+        print(f"{key[0]:<18} {key[1]:>4} "
+              f"{result['throughput_rps']:>9.1f} {rps_change:>+7.1%} "
+              f"{result['latency_ms']['p50']:>12.2f} {p50_change:>+7.1%} "
+              f"{result['latency_ms']['p99']:>12.2f} {p99_change:>+7.1%}"
+              f"{'  РЕГРЕССИЯ' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="прогнать нагрузку и записать отчёт")
+    run_parser.add_argument("--rows", type=int, default=10000, help="перевалов в БД")
+    run_parser.add_argument("--users", type=int, default=1000, help="различных email")
+    run_parser.add_argument("--images", type=int, default=1, help="изображений на перевал")
+    run_parser.add_argument("--image-kb", type=int, default=32, help="размер изображения, КБ")
+    run_parser.add_argument("--areas", type=int, default=200, help="дополнительных районов")
+    run_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    run_parser.add_argument("--requests", type=int, default=1000, help="запросов на сценарий и уровень")
+    run_parser.add_argument("--warmup", type=int, default=50)
+    run_parser.add_argument("--workers", type=int, default=1, help="рабочих процессов сервера")
+    run_parser.add_argument("--only", nargs="+", metavar="SCENARIO",
+                            help=f"сценарии: {', '.join(SCENARIOS)}")
+    run_parser.add_argument("--pg-bin", help="каталог программ PostgreSQL")
+    run_parser.add_argument("--pg-os-user", help="пользователь ОС для postgres при запуске от root")
+    run_parser.add_argument("--external-db", action="store_true", help="использовать БД из FSTR_DB_*")
+    run_parser.add_argument("--replicas", type=int, default=0, help="реплик временной БД для чтения")
+    run_parser.add_argument("--out", help="файл отчёта (по умолчанию loadtest-<коммит>.json)")
+
+    compare_parser = commands.add_parser("compare", help="сравнить два отчёта")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="допустимое ухудшение (доля), иначе код возврата 1")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        report = run(args)
+        out = args.out or f"loadtest-{(report['meta']['commit'] or 'unknown')[:10]}.json"
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчёт: {out}")
+    else:
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        if not compare(base, new, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
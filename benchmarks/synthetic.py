@@ -0,0 +1,42 @@
+"""Генерация синтетических перевалов для бенчмарков"""
+import random
+
+# PNG 1x1, как в test_request.py
+TINY_PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/5+hHgAHggJ/PchI7wAAAABJRU5ErkJggg=="
+
+PREFIXES = ["пер. ", "", "перевал ", "седл. "]
+NAMES = ["Пхия", "Триев", "Анзоб", "Актру", "Каратюрек", "Учитель", "Кара-Тюрек", "Кату-Ярык",
+         "Шавлинский", "Джимбар", "Мунку-Сардык", "Орой", "Талдуринский", "Эдельвейс", "Снежный"]
+LEVELS = ["", "н/к", "1А", "1Б", "2А", "2Б", "3А"]
+
+
+def make_pereval(i: int, rng: random.Random, users: int = 1000, images: int = 1) -> dict:
+    """Перевал в формате POST /submitData"""
+    name = rng.choice(NAMES)
+    return {
+        "beauty_title": rng.choice(PREFIXES),
+        "title": f"{name} {i}",
+        "other_titles": rng.choice(NAMES),
+        "connect": "",
+        "add_time": f"20{rng.randint(15, 25)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} "
+                    f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}",
+        "user": {
+            "email": f"user{rng.randrange(users)}@example.com",
+            "fam": "Пупкин",
+            "name": "Василий",
+            "otc": "Иванович",
+            "phone": f"+7 9{rng.randint(10, 99)} {rng.randint(100, 999)} {rng.randint(10, 99)} {rng.randint(10, 99)}"
+        },
+        "coords": {
+            "latitude": f"{rng.uniform(36.0, 55.0):.4f}",
+            "longitude": f"{rng.uniform(40.0, 100.0):.4f}",
+            "height": str(rng.randint(1000, 6000))
+        },
+        "level": {
+            "winter": rng.choice(LEVELS),
+            "summer": rng.choice(LEVELS),
+            "autumn": rng.choice(LEVELS),
+            "spring": rng.choice(LEVELS)
+        },
+        "images": [{"data": TINY_PNG, "title": f"Фото {n + 1}"} for n in range(images)]
+    }
@@ -0,0 +1,55 @@
+import asyncio
+import os
+
+import pytest
+
+from app.async_database import AsyncDatabaseManager
+from app.database import DatabaseManager
+
+
+def require_test_db():
+    if os.getenv('FSTR_TEST_DB') != '1':
+        pytest.skip("тесты с БД включаются FSTR_TEST_DB=1")
+
+
+@pytest.fixture
+def sync_db():
+    """DatabaseManager на БД из FSTR_DB_* (только с FSTR_TEST_DB=1)"""
+    require_test_db()
+    db = DatabaseManager()
+    try:
+        db.release_connection(db.get_connection())
+    except Exception as e:
+        pytest.skip(f"БД недоступна: {e}")
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def run_with_db():
+    """
+    Выполнить сценарий scenario(db) с AsyncDatabaseManager на БД из FSTR_DB_*
+    Тесты пишут в БД, поэтому запускаются только с FSTR_TEST_DB=1;
+    созданные сценарием записи (db.created) удаляются в конце
+    """
+    require_test_db()
+
+    def run(scenario):
+        async def main():
+            db = AsyncDatabaseManager()
+            db.created = []
+            try:
+                await db.connect()
+            except Exception as e:
+                pytest.skip(f"БД недоступна: {e}")
+            try:
+                return await scenario(db)
+            finally:
+                async with db.connection() as conn:
+                    await conn.execute("DELETE FROM pereval_idempotency WHERE pereval_id = ANY($1::int[])", db.created)
+                    await conn.execute("DELETE FROM pereval_added WHERE id = ANY($1::int[])", db.created)
+                await db.close()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from app.admission import Limiter, RateLimitedError, TokenBuckets
+
+
+def test_limiter_priority_then_arrival_order():
+    async def scenario():
+        limiter = Limiter(1)
+        assert await limiter.acquire(1.0)
+        order = []
+
+        async def waiter(name, priority):
+            await limiter.acquire(1.0, priority)
+            order.append(name)
+            limiter.release()
+
+        tasks = [asyncio.create_task(waiter(name, priority))
+                 for name, priority in (("upload", 2), ("submit", 1), ("read", 0), ("read2", 0))]
+        await asyncio.sleep(0.01)
+        assert limiter.waiting == 4
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order, limiter
+
+    order, limiter = asyncio.run(scenario())
+    assert order == ["read", "read2", "submit", "upload"]
+    assert (limiter.in_use, limiter.waiting) == (0, 0)
+
+
+def test_limiter_timeout():
+    async def scenario():
+        limiter = Limiter(1)
+        assert await limiter.acquire(0)
+        assert not await limiter.acquire(0)
+        assert not await limiter.acquire(0.02)
+        assert limiter.waiting == 0
+        limiter.release()
+        assert await limiter.acquire(0)
+        return limiter
+
+    assert asyncio.run(scenario()).in_use == 1
+
+
+def test_limiter_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        limiter = Limiter(1)
+        await limiter.acquire(1.0)
+        task = asyncio.create_task(limiter.acquire(1.0))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        limiter.release()
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert (limiter.in_use, limiter.waiting) == (0, 0)
+
+
+def test_token_bucket_burst_and_refill(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("app.admission.time.monotonic", lambda: now[0])
+    buckets = TokenBuckets(rate=2, burst=3)
+    assert [buckets.take("a") for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("a") == pytest.approx(0.5)
+    assert buckets.take("b") == 0
+    now[0] += 1.0
+    assert buckets.take("a") == 0
+    with pytest.raises(RateLimitedError) as error:
+        for _ in range(3):
+            buckets.check("a")
+    assert error.value.retry_after > 0
+
+
+def test_token_bucket_unlimited_and_client_limit():
+    assert all(TokenBuckets(rate=0, burst=1).take("a") == 0 for _ in range(100))
+    buckets = TokenBuckets(rate=1, burst=1, max_clients=2)
+    for client in ("a", "b", "c"):
+        buckets.take(client)
+    # самый давний клиент вытеснен и снова получает полный запас
+    assert len(buckets._buckets) == 2
+    assert buckets.take("a") == 0
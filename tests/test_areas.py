@@ -0,0 +1,51 @@
+from app.areas import AreaTree
+
+# (id, id_parent, title): 0 - корень («Планета Земля», родитель - он сам)
+ROWS = [
+    (0, 0, "Планета Земля"),
+    (1, 0, "Памиро-Алай"),
+    (2, 1, "Фанские горы"),
+    (3, 2, "Чимтарга"),
+    (4, 1, "Гиссарский хребет"),
+    (5, 0, "Кавказ"),
+]
+
+
+def test_ancestors():
+    tree = AreaTree(ROWS)
+    assert tree.is_ancestor(0, 3)
+    assert tree.is_ancestor(1, 3)
+    assert tree.is_ancestor(3, 3)
+    assert not tree.is_ancestor(3, 1)
+    assert not tree.is_ancestor(4, 3)
+    assert not tree.is_ancestor(5, 2)
+    assert not tree.is_ancestor(1, 99)
+
+
+def test_subtree_and_depth():
+    tree = AreaTree(ROWS)
+    assert tree.subtree_ids(1) == [1, 2, 3, 4]
+    assert [(node["id"], node["depth"]) for node in tree.subtree(1)] == [(1, 0), (2, 1), (3, 2), (4, 1)]
+    assert tree.subtree_ids(3) == [3]
+    assert [node["id"] for node in tree.all()] == [0, 1, 2, 3, 4, 5]
+
+
+def test_path():
+    tree = AreaTree(ROWS)
+    assert [node["id"] for node in tree.path(3)] == [0, 1, 2, 3]
+    assert tree.path(0)[0]["id_parent"] == 0
+
+
+def test_missing_parent_and_cycle_become_roots():
+    tree = AreaTree(ROWS + [(10, 99, "Без родителя"), (20, 21, "Цикл"), (21, 20, "Цикл")])
+    assert len(tree) == 9
+    assert [node["id"] for node in tree.path(10)] == [10]
+    assert set(tree.subtree_ids(20)) | set(tree.subtree_ids(21)) == {20, 21}
+    assert not tree.is_ancestor(0, 20)
+
+
+def test_empty():
+    tree = AreaTree()
+    assert len(tree) == 0
+    assert 1 not in tree
+    assert tree.all() == []
@@ -0,0 +1,44 @@
+from fastapi.testclient import TestClient
+
+from app import main
+from app.idempotency import payload_hash
+from tests.test_idempotency import PEREVAL
+
+client = TestClient(main.app)
+
+
+def test_batch_stores_valid_items_and_reports_invalid(monkeypatch):
+    calls = []
+
+    async def add_perevals(perevals, content_hashes, duplicates):
+        calls.append((perevals, content_hashes))
+        return [100 + pos for pos in range(len(perevals))]
+
+    monkeypatch.setattr(main.db_manager, "add_perevals", add_perevals)
+    invalid = dict(PEREVAL, add_time="вчера")
+    response = client.post("/submitData/batch", json=[PEREVAL, invalid, dict(PEREVAL, title="Второй"), {}])
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(result["status"], result["id"]) for result in results] == [
+        (200, 100), (422, None), (200, 101), (422, None)
+    ]
+    assert results[1]["message"][0]["loc"] == ["add_time"]
+    # в БД одной пачкой уходят только корректные записи, в порядке входа
+    perevals, content_hashes = calls[0]
+    assert [pereval.title for pereval in perevals] == ["Анзоб", "Второй"]
+    assert content_hashes[0] == payload_hash(perevals[0])
+
+
+def test_batch_db_error_fails_only_valid_items(monkeypatch):
+    async def add_perevals(perevals, content_hashes, duplicates):
+        raise RuntimeError("БД недоступна")
+
+    monkeypatch.setattr(main.db_manager, "add_perevals", add_perevals)
+    results = client.post("/submitData/batch", json=[PEREVAL, {}]).json()["results"]
+    assert [result["status"] for result in results] == [500, 422]
+
+
+def test_batch_too_large(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_ITEMS", 1)
+    assert client.post("/submitData/batch", json=[PEREVAL, PEREVAL]).status_code == 413
@@ -0,0 +1,65 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+from app import main
+from app.cache import LRUTTLCache
+
+client = TestClient(main.app)
+ROW = {"id": 7, "date_added": "2024-07-01T10:00:00", "version": 3, "raw_data": '{"title": "Анзоб"}', "images": None}
+
+
+def test_lru_ttl_cache(monkeypatch):
+    async def scenario():
+        now = [100.0]
+        monkeypatch.setattr("app.cache.time.monotonic", lambda: now[0])
+        cache = LRUTTLCache(max_entries=2, ttl=10)
+        await cache.set("a", 1)
+        await cache.set("b", 2)
+        assert await cache.get("a") == 1
+        # "b" - самая давно использованная
+        await cache.set("c", 3)
+        assert await cache.get("b") is None
+        assert await cache.get("a") == 1
+        await cache.delete("a")
+        assert await cache.get("a") is None
+        now[0] += 11
+        assert await cache.get("c") is None
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["size"], stats["hits"], stats["misses"], stats["evictions"]) == (0, 2, 3, 1)
+
+
+def test_get_pereval_reads_through_and_invalidates(monkeypatch):
+    reads = []
+
+    async def get_pereval_by_id(pereval_id):
+        reads.append(pereval_id)
+        return dict(ROW, id=pereval_id)
+
+    monkeypatch.setattr(main, "pereval_cache", LRUTTLCache())
+    monkeypatch.setattr(main.db_manager, "get_pereval_by_id", get_pereval_by_id)
+
+    first = client.get("/submitData/7")
+    assert first.status_code == 200 and first.headers["etag"] == '"v3"'
+    assert client.get("/submitData/7").content == first.content
+    assert client.get("/submitData/7", headers={"If-None-Match": '"v3"'}).status_code == 304
+    assert reads == [7]
+
+    asyncio.run(main._invalidate_pereval(7))
+    client.get("/submitData/7")
+    assert reads == [7, 7]
+
+
+def test_get_pereval_does_not_cache_read_raced_with_invalidation(monkeypatch):
+    async def get_pereval_by_id(pereval_id):
+        # запись изменили, пока шло чтение: прочитанное могло устареть
+        await main._invalidate_pereval(pereval_id)
+        return dict(ROW, id=pereval_id)
+
+    cache = LRUTTLCache()
+    monkeypatch.setattr(main, "pereval_cache", cache)
+    monkeypatch.setattr(main.db_manager, "get_pereval_by_id", get_pereval_by_id)
+    assert client.get("/submitData/7").status_code == 200
+    assert cache.stats()["size"] == 0
@@ -0,0 +1,52 @@
+import base64
+import time
+
+import pytest
+
+from app.changes import CHANGES_TTL, ChangeToken, ChangeTokenExpiredError, token_scope
+
+
+def test_round_trip_without_cursor():
+    token = ChangeToken(token_scope(None), floor=1234)
+    decoded = ChangeToken.decode(token.encode())
+    assert decoded.floor == 1234
+    assert decoded.floor_time == int(token.floor_time)
+    assert decoded.cursor is None
+
+
+def test_round_trip_with_cursor():
+    scope = token_scope("user@example.com")
+    token = ChangeToken(scope, 10, time.time(), next_floor=20, next_time=time.time(), cursor=(15, 7))
+    decoded = ChangeToken.decode(token.encode(), "user@example.com")
+    assert (decoded.floor, decoded.next_floor, decoded.cursor) == (10, 20, (15, 7))
+
+
+def test_token_of_other_feed_rejected():
+    token = ChangeToken(token_scope("a@example.com")).encode()
+    with pytest.raises(ValueError):
+        ChangeToken.decode(token, "b@example.com")
+    with pytest.raises(ValueError):
+        ChangeToken.decode(token)
+
+
+@pytest.mark.parametrize("token", ["", "не токен", "Kg", base64.urlsafe_b64encode(b"*.1.2.3").decode()])
+def test_broken_token_rejected(token):
+    with pytest.raises(ValueError):
+        ChangeToken.decode(token)
+
+
+def test_expired_token():
+    token = ChangeToken('*', 5, time.time() - CHANGES_TTL - 60).encode()
+    with pytest.raises(ChangeTokenExpiredError):
+        ChangeToken.decode(token)
+
+
+def test_advance_keeps_floor_until_last_page():
+    """Пока есть страницы, граница прежняя; после последней - xmin первой страницы"""
+    token = ChangeToken('*', floor=100)
+    page = token.advance(xmin=150, last=(120, 3))
+    assert (page.floor, page.next_floor, page.cursor) == (100, 150, (120, 3))
+    page = ChangeToken.decode(page.encode()).advance(xmin=170, last=(130, 8))
+    assert (page.floor, page.next_floor, page.cursor) == (100, 150, (130, 8))
+    done = page.advance(xmin=180, last=None)
+    assert (done.floor, done.cursor) == (150, None)
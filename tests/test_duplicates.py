@@ -0,0 +1,65 @@
+import random
+
+from app.duplicates import METERS_PER_DEGREE, DuplicateIndex, distance_m, name_keys, similarity, trigrams
+
+
+def brute_force(records, lat, lon, radius):
+    return {pereval_id for pereval_id, plat, plon in records if distance_m(lat, lon, plat, plon) <= radius}
+
+
+def test_name_keys_drop_generic_words():
+    assert name_keys("пер. Анзоб", "Перевал Анзоб, Анзобский") == ["анзоб", "анзобский"]
+    assert name_keys("Перевал", "") == []
+
+
+def test_similarity_takes_best_pair():
+    first = tuple(trigrams(key) for key in ("анзоб",))
+    second = tuple(trigrams(key) for key in ("северный", "анзоб"))
+    assert similarity(first, second) == 1.0
+    assert similarity(first, (trigrams("ушба"),)) == 0.0
+
+
+def test_find_respelled_pass_nearby():
+    index = DuplicateIndex(radius=1000, threshold=0.5, limit=5)
+    index.load([
+        (1, 39.08, 68.86, "Анзоб", ""),
+        (2, 39.08, 68.86, "Ушба", ""),
+        (3, 39.5, 68.86, "Анзоб", ""),
+        (4, None, None, "Анзоб", ""),
+    ])
+    shift = 500 / METERS_PER_DEGREE
+    found = index.find(39.08 + shift, 68.86, "ПЕРЕВАЛ АНЗОБ", None)
+    assert [pereval_id for pereval_id, _, _ in found] == [1]
+    assert found[0][1] == 1.0 and 450 < found[0][2] < 550
+    # название из other_titles тоже сравнивается
+    assert [item[0] for item in index.find(39.08, 68.86, "Северный", "Ушба")] == [2]
+    assert index.find(39.08, 68.86, "пер.", None) == []
+
+
+def test_grid_cells_cover_radius():
+    # в сетке находятся все записи в радиусе, в том числе в соседних ячейках и на высоких широтах
+    rng = random.Random(1)
+    for lat0 in (0.0, 45.0, 75.0, -60.0):
+        index = DuplicateIndex(radius=1000, threshold=0.0, limit=1000)
+        records = []
+        for pereval_id in range(300):
+            lat = lat0 + rng.uniform(-0.03, 0.03)
+            lon = 10 + rng.uniform(-0.1, 0.1)
+            records.append((pereval_id, lat, lon))
+            index.upsert(pereval_id, lat, lon, "Анзоб", "")
+        for _ in range(20):
+            lat, lon = lat0 + rng.uniform(-0.02, 0.02), 10 + rng.uniform(-0.05, 0.05)
+            found = {pereval_id for pereval_id, _, _ in index.find(lat, lon, "Анзоб", None)}
+            assert found == brute_force(records, lat, lon, 1000)
+
+
+def test_upsert_moves_and_remove_clears_cells():
+    index = DuplicateIndex(radius=1000, threshold=0.5)
+    index.upsert(1, 39.08, 68.86, "Анзоб", "")
+    index.upsert(2, 39.08, 68.86, "Анзоб", "")
+    index.upsert(1, 45.0, 7.0, "Анзоб", "")
+    assert [item[0] for item in index.find(39.08, 68.86, "Анзоб", None)] == [2]
+    assert [item[0] for item in index.find(45.0, 7.0, "Анзоб", None)] == [1]
+    index.remove(1)
+    index.remove(2)
+    assert len(index) == 0 and index.cells == {}
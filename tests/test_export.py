@@ -0,0 +1,56 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.export import local_time, prefetch
+
+
+def test_local_time_converts_aware_datetime():
+    moment = datetime(2024, 1, 1, 12, 0, tzinfo=timezone(timedelta(hours=3)))
+    local = local_time(moment)
+    assert local.tzinfo is None
+    assert local == moment.astimezone().replace(tzinfo=None)
+    naive = datetime(2024, 1, 1, 12, 0)
+    assert local_time(naive) is naive
+    assert local_time(None) is None
+
+
+async def collect(batches):
+    return [batch async for batch in batches]
+
+
+def test_prefetch_reads_first_batch_before_streaming():
+    read = []
+
+    async def batches():
+        for i in range(3):
+            read.append(i)
+            yield [{"id": i}]
+
+    async def scenario():
+        stream = await prefetch(batches())
+        assert read == [0]
+        return await collect(stream)
+
+    assert asyncio.run(scenario()) == [[{"id": 0}], [{"id": 1}], [{"id": 2}]]
+
+
+def test_prefetch_raises_before_response():
+    async def failing():
+        raise ValueError("неверный параметр")
+        yield
+
+    with pytest.raises(ValueError):
+        asyncio.run(prefetch(failing()))
+
+
+def test_prefetch_empty():
+    async def empty():
+        return
+        yield
+
+    async def scenario():
+        return await collect(await prefetch(empty()))
+
+    assert asyncio.run(scenario()) == []
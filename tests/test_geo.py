@@ -0,0 +1,97 @@
+import math
+import random
+
+import pytest
+
+from app.geo import KDTree, SpatialIndex, chord_to_km, to_xyz
+
+
+def random_points(rng, count, start=0):
+    return [(start + i, rng.uniform(-89, 89), rng.uniform(-180, 180)) for i in range(count)]
+
+
+def brute_force(points, lat, lon, k):
+    """k ближайших перебором: (квадрат хорды, id)"""
+    tx, ty, tz = to_xyz(lat, lon)
+    found = []
+    for pereval_id, plat, plon in points:
+        x, y, z = to_xyz(plat, plon)
+        found.append(((x - tx) ** 2 + (y - ty) ** 2 + (z - tz) ** 2, pereval_id))
+    return sorted(found)[:k]
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 7, 500])
+def test_kdtree_matches_brute_force(count):
+    rng = random.Random(count)
+    points = random_points(rng, count)
+    tree = KDTree(points)
+    assert len(tree) == count
+    for _ in range(50):
+        lat, lon, k = rng.uniform(-90, 90), rng.uniform(-180, 180), rng.randint(1, 10)
+        assert tree.nearest(lat, lon, k) == brute_force(points, lat, lon, k)
+
+
+def test_kdtree_skip():
+    rng = random.Random(1)
+    points = random_points(rng, 200)
+    skip = frozenset(range(0, 200, 3))
+    expected = brute_force([p for p in points if p[0] not in skip], 10, 20, 5)
+    assert KDTree(points).nearest(10, 20, 5, skip=skip) == expected
+
+
+def test_kdtree_across_antimeridian():
+    tree = KDTree([(1, 0, 179.9), (2, 0, 170)])
+    assert tree.nearest(0, -179.9, 1)[0][1] == 1
+
+
+def test_chord_to_km():
+    dist, _ = KDTree([(1, 0, 0)]).nearest(0, 90, 1)[0]
+    assert chord_to_km(dist) == pytest.approx(math.pi / 2 * 6371.0, rel=1e-3)
+
+
+def test_spatial_index_updates_match_brute_force():
+    rng = random.Random(2)
+    points = random_points(rng, 300)
+    index = SpatialIndex(rebuild_min=10 ** 6)
+    index.begin_load()
+    index.load(points, KDTree(points))
+    current = {pereval_id: (lat, lon) for pereval_id, lat, lon in points}
+
+    for pereval_id in rng.sample(sorted(current), 40):
+        index.remove(pereval_id)
+        del current[pereval_id]
+    for pereval_id, lat, lon in random_points(rng, 40, start=1000) + random_points(rng, 20):
+        index.upsert(pereval_id, lat, lon)
+        current[pereval_id] = (lat, lon)
+    index.upsert(1001, None, None)
+    current.pop(1001)
+
+    expected_points = [(pereval_id, lat, lon) for pereval_id, (lat, lon) in current.items()]
+    for _ in range(30):
+        lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        found = index.nearest(lat, lon, 5)
+        expected = brute_force(expected_points, lat, lon, 5)
+        assert [pereval_id for _, pereval_id in found] == [pereval_id for _, pereval_id in expected]
+    assert len(index) == len(current)
+
+
+def test_spatial_index_rebuild_keeps_changes_during_build():
+    rng = random.Random(3)
+    points = random_points(rng, 50)
+    index = SpatialIndex(rebuild_min=5)
+    index.load(points, KDTree(points))
+    for pereval_id, lat, lon in random_points(rng, 10, start=100):
+        index.upsert(pereval_id, lat, lon)
+    assert index.needs_rebuild
+
+    snapshot = index.snapshot()
+    assert not index.needs_rebuild
+    # изменения, пришедшие во время сборки дерева
+    index.upsert(200, 45.0, 7.0)
+    index.remove(100)
+    index.swap(KDTree(snapshot))
+
+    assert index.nearest(45.0, 7.0, 1)[0][1] == 200
+    ids = {pereval_id for _, pereval_id in index.nearest(0, 0, len(index) + 10)}
+    assert 100 not in ids and 200 in ids
+    assert len(ids) == len(index) == 60
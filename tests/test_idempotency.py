@@ -0,0 +1,140 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app.idempotency import (IDEMPOTENCY_KEY_MAX_LENGTH, IdempotencyKeyConflictError, SubmissionRegistry,
+                             check_key, check_request_hash, payload_hash)
+from app.models import PerevalData, PerevalPatch
+
+PEREVAL = {
+    "beauty_title": "пер.",
+    "title": "Анзоб",
+    "other_titles": "",
+    "connect": "",
+    "add_time": "2024-07-01 10:00:00",
+    "user": {"email": "user@example.com", "fam": "Иванов", "name": "Иван", "otc": "Иванович", "phone": "+7 000"},
+    "coords": {"latitude": "39.08", "longitude": "68.86", "height": "3372"},
+    "level": {"winter": "", "summer": "1А", "autumn": "", "spring": ""},
+    "images": [],
+}
+
+
+def unique_pereval(**fields) -> PerevalData:
+    """Перевал с новым содержимым: хэш не совпадает с записями, уже лежащими в БД"""
+    return PerevalData.model_validate(dict(PEREVAL, connect=uuid.uuid4().hex, **fields))
+
+
+def test_payload_hash_is_canonical():
+    reordered = dict(reversed(list(PEREVAL.items())))
+    reordered["user"] = dict(reversed(list(PEREVAL["user"].items())))
+    assert payload_hash(reordered) == payload_hash(PEREVAL)
+    assert payload_hash(PerevalData.model_validate(PEREVAL)) == payload_hash(reordered)
+    assert payload_hash(dict(PEREVAL, title="Анзоб Северный")) != payload_hash(PEREVAL)
+
+
+def test_check_request_hash():
+    first, second = payload_hash({"a": 1}), payload_hash({"a": 2})
+    check_request_hash(first, first)
+    check_request_hash(memoryview(first), first)
+    check_request_hash(None, first)
+    check_request_hash(first, None)
+    with pytest.raises(IdempotencyKeyConflictError):
+        check_request_hash(first, second)
+
+
+def test_check_key():
+    assert check_key(None) is None
+    assert check_key(" key-1 ") == "key-1"
+    for key in ("", "   ", "k" * (IDEMPOTENCY_KEY_MAX_LENGTH + 1)):
+        with pytest.raises(ValueError):
+            check_key(key)
+
+
+class FakeDB:
+    """Ответ find_submission без БД: duplicate_id по хэшу содержимого"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.queries = 0
+
+    async def find_submission(self, key, content_hash):
+        self.queries += 1
+        return {"key_id": None, "request_hash": None, "duplicate_id": self.hashes.get(content_hash)}
+
+
+def test_registry_forgets_changed_record():
+    async def scenario():
+        db = FakeDB()
+        registry = SubmissionRegistry(db)
+        content_hash = payload_hash(PEREVAL)
+        db.hashes[content_hash] = 1
+        await registry.remember(1, content_hash, content_hash=content_hash)
+        assert await registry.find(content_hash, content_hash=content_hash) == 1
+        assert db.queries == 0
+
+        # запись изменили: в БД хэша больше нет, память его не помнит
+        del db.hashes[content_hash]
+        await registry.forget(1)
+        assert await registry.find(content_hash, content_hash=content_hash) is None
+        assert db.queries == 1
+
+    asyncio.run(scenario())
+
+
+def test_registry_key_with_other_data_conflicts():
+    async def scenario():
+        registry = SubmissionRegistry(FakeDB())
+        first, second = payload_hash({"a": 1}), payload_hash({"a": 2})
+        await registry.remember(5, first, key="key-1")
+        assert await registry.find(first, key="key-1") == 5
+        with pytest.raises(IdempotencyKeyConflictError):
+            await registry.find(second, key="key-1")
+
+    asyncio.run(scenario())
+
+
+def test_batch_keys(run_with_db):
+    async def scenario(db):
+        key, other_key = uuid.uuid4().hex, uuid.uuid4().hex
+        pereval, other = unique_pereval(), unique_pereval()
+        hashes = [payload_hash(pereval), payload_hash(pereval), payload_hash(other)]
+
+        # повтор ключа в пачке - id первой записи с ним
+        ids = await db.add_perevals([pereval, pereval, other], content_hashes=hashes, keys=[key, key, other_key])
+        db.created.extend(ids)
+        assert ids[0] == ids[1] != ids[2]
+
+        # занятый ключ с теми же данными - id его записи, новая не создаётся
+        assert await db.add_perevals([pereval], content_hashes=hashes[:1], keys=[key]) == ids[:1]
+
+        # тот же ключ с другими данными - ошибка, в пачке и между пачками
+        with pytest.raises(IdempotencyKeyConflictError):
+            await db.add_perevals([other], content_hashes=hashes[2:], keys=[key])
+        fresh = unique_pereval()
+        with pytest.raises(IdempotencyKeyConflictError):
+            await db.add_perevals([pereval, fresh], content_hashes=[hashes[0], payload_hash(fresh)],
+                                  keys=[uuid.uuid4().hex] * 2)
+        assert (await db.find_submission(None, payload_hash(fresh)))["duplicate_id"] is None
+
+    run_with_db(scenario)
+
+
+def test_resubmit_after_patch_creates_new_record(run_with_db):
+    async def scenario(db):
+        pereval = unique_pereval()
+        content_hash = payload_hash(pereval)
+        first = await db.add_pereval(pereval, content_hash=content_hash)
+        db.created.append(first)
+        assert await db.add_pereval(pereval, content_hash=content_hash) == first
+
+        version, message = await db.update_pereval(first, PerevalPatch.model_validate({"title": "Анзоб Северный"}))
+        assert message is None and version is not None
+        found = await db.find_submission(None, content_hash)
+        assert found["duplicate_id"] is None
+
+        second = await db.add_pereval(pereval, content_hash=content_hash)
+        db.created.append(second)
+        assert second not in (None, first)
+
+    run_with_db(scenario)
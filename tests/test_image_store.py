@@ -0,0 +1,52 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+from app import database
+from app.image_store import LocalImageStore
+
+
+def pereval_with_image(data: bytes) -> dict:
+    return {
+        "beauty_title": "пер.",
+        "title": "Анзоб",
+        "other_titles": "",
+        "connect": "",
+        "add_time": "2024-07-01 10:00:00",
+        "user": {"email": "user@example.com", "fam": "Иванов", "name": "Иван", "otc": "Иванович", "phone": "+7 000"},
+        "coords": {"latitude": "39.08", "longitude": "68.86", "height": "3372"},
+        "level": {"winter": "", "summer": "1А", "autumn": "", "spring": ""},
+        "images": [{"data": base64.b64encode(data).decode(), "title": "Седловина"}],
+    }
+
+
+def test_local_store_commit_and_delete(tmp_path):
+    store = LocalImageStore(str(tmp_path), fsync=False)
+    data = os.urandom(100)
+    staged = store.stage()
+    staged.write(data)
+    assert store.commit(staged)
+    assert staged.hexdigest == hashlib.sha256(data).hexdigest()
+    assert store.stat(staged.hexdigest)[0] == 100
+
+    again = store.stage()
+    again.write(data)
+    # файл уже есть: новый не создан
+    assert not store.commit(again)
+    store.delete(staged.hexdigest)
+    assert store.stat(staged.hexdigest) is None
+
+
+def test_sync_rollback_removes_new_image_files(sync_db, tmp_path, monkeypatch):
+    sync_db.images = LocalImageStore(str(tmp_path), fsync=False)
+    data = os.urandom(100)
+
+    def failing(*args, **kwargs):
+        raise RuntimeError("ошибка вставки")
+
+    monkeypatch.setattr(database, "execute_values", failing)
+    with pytest.raises(RuntimeError):
+        sync_db.add_perevals([pereval_with_image(data)])
+    assert sync_db.images.stat(hashlib.sha256(data).hexdigest()) is None
@@ -0,0 +1,31 @@
+import pytest
+
+from app.images import parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=10-", (10, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    (" bytes = 5-6", (5, 6)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=0-1,5-6",  # несколько диапазонов
+    "items=0-1",
+    "bytes=5",
+    "bytes=5-2",  # конец раньше начала: заголовок игнорируется (RFC 7233)
+])
+def test_parse_range_ignored(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1000-1001", "bytes=-0", "bytes=a-b", "bytes=-"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
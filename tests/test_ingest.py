@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+
+from app.ingest import IngestQueue, SpillLog
+
+PEREVAL = {
+    "beauty_title": "пер.",
+    "title": "Анзоб",
+    "other_titles": "",
+    "connect": "",
+    "add_time": "2024-07-01 10:00:00",
+    "user": {"email": "user@example.com", "fam": "Иванов", "name": "Иван", "otc": "Иванович", "phone": "+7 000"},
+    "coords": {"latitude": "39.08", "longitude": "68.86", "height": "3372"},
+    "level": {"winter": "", "summer": "1А", "autumn": "", "spring": ""},
+    "images": [],
+}
+
+
+class FakeDB:
+    """Записи по id в памяти вместо AsyncDatabaseManager"""
+
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+        self.batches = []
+        self.states = []
+
+    async def existing_ids(self, ids):
+        return {pereval_id for pereval_id in ids if pereval_id in self.existing}
+
+    async def add_perevals(self, perevals, ids, content_hashes, keys):
+        self.batches.append((list(ids), list(keys)))
+        self.existing.update(ids)
+        return list(ids)
+
+    async def save_ingest_states(self, persisted, failed):
+        self.states.append((sorted(persisted), failed))
+
+
+def crash(spill: SpillLog):
+    """Процесс упал: файлы закрыты (flock снят), сегменты остались на диске"""
+    for file, _ in spill._segments.values():
+        file.close()
+
+
+def test_recover_writes_missing_records(tmp_path):
+    spill = SpillLog(str(tmp_path), fsync=False)
+    spill.append(1, dict(PEREVAL, title="Первый"), key="key-1")
+    spill.append(2, dict(PEREVAL, title="Уже в БД"))
+    spill.rotate()
+    spill.append(3, dict(PEREVAL, title="Третий"))
+    # строка, недописанная при падении
+    spill._file.write(b'{"id": 4, "data": {"tit')
+    spill._file.flush()
+    crash(spill)
+    time.sleep(0.002)
+    live = SpillLog(str(tmp_path), fsync=False)
+    live.append(5, PEREVAL)
+
+    db = FakeDB(existing={2})
+    recovered = asyncio.run(IngestQueue(db, batch_size=1).recover(str(tmp_path)))
+
+    assert recovered == 2
+    assert db.batches == [([1], ["key-1"]), ([3], [None])]
+    assert db.states == [([1, 2], []), ([3], [])]
+    # остался только сегмент живого процесса
+    assert os.listdir(tmp_path) == [os.path.basename(live._path(live._number))]
+    live.close(drained=True)
+    assert os.listdir(tmp_path) == []
+
+
+def test_recover_keeps_segment_on_error(tmp_path):
+    spill = SpillLog(str(tmp_path), fsync=False)
+    spill.append(1, PEREVAL)
+    crash(spill)
+
+    class FailingDB(FakeDB):
+        async def add_perevals(self, *args, **kwargs):
+            raise ConnectionError("БД недоступна")
+
+    assert asyncio.run(IngestQueue(FailingDB(), batch_size=10).recover(str(tmp_path))) == 0
+    assert len(os.listdir(tmp_path)) == 1
+    db = FakeDB()
+    assert asyncio.run(IngestQueue(db, batch_size=10).recover(str(tmp_path))) == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_recover_marks_deduplicated_records_failed(tmp_path):
+    spill = SpillLog(str(tmp_path), fsync=False)
+    spill.append(1, PEREVAL)
+    spill.append(2, dict(PEREVAL, title="Второй"))
+    crash(spill)
+
+    class DedupDB(FakeDB):
+        async def add_perevals(self, perevals, ids, content_hashes, keys):
+            # запись 1 уже сохранена под id 7 через другой процесс
+            await super().add_perevals(perevals, ids, content_hashes, keys)
+            return [7 if pereval_id == 1 else pereval_id for pereval_id in ids]
+
+    db = DedupDB()
+    assert asyncio.run(IngestQueue(db, batch_size=10).recover(str(tmp_path))) == 1
+    assert db.states == [([2], [(1, "Дубликат записи 7")])]
+
+
+def test_committed_segment_removed_after_rotate(tmp_path):
+    spill = SpillLog(str(tmp_path), fsync=False)
+    first = spill.append(1, PEREVAL)
+    spill.append(2, PEREVAL)
+    spill.rotate()
+    spill.committed(first)
+    assert len(os.listdir(tmp_path)) == 2
+    spill.committed(first)
+    assert os.listdir(tmp_path) == [os.path.basename(spill._path(spill._number))]
+    spill.close(drained=False)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from app.database import VersionConflictError, build_raw_patch
+from app.main import parse_if_match
+from app.models import PerevalPatch
+from tests.test_idempotency import unique_pereval
+
+
+def test_raw_patch_only_given_fields():
+    patch = PerevalPatch.model_validate({"connect": None, "coords": {"height": "3400"}, "level": {"summer": None}})
+    assert build_raw_patch(patch) == {"connect": "", "coords": {"height": "3400"}, "level": {"summer": ""}}
+    patch = PerevalPatch.model_validate({"beauty_title": "пер.", "user": {"email": "other@example.com"}})
+    assert build_raw_patch(patch) == {"beautyTitle": "пер."}
+
+
+def test_parse_if_match():
+    assert parse_if_match(None) is None
+    assert parse_if_match(" * ") is None
+    assert parse_if_match('"v3", W/"v4", "5", "v6"') == [3, 6]
+    assert parse_if_match('"x"') == []
+
+
+@pytest.mark.parametrize("target, patch, expected", [
+    # null удаляет ключ, остальные ключи сохраняются
+    ({"a": 1, "b": 2}, {"a": None}, {"b": 2}),
+    # вложенные объекты сливаются по полям
+    ({"coords": {"latitude": "1", "height": "2"}}, {"coords": {"height": "3"}},
+     {"coords": {"latitude": "1", "height": "3"}}),
+    # массивы заменяются целиком
+    ({"images": [1, 2]}, {"images": [3]}, {"images": [3]}),
+    # объект на месте не-объекта и наоборот
+    ({"a": "x"}, {"a": {"b": None, "c": 1}}, {"a": {"c": 1}}),
+    ({"a": {"b": 1}}, {"a": "x"}, {"a": "x"}),
+    ({"a": 1}, {}, {"a": 1}),
+])
+def test_merge_patch_sql(run_with_db, target, patch, expected):
+    async def scenario(db):
+        async with db.connection() as conn:
+            return await conn.fetchval("SELECT pereval_merge_patch($1::jsonb, $2::jsonb)", target, patch)
+
+    assert run_with_db(scenario) == expected
+
+
+def test_update_checks_version(run_with_db):
+    async def scenario(db):
+        pereval_id = await db.add_pereval(unique_pereval())
+        db.created.append(pereval_id)
+        patch = PerevalPatch.model_validate({"coords": {"height": "3400"}})
+
+        with pytest.raises(VersionConflictError) as conflict:
+            await db.update_pereval(pereval_id, patch, versions=[7])
+        assert conflict.value.version == 1
+        assert await db.update_pereval(pereval_id, patch, versions=[1]) == (2, None)
+        # версия 1 устарела
+        with pytest.raises(VersionConflictError):
+            await db.update_pereval(pereval_id, patch, versions=[1])
+
+        record = await db.get_pereval_by_id(pereval_id)
+        coords = json.loads(record["raw_data"])["coords"]
+        assert (coords["height"], coords["latitude"]) == ("3400", "39.08")
+
+        async with db.connection() as conn:
+            await conn.execute("UPDATE pereval_added SET status = 'accepted' WHERE id = $1", pereval_id)
+        version, message = await db.update_pereval(pereval_id, patch)
+        assert version is None and "статус" in message
+
+    run_with_db(scenario)
@@ -0,0 +1,90 @@
+import asyncio
+
+from app.async_database import AsyncDatabaseManager
+from app.replicas import LagTracker, Replica, read_from_primary, replica_hosts_from_env
+
+
+def test_lag_from_primary_wal_samples():
+    tracker = LagTracker(window=10)
+    tracker.sample(100, now=0)
+    tracker.sample(200, now=2)
+    tracker.sample(300, now=4)
+    assert tracker.lag(300, now=5) == 0.0
+    # реплика применила журнал до позиции 250: последняя пройденная отметка - 200 (в момент 2)
+    assert tracker.lag(250, now=5) == 3
+    assert tracker.lag(50, now=5) == float('inf')
+    assert tracker.lag(None, now=5) == float('inf')
+
+    # отметки старше окна забываются, кроме одной
+    tracker.sample(400, now=20)
+    assert tracker.lag(350, now=20) == 16
+    assert tracker.lag(250, now=20) == float('inf')
+
+
+def test_replica_excluded_while_lagging():
+    replica = Replica("replica1", 5432)
+    replica.pool = object()
+    replica.mark_checked(1.0, max_lag=5)
+    assert replica.available
+    replica.mark_checked(7.5, max_lag=5)
+    assert not replica.available and "7.5" in replica.error
+    replica.mark_checked(0.0, max_lag=5)
+    assert replica.available and replica.error is None
+
+
+def test_reads_skip_unavailable_replicas():
+    db = AsyncDatabaseManager()
+    db.replicas = [Replica("a", 5432), Replica("b", 5432), Replica("c", 5432)]
+    for replica in db.replicas:
+        replica.pool = object()
+        replica.mark_checked(0.0, max_lag=5)
+    db.replicas[1].mark_checked(60.0, max_lag=5)
+
+    picked = {db._pick_replica().name for _ in range(4)}
+    assert picked == {"a:5432", "c:5432"}
+
+    token = read_from_primary.set(True)
+    try:
+        assert db._pick_replica() is None
+    finally:
+        read_from_primary.reset(token)
+
+    db.replicas[0].mark_failed(ConnectionError("нет связи"))
+    db.replicas[2].mark_failed(ConnectionError("нет связи"))
+    assert db._pick_replica() is None
+
+
+def test_failed_replica_read_falls_back_to_primary():
+    db = AsyncDatabaseManager()
+    replica = Replica("a", 5432)
+    replica.pool = object()
+    replica.mark_checked(0.0, max_lag=5)
+    db.replicas = [replica]
+
+    class Connection:
+        """Соединение с реплики не выдаётся, с основного сервера - его имя"""
+
+        def __init__(self, target=None):
+            self.target = target
+
+        async def __aenter__(self):
+            if self.target is not None:
+                raise ConnectionRefusedError("реплика недоступна")
+            return "primary"
+
+        async def __aexit__(self, *exc):
+            return False
+
+    db.connection = Connection
+
+    async def run(conn):
+        return conn
+
+    assert asyncio.run(db._read(run)) == "primary"
+    assert not replica.available
+
+
+def test_replica_hosts_from_env(monkeypatch):
+    monkeypatch.setenv("FSTR_DB_PORT", "6432")
+    monkeypatch.setenv("FSTR_DB_REPLICAS", "replica1, replica2:5433,,")
+    assert replica_hosts_from_env() == [("replica1", 6432), ("replica2", 5433)]
@@ -0,0 +1,54 @@
+from app.search import SuggestTrie, normalize
+
+
+def titles(trie, prefix, limit=10):
+    return [item["title"] for item in trie.suggest(prefix, limit)]
+
+
+def test_normalize():
+    assert normalize("  Перевал   ЁЛКИ ") == "перевал елки"
+
+
+def test_prefix_of_title_and_word():
+    trie = SuggestTrie()
+    trie.load([(1, "пер. Анзоб", None), (2, "Анзоб", "Анзобский; Северный Анзоб")])
+    # сначала названия с ключом «анзоб», затем его продолжения
+    assert titles(trie, "анз") == ["Анзоб", "Северный Анзоб", "пер. Анзоб", "Анзобский"]
+    assert titles(trie, "СЕВ") == ["Северный Анзоб"]
+    assert titles(trie, "анзоб", limit=1) == ["Анзоб"]
+    assert titles(trie, "xyz") == []
+
+
+def test_counts_and_numbers_not_indexed():
+    trie = SuggestTrie()
+    trie.load([(1, "Анзоб 2", None), (2, "Анзоб 2", None)])
+    assert trie.suggest("анзоб") == [{"title": "Анзоб 2", "count": 2}]
+    assert trie.suggest("2") == []
+
+
+def test_upsert_and_remove():
+    trie = SuggestTrie()
+    trie.upsert(1, "Чимтарга", None)
+    trie.upsert(2, "Чиммерс", None)
+    trie.upsert(1, "Казнок", None)
+    assert titles(trie, "чим") == ["Чиммерс"]
+    assert titles(trie, "каз") == ["Казнок"]
+    trie.remove(2)
+    trie.remove(1)
+    assert len(trie) == 0
+    assert titles(trie, "") == []
+    assert trie.root.children == {}
+
+
+def test_edge_split_and_merge():
+    trie = SuggestTrie()
+    trie.upsert(1, "абвгд", None)
+    trie.upsert(2, "абвеж", None)
+    trie.upsert(3, "аб", None)
+    assert titles(trie, "абв") == ["абвгд", "абвеж"]
+    assert titles(trie, "аб") == ["аб", "абвгд", "абвеж"]
+    trie.remove(3)
+    trie.remove(2)
+    assert titles(trie, "абвг") == ["абвгд"]
+    label, _ = trie.root.children["а"]
+    assert label == "абвгд"
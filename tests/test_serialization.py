@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime
+
+import orjson
+import pytest
+from fastapi.exceptions import RequestValidationError
+
+from app.models import PerevalData
+from app.serialization import FastJSONResponse, dumps, inline_schema_refs, json_body, passthrough_row
+from tests.test_idempotency import PEREVAL
+
+
+def test_passthrough_row_inserts_jsonb_text_as_is():
+    raw_data = '{"title": "Анзоб", "coords": {"height": "3372"}}'
+    row = {"id": 1, "date_added": datetime(2024, 7, 1, 10, 0), "raw_data": raw_data, "images": None}
+    result = passthrough_row(row)
+    assert isinstance(result["raw_data"], orjson.Fragment)
+    assert result["images"] is None
+    body = dumps(result)
+    # текст из БД попал в ответ без разбора и повторного кодирования
+    assert raw_data.encode() in body
+    assert orjson.loads(body) == {"id": 1, "date_added": "2024-07-01T10:00:00",
+                                  "raw_data": orjson.loads(raw_data), "images": None}
+
+
+def test_fast_json_response_passes_bytes():
+    assert FastJSONResponse(b'{"a":1}').body == b'{"a":1}'
+    assert FastJSONResponse({"a": 1}).body == b'{"a":1}'
+
+
+class FakeRequest:
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def body(self) -> bytes:
+        return self._body
+
+
+def test_json_body_validates_bytes():
+    dependency = json_body(PerevalData)
+    pereval = asyncio.run(dependency(FakeRequest(orjson.dumps(PEREVAL))))
+    assert pereval.title == "Анзоб"
+    with pytest.raises(RequestValidationError) as error:
+        asyncio.run(dependency(FakeRequest(orjson.dumps(dict(PEREVAL, title=None)))))
+    assert error.value.errors()[0]["loc"] == ("body", "title")
+
+
+def test_inline_schema_refs():
+    schema = inline_schema_refs(PerevalData.model_json_schema())
+    assert "$defs" not in orjson.dumps(schema).decode()
+    assert schema["properties"]["user"]["properties"]["email"]["type"] == "string"
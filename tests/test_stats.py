@@ -0,0 +1,62 @@
+import asyncio
+
+from app.stats import StatsReader, area_bounds, ranked
+from tests.test_idempotency import unique_pereval
+
+
+class FakeDB:
+    def __init__(self):
+        self.reads = []
+
+    async def get_stats(self, dimensions):
+        self.reads.append(tuple(dimensions))
+        return {"total": {"": 12}, "status": {"new": 10, "accepted": 2}}
+
+    async def get_top_contributors(self, limit):
+        self.reads.append(("contributors", limit))
+        return [{"email": f"user{i}@example.com", "count": 10 - i} for i in range(limit)]
+
+
+def test_stats_reader_caches_dimensions():
+    async def scenario():
+        db = FakeDB()
+        stats = StatsReader(db, ttl=60)
+        assert await stats.total() == 12
+        assert await stats.counts("status") == {"new": 10, "accepted": 2}
+        assert await stats.total() == 12
+        assert len(await stats.contributors(3)) == 3
+        assert len(await stats.contributors(5)) == 5
+        return db.reads
+
+    assert asyncio.run(scenario()) == [("total",), ("status",), ("contributors", 100)]
+
+
+def test_ranked_and_area_bounds():
+    assert ranked({"b": 2, "a": 2, "c": 5}, 2) == [("c", 5), ("a", 2)]
+    assert area_bounds("-1,68") == {"lat_min": -1, "lon_min": 68, "lat_max": 0, "lon_max": 69}
+
+
+def test_reconcile_fixes_drifted_counters(run_with_db):
+    async def scenario(db):
+        pereval_id = await db.add_pereval(unique_pereval(add_time="1901-02-03 10:00:00"))
+        db.created.append(pereval_id)
+        async with db.connection() as conn:
+            actual = await conn.fetchval("SELECT count(*) FROM pereval_added")
+            assert (await db.get_stats(["total"]))["total"][""] == actual
+            # счётчики разошлись с данными: записи в обход триггеров
+            await conn.execute("""
+            INSERT INTO pereval_stats (dimension, key, slot, count)
+            VALUES ('total', '', 0, 5), ('month', '1900-01', 0, 3)
+            ON CONFLICT (dimension, key, slot) DO UPDATE SET count = pereval_stats.count + EXCLUDED.count
+            """)
+            await conn.execute("UPDATE pereval_stats SET count = count - 1 "
+                               "WHERE dimension = 'month' AND key = '1901-02' AND count > 0")
+
+        assert await db.reconcile_stats() >= 3
+        stats = await db.get_stats(["total", "month"])
+        assert stats["total"][""] == actual
+        assert "1900-01" not in stats["month"]
+        assert stats["month"]["1901-02"] >= 1
+        assert await db.reconcile_stats() == 0
+
+    run_with_db(scenario)